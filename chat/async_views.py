@@ -0,0 +1,349 @@
+# chat/async_views.py
+"""
+聊天接口的异步版本，请求和返回格式与 ChatMessageView、ChatMessageWithFilesView 相同。
+需要通过ASGI服务器运行（如 uvicorn rag_project.asgi:application）。
+
+DRF 的视图不支持异步，这里使用Django原生异步视图：数据库操作使用异步ORM，
+嵌入、重排序和模型调用通过异步HTTP客户端完成，等待外部服务期间不占用工作线程，
+一个进程可以同时处理大量进行中的对话。FAISS检索等本地计算在线程中执行。
+"""
+import json
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+from core.llm.services import aget_default_model_name, aget_llm_service
+from core.rag.services import get_knowledge_base_rag_service
+from knowledge_base.models import KnowledgeBase
+from model_manager.models import SystemPrompt
+from .history import aget_history_messages, get_history_budget
+from .models import ChatHistory, ChatMessage
+from .serializers import ChatInputSerializer
+from .views import (
+    FILE_RAG_ERROR_NOTE, FILE_SEARCH_MAX_DOCS, build_file_message, build_file_no_results_prompt,
+    build_no_kb_prompt, build_no_results_prompt, get_file_search_queries, get_uploaded_files,
+    save_chat_files,
+)
+
+def json_response(data, status=200):
+    # 使用DRF的编码器，与同步接口的返回内容一致（如检索分数中的numpy数值）
+    return JsonResponse(data, status=status, safe=False, encoder=JSONEncoder,
+                        json_dumps_params={'ensure_ascii': False})
+
+def error_response(message, status):
+    return json_response({'error': message}, status=status)
+
+async def authenticate(request):
+    """与 JWTAuthentication 相同，按 Authorization 头中的访问令牌认证用户，失败时返回 None"""
+    authentication = JWTAuthentication()
+    try:
+        header = authentication.get_header(request)
+        if header is None:
+            return None
+        raw_token = authentication.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = authentication.get_validated_token(raw_token)
+    except AuthenticationFailed:
+        return None
+
+    user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+    user = await get_user_model().objects.filter(**{api_settings.USER_ID_FIELD: user_id}).afirst()
+    if user is None or not user.is_active:
+        return None
+    return user
+
+def unauthorized_response():
+    return json_response({'detail': '身份认证信息未提供或无效'}, status=401)
+
+async def acreate_chat_history(user, message, model_name, use_rag, knowledge_base, system_prompt_id):
+    return await ChatHistory.objects.acreate(
+        user=user,
+        title=message[:20] + ('...' if len(message) > 20 else ''),
+        config={
+            'model': model_name,
+            'use_rag': use_rag,
+            'knowledge_base': knowledge_base,
+            'system_prompt_id': system_prompt_id
+        }
+    )
+
+async def abuild_history_messages(chat_history, system_prompt_id, exclude_message_id, context_length,
+                                  current_message, use_rag=False):
+    """系统提示词加上按上下文长度截取的聊天历史（不含刚保存的用户消息）"""
+    messages = []
+    if system_prompt_id:
+        system_prompt = await SystemPrompt.objects.filter(id=system_prompt_id).afirst()
+        if system_prompt:
+            messages.append({'role': 'system', 'content': system_prompt.content})
+
+    budget = get_history_budget(
+        context_length, messages + [{'role': 'user', 'content': current_message}], use_rag=use_rag
+    )
+    messages.extend(await aget_history_messages(chat_history, budget, exclude_message_id=exclude_message_id))
+    return messages
+
+async def aget_knowledge_base(user, knowledge_base):
+    return await KnowledgeBase.objects.select_related('user').filter(name=knowledge_base, user=user).afirst()
+
+async def agenerate_reply(llm_service, messages, chat_history):
+    """异步调用模型并保存助手回复，返回 (回复内容, 思考过程)"""
+    response = await llm_service.agenerate(messages)
+    assistant_message = response['choices'][0]['message']['content']
+    thinking_process = response.get('thinking_process')
+
+    if thinking_process:
+        print(f"\n=== 思考过程（长度: {len(thinking_process)}）===\n{thinking_process}\n")
+    print(f"\n=== 生成的回复（长度: {len(assistant_message)}）===\n{assistant_message}\n")
+
+    await ChatMessage.objects.acreate(
+        chat_history=chat_history,
+        role='assistant',
+        content=assistant_message,
+        thinking_process=thinking_process
+    )
+    return assistant_message, thinking_process
+
+async def aprepare_chat_messages(user, message, model_name, history_id=None, use_rag=False,
+                                 knowledge_base='', system_prompt_id=None, context_length=None):
+    """
+    prepare_chat_messages 的异步版本。
+    返回 (chat_history, messages, related_docs)，聊天历史不存在时 chat_history 为 None
+    """
+    if history_id:
+        chat_history = await ChatHistory.objects.filter(id=history_id, user=user).afirst()
+        if chat_history is None:
+            return None, [], None
+    else:
+        chat_history = await acreate_chat_history(
+            user, message, model_name, use_rag, knowledge_base, system_prompt_id
+        )
+
+    user_message = await ChatMessage.objects.acreate(
+        chat_history=chat_history,
+        role='user',
+        content=message,
+        raw_input=message
+    )
+    messages = await abuild_history_messages(
+        chat_history, system_prompt_id, user_message.id, context_length, message,
+        use_rag=bool(use_rag and knowledge_base)
+    )
+
+    related_docs = None
+    if not (use_rag and knowledge_base):
+        messages.append({'role': 'user', 'content': message})
+        return chat_history, messages, related_docs
+
+    try:
+        print(f"开始进行RAG处理: 知识库={knowledge_base}, 查询={message[:50]}...")
+        kb = await aget_knowledge_base(user, knowledge_base)
+        if kb is None:
+            print(f"错误: 知识库 '{knowledge_base}' 不存在")
+            no_kb_prompt = build_no_kb_prompt(knowledge_base, message)
+            user_message.raw_input = no_kb_prompt
+            await user_message.asave()
+            messages.append({'role': 'user', 'content': no_kb_prompt})
+            raise ValueError(f"找不到指定的知识库 '{knowledge_base}' 或用户无权访问")
+        print(f"找到知识库: {kb.name}, ID: {kb.id}, 用户: {kb.user.username}, 文档数: {await kb.documents.acount()}")
+
+        # 首次加载索引需要读取磁盘，放到独立线程中执行，不占用异步ORM的执行线程
+        rag_service = await sync_to_async(get_knowledge_base_rag_service, thread_sensitive=False)(kb)
+        docs = await rag_service.aretrieve(message)
+
+        if docs:
+            print(f"RAG检索成功: 找到 {len(docs)} 个相关文档")
+            related_docs = [{'content': doc.page_content, 'metadata': doc.metadata} for doc in docs]
+            prompt = rag_service.create_prompt(message, docs)
+            user_message.related_docs = related_docs
+            print(f"生成RAG提示词成功，长度: {len(prompt)}")
+        else:
+            print("RAG未能找到相关文档，使用特殊提示处理")
+            prompt = build_no_results_prompt(message)
+            user_message.related_docs = []
+        user_message.rag_prompt = prompt
+        await user_message.asave()
+
+        # 与同步版本相同：有消息历史时替换最后一条消息的内容
+        if messages:
+            messages[-1]['content'] = prompt
+        else:
+            messages.append({'role': 'user', 'content': prompt})
+    except Exception as e:
+        print(f"RAG处理错误: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        messages.append({'role': 'user', 'content': message})
+
+    return chat_history, messages, related_docs
+
+@csrf_exempt
+@require_POST
+async def chat_message(request):
+    """ChatMessageView 的异步版本"""
+    user = await authenticate(request)
+    if user is None:
+        return unauthorized_response()
+
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return error_response('请求数据不是有效的JSON', 400)
+    serializer = ChatInputSerializer(data=data)
+    if not serializer.is_valid():
+        return json_response(serializer.errors, status=400)
+
+    default_model = await aget_default_model_name()
+    if not default_model:
+        return error_response('没有可用的模型，请在管理界面添加并激活至少一个模型', 400)
+    model_name = serializer.validated_data.get('model', default_model)
+    llm_service = await aget_llm_service(model_name)
+    if not llm_service:
+        return error_response(f'模型 {model_name} 不存在或未激活，请选择其他模型', 400)
+
+    chat_history, messages, related_docs = await aprepare_chat_messages(
+        user, serializer.validated_data['message'], model_name,
+        history_id=serializer.validated_data.get('history_id'),
+        use_rag=serializer.validated_data.get('use_rag', False),
+        knowledge_base=serializer.validated_data.get('knowledge_base', ''),
+        system_prompt_id=serializer.validated_data.get('system_prompt_id'),
+        context_length=llm_service.context_length,
+    )
+    if chat_history is None:
+        return json_response({'detail': '聊天记录不存在'}, status=404)
+
+    try:
+        assistant_message, thinking_process = await agenerate_reply(llm_service, messages, chat_history)
+    except Exception as e:
+        print(f"生成回复时出错: {str(e)}")
+        return error_response(f'生成回复时出错: {str(e)}', 500)
+
+    return json_response({
+        'message': assistant_message,
+        'history_id': chat_history.id,
+        'related_docs': related_docs,
+        'thinking_process': thinking_process
+    })
+
+def parse_files_request(request):
+    """解析表单（或JSON）数据和上传的文件"""
+    if request.content_type == 'application/json':
+        return json.loads(request.body or b'{}'), []
+    return request.POST, get_uploaded_files(request.FILES)
+
+@csrf_exempt
+@require_POST
+async def chat_message_with_files(request):
+    """ChatMessageWithFilesView 的异步版本"""
+    user = await authenticate(request)
+    if user is None:
+        return unauthorized_response()
+
+    try:
+        # 解析上传的文件需要读写临时文件，放到线程中执行
+        data, files = await sync_to_async(parse_files_request)(request)
+        message = data.get('message', '')
+        history_id = data.get('history_id')
+        default_model = await aget_default_model_name()
+        if not default_model:
+            return error_response('没有可用的模型，请在管理界面添加并激活至少一个模型', 400)
+        model_name = data.get('model', default_model)
+        llm_service = await aget_llm_service(model_name)
+        if not llm_service:
+            return error_response(f'模型 {model_name} 不存在或未激活，请选择其他模型', 400)
+        use_rag = data.get('use_rag') in [True, 'true', 'True', '1']
+        knowledge_base = data.get('knowledge_base', '')
+        system_prompt_id = data.get('system_prompt_id')
+
+        # 文件内容提取（如PDF解析）耗时较长，不占用处理数据库操作的线程
+        domain = request.build_absolute_uri('/').rstrip('/')
+        file_data, file_contents = await sync_to_async(save_chat_files, thread_sensitive=False)(
+            user.id, files, domain
+        )
+
+        chat_history = None
+        if history_id:
+            try:
+                chat_history = await ChatHistory.objects.filter(id=history_id, user=user).afirst()
+            except (ValueError, TypeError):
+                chat_history = None
+        if chat_history is None:
+            # 如果找不到历史ID，创建新的
+            chat_history = await acreate_chat_history(
+                user, message, model_name, use_rag, knowledge_base, system_prompt_id
+            )
+
+        enhanced_message = build_file_message(message, file_contents)
+        user_message = await ChatMessage.objects.acreate(
+            chat_history=chat_history,
+            role='user',
+            content=message,
+            raw_input=enhanced_message,
+            attachments=file_data if file_data else None
+        )
+        messages = await abuild_history_messages(
+            chat_history, system_prompt_id, user_message.id, llm_service.context_length, enhanced_message,
+            use_rag=bool(use_rag and knowledge_base)
+        )
+
+        related_docs = None
+        if use_rag and knowledge_base:
+            try:
+                kb = await aget_knowledge_base(user, knowledge_base)
+                if kb is None:
+                    print(f"错误: 指定的知识库 '{knowledge_base}' 不存在")
+                    no_kb_prompt = build_no_kb_prompt(knowledge_base, enhanced_message)
+                    user_message.raw_input = no_kb_prompt
+                    await user_message.asave()
+                    messages.append({'role': 'user', 'content': no_kb_prompt})
+                    raise ValueError(f"指定的知识库 '{knowledge_base}' 不存在")
+                print(f"知识库: {kb.name}, ID: {kb.id}, 用户: {kb.user.username}")
+
+                rag_service = await sync_to_async(get_knowledge_base_rag_service, thread_sensitive=False)(kb)
+                search_queries = get_file_search_queries(message, file_contents)
+                unique_docs_list = await rag_service.aretrieve_many(search_queries, top_k=FILE_SEARCH_MAX_DOCS)
+
+                if unique_docs_list:
+                    related_docs = [{'content': doc.page_content, 'metadata': doc.metadata} for doc in unique_docs_list]
+                    prompt = rag_service.create_prompt(enhanced_message, unique_docs_list)
+                    user_message.related_docs = related_docs
+                    print(f"生成RAG提示词成功，长度: {len(prompt)}")
+                else:
+                    print("未找到任何高相关度文档，使用无结果提示词")
+                    prompt = build_file_no_results_prompt(enhanced_message)
+                    user_message.related_docs = []
+                user_message.rag_prompt = prompt
+                await user_message.asave()
+                messages.append({'role': 'user', 'content': prompt})
+            except Exception as e:
+                print(f"RAG处理错误: {str(e)}")
+                import traceback
+                traceback.print_exc()
+                messages.append({'role': 'user', 'content': enhanced_message + FILE_RAG_ERROR_NOTE})
+        else:
+            messages.append({'role': 'user', 'content': enhanced_message})
+
+        print("开始生成回复...")
+        try:
+            assistant_message, thinking_process = await agenerate_reply(llm_service, messages, chat_history)
+        except Exception as e:
+            print(f"生成回复时出错: {str(e)}")
+            return error_response(f'生成回复时出错: {str(e)}', 500)
+
+        return json_response({
+            'message': assistant_message,
+            'history_id': chat_history.id,
+            'related_docs': related_docs,
+            'thinking_process': thinking_process,
+            'files': file_data
+        })
+    except Exception as e:
+        print(f"处理带文件的消息时出错: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return error_response(f'处理带文件的消息时出错: {str(e)}', 500)
@@ -0,0 +1,130 @@
+# chat/history.py
+"""
+按模型上下文长度组装发送给模型的聊天历史。
+只查询最近 max_messages 条尚未并入摘要的消息（只取需要的字段），从最新的消息往前按token预算保留滑动窗口；
+被挤出窗口的早期消息压缩后并入 ChatHistory.summary 中的滚动摘要，作为一条系统消息放在窗口之前。
+摘要随窗口移动逐步更新，不需要额外调用模型。
+"""
+from django.conf import settings
+from core.llm.tokenizer import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, count_message_tokens, count_tokens
+from .models import ChatHistory, ChatMessage
+
+SUMMARY_PREFIX = '以下是之前对话的摘要：\n'
+ROLE_LABELS = {'user': '用户', 'assistant': '助手', 'system': '系统'}
+
+def get_history_config():
+    """读取 RAG_CONFIGS['chat_history']"""
+    config = getattr(settings, 'RAG_CONFIGS', {}).get('chat_history', {})
+    return {
+        'reply_tokens': int(config.get('reply_tokens', 1024)),
+        'rag_tokens': int(config.get('rag_tokens', 2048)),
+        'max_messages': int(config.get('max_messages', 50)),
+        'summary_tokens': int(config.get('summary_tokens', 512)),
+        'summary_line_chars': int(config.get('summary_line_chars', 200)),
+    }
+
+def get_history_budget(context_length, fixed_messages, use_rag=False):
+    """
+    聊天历史可用的token数：上下文长度减去回复预留、固定消息（系统提示词、当前消息）
+    以及启用RAG时为检索结果预留的部分
+    """
+    config = get_history_config()
+    budget = (context_length or 4096) - config['reply_tokens'] - TOKENS_PER_REPLY
+    budget -= sum(count_message_tokens(message) for message in fixed_messages)
+    if use_rag:
+        budget -= config['rag_tokens']
+    return max(budget, 0)
+
+def history_queryset(chat_history, exclude_message_id=None):
+    """最近的 max_messages 条尚未并入摘要的消息，从新到旧"""
+    # 不通过 chat_history.messages 查询：关联管理器会给每条消息回填外键，触发延迟字段的逐条查询
+    queryset = ChatMessage.objects.filter(chat_history_id=chat_history.id).only('id', 'role', 'content')
+    if exclude_message_id is not None:
+        queryset = queryset.exclude(id=exclude_message_id)
+    if chat_history.summary_message_id:
+        queryset = queryset.filter(id__gt=chat_history.summary_message_id)
+    return queryset.order_by('-created_at', '-id')[:get_history_config()['max_messages']]
+
+def split_window(recent_messages, budget):
+    """
+    recent_messages 从新到旧。
+    返回 (窗口内的消息, 挤出窗口的消息)，都按从旧到新排列
+    """
+    used = 0
+    kept = 0
+    for msg in recent_messages:
+        cost = count_message_tokens({'content': msg.content})
+        if used + cost > budget:
+            break
+        used += cost
+        kept += 1
+    return recent_messages[:kept][::-1], recent_messages[kept:][::-1]
+
+def summary_line(msg, max_chars):
+    content = ' '.join((msg.content or '').split())
+    if len(content) > max_chars:
+        content = content[:max_chars] + '…'
+    return f"{ROLE_LABELS.get(msg.role, msg.role)}：{content}"
+
+def merge_summary(summary, dropped_messages):
+    """把挤出窗口的消息逐条压缩为一行并入摘要，超过 summary_tokens 时丢弃最早的行"""
+    config = get_history_config()
+    lines = summary.splitlines() if summary else []
+    lines.extend(summary_line(msg, config['summary_line_chars']) for msg in dropped_messages)
+    # 每行单独计数，已有的行命中计数缓存
+    line_tokens = [count_tokens(line) + 1 for line in lines]
+    total = sum(line_tokens)
+    start = 0
+    while start < len(lines) and total > config['summary_tokens']:
+        total -= line_tokens[start]
+        start += 1
+    return '\n'.join(lines[start:])
+
+def assemble_history(chat_history, recent_messages, budget):
+    """
+    recent_messages 为 history_queryset 的结果。
+    返回 (历史消息列表, 摘要更新)，摘要不需要更新时后者为 None，否则为 (新摘要, 已并入摘要的最后一条消息ID)
+    """
+    recent_messages = list(recent_messages)
+    summary = chat_history.summary
+    window, dropped = split_window(recent_messages, budget)
+    if dropped or summary:
+        # 需要摘要时先为它预留空间
+        summary_budget = get_history_config()['summary_tokens'] + TOKENS_PER_MESSAGE
+        window, dropped = split_window(recent_messages, max(budget - summary_budget, 0))
+
+    update = None
+    if dropped:
+        # 超出 max_messages 查询范围的更早消息（只在旧会话第一次组装时出现）不再并入摘要
+        summary = merge_summary(summary, dropped)
+        update = (summary, dropped[-1].id)
+
+    messages = []
+    if summary:
+        messages.append({'role': 'system', 'content': SUMMARY_PREFIX + summary})
+    messages.extend({'role': msg.role, 'content': msg.content} for msg in window)
+    return messages, update
+
+def _summary_queryset(chat_history):
+    # 只在摘要位置没有被并发请求推进时更新；使用 update() 不修改会话的 updated_at
+    return ChatHistory.objects.filter(id=chat_history.id, summary_message_id=chat_history.summary_message_id)
+
+def _apply_summary(chat_history, update):
+    chat_history.summary, chat_history.summary_message_id = update
+
+def get_history_messages(chat_history, budget, exclude_message_id=None):
+    """按token预算组装聊天历史（不含系统提示词和当前消息），必要时更新滚动摘要"""
+    messages, update = assemble_history(chat_history, history_queryset(chat_history, exclude_message_id), budget)
+    if update:
+        _summary_queryset(chat_history).update(summary=update[0], summary_message_id=update[1])
+        _apply_summary(chat_history, update)
+    return messages
+
+async def aget_history_messages(chat_history, budget, exclude_message_id=None):
+    """get_history_messages 的异步版本"""
+    recent_messages = [msg async for msg in history_queryset(chat_history, exclude_message_id)]
+    messages, update = assemble_history(chat_history, recent_messages, budget)
+    if update:
+        await _summary_queryset(chat_history).aupdate(summary=update[0], summary_message_id=update[1])
+        _apply_summary(chat_history, update)
+    return messages
@@ -0,0 +1,147 @@
+# chat/management/commands/benchmark_chat.py
+import asyncio
+import contextlib
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncRequestFactory
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import RefreshToken
+from model_manager.models import LLMModel
+from chat.async_views import chat_message
+from chat.views import ChatMessageView
+
+class StubLLMServer(ThreadingHTTPServer):
+    """模拟OpenAI兼容接口的本地服务，每个请求等待 delay 秒后返回固定回复"""
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, delay):
+        self.delay = delay
+        super().__init__(('127.0.0.1', 0), StubLLMHandler)
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        time.sleep(self.server.delay)
+        payload = json.dumps({
+            'id': f'chatcmpl-{uuid4().hex}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': '这是测试回复。'},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2},
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+class Command(BaseCommand):
+    help = '用本地模拟模型服务对比同步和异步聊天接口的并发能力'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='每种接口发送的请求数')
+        parser.add_argument('--threads', type=int, default=8,
+                            help='同步接口的工作线程数（相当于WSGI服务器的线程数）')
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='异步接口同时进行的请求数，默认全部同时发送')
+        parser.add_argument('--delay', type=float, default=1.0, help='模拟模型每次回复的耗时（秒）')
+
+    def handle(self, *args, **options):
+        server = StubLLMServer(options['delay'])
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        suffix = uuid4().hex[:8]
+        user = User.objects.create_user(username=f'benchmark_{suffix}', password=uuid4().hex)
+        model = LLMModel.objects.create(
+            name=f'benchmark-stub-{suffix}',
+            display_name='Benchmark Stub',
+            provider='openai',
+            api_key='benchmark',
+            base_url=f'http://127.0.0.1:{server.server_address[1]}/v1',
+        )
+        payload = {'message': '你好', 'model': model.name}
+        self.stdout.write(
+            f"请求数: {options['requests']}，模拟模型耗时: {options['delay']}s，"
+            f"同步工作线程: {options['threads']}"
+        )
+        try:
+            # 视图中的调试输出很多，运行期间不显示
+            with contextlib.redirect_stdout(io.StringIO()):
+                sync_result = self.run_sync(user, payload, options['requests'], options['threads'])
+                async_result = asyncio.run(self.run_async(
+                    user, payload, options['requests'], options['concurrency'] or options['requests']
+                ))
+            self.report('同步接口', *sync_result)
+            self.report('异步接口', *async_result)
+            sync_rate, async_rate = self.throughput(*sync_result), self.throughput(*async_result)
+            if sync_rate and async_rate:
+                self.stdout.write(f"异步接口吞吐量是同步接口的 {async_rate / sync_rate:.1f} 倍")
+        finally:
+            server.shutdown()
+            server.server_close()
+            user.delete()
+            model.delete()
+
+    @staticmethod
+    def throughput(succeeded, elapsed, total):
+        return succeeded / elapsed if elapsed else 0
+
+    def report(self, label, succeeded, elapsed, total):
+        self.stdout.write(
+            f"{label}: 成功 {succeeded}/{total}，耗时 {elapsed:.2f}s，"
+            f"吞吐量 {self.throughput(succeeded, elapsed, total):.1f} 请求/秒"
+        )
+
+    def run_sync(self, user, payload, total, threads):
+        """同步视图在固定数量的线程中处理请求，每个请求占用一个线程直到模型返回"""
+        factory = APIRequestFactory()
+        view = ChatMessageView.as_view()
+
+        def send():
+            request = factory.post('/api/chat/', payload, format='json')
+            force_authenticate(request, user=user)
+            try:
+                return view(request).status_code == 200
+            finally:
+                connection.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(lambda _: send(), range(total)))
+        return sum(results), time.perf_counter() - start, total
+
+    async def run_async(self, user, payload, total, concurrency):
+        """异步视图在一个事件循环中同时处理所有请求"""
+        factory = AsyncRequestFactory()
+        token = str(RefreshToken.for_user(user).access_token)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send():
+            async with semaphore:
+                request = factory.post(
+                    '/api/chat/async/', payload, content_type='application/json',
+                    headers={'Authorization': f'Bearer {token}'}
+                )
+                response = await chat_message(request)
+                return response.status_code == 200
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(send() for _ in range(total)))
+        return sum(results), time.perf_counter() - start, total
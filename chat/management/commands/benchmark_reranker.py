@@ -0,0 +1,115 @@
+# chat/management/commands/benchmark_reranker.py
+import random
+import statistics
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core.rag.reranker import get_reranker
+
+SAMPLE_PARAGRAPHS = [
+    "公民有受教育的权利和义务。国家培养青年、少年、儿童在品德、智力、体质等方面全面发展。",
+    "国家通过各种途径，创造劳动就业条件，加强劳动保护，改善劳动条件，并在发展生产的基础上，提高劳动报酬和福利待遇。",
+    "劳动者有休息的权利。国家发展劳动者休息和休养的设施，规定职工的工作时间和休假制度。",
+    "中华人民共和国年满十八周岁的公民，不分民族、种族、性别、职业、家庭出身、宗教信仰、教育程度、财产状况、居住期限，都有选举权和被选举权。",
+    "中华人民共和国公民的住宅不受侵犯。禁止非法搜查或者非法侵入公民的住宅。",
+    "中华人民共和国公民的通信自由和通信秘密受法律的保护。",
+    "国家采取综合措施，控制人口数量，提高人口素质。国家依靠宣传教育、科学技术进步、综合服务、建立健全奖励和社会保障制度，开展人口与计划生育工作。",
+    "夫妻双方在实行计划生育中负有共同的责任。公民有生育的权利，也有依法实行计划生育的义务。",
+    "各级人民政府及其工作人员在推行计划生育工作中应当严格依法行政，文明执法，不得侵犯公民的合法权益。",
+    "国家建立、健全基本养老保险、基本医疗保险、生育保险和社会福利等社会保障制度，促进计划生育。",
+    "合同当事人应当遵循诚信原则，根据合同的性质、目的和交易习惯履行通知、协助、保密等义务。",
+    "当事人一方不履行合同义务或者履行合同义务不符合约定的，应当承担继续履行、采取补救措施或者赔偿损失等违约责任。",
+]
+
+class Command(BaseCommand):
+    help = '对比本地ONNX交叉编码器和远程重排序接口的延迟（使用 RAG_CONFIGS["reranker"] 中的配置）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=20, help='测试的查询数')
+        parser.add_argument('--docs', type=int, default=20, help='每个查询的候选文档数')
+        parser.add_argument('--file', default=None,
+                            help='用文本文件中的段落（以空行分隔）作为候选文档，默认使用内置示例')
+        parser.add_argument('--skip-remote', action='store_true', help='只测试本地模型')
+
+    def handle(self, *args, **options):
+        paragraphs = self.load_paragraphs(options['file'])
+        rng = random.Random(0)
+        cases = []
+        for _ in range(options['queries']):
+            # 查询取某个段落的前半句，候选文档从所有段落中抽样（数量不够时重复并加编号）
+            query = rng.choice(paragraphs).split('，')[0]
+            docs = [f"{rng.choice(paragraphs)}（{i}）" for i in range(options['docs'])]
+            cases.append((query, docs))
+
+        # 关闭分数缓存，每次都实际计算
+        reranker_cfg = dict(getattr(settings, 'RAG_CONFIGS', {}).get('reranker', {}), cache_size=0)
+        rerankers = [('本地模型', get_reranker(dict(reranker_cfg, provider='local')))]
+        if not options['skip_remote']:
+            rerankers.append(('远程接口', get_reranker(dict(reranker_cfg, provider='siliconflow'))))
+
+        self.stdout.write(f"查询数: {len(cases)}，每个查询的候选文档: {options['docs']}")
+        results = {}
+        for label, reranker in rerankers:
+            if reranker is None:
+                self.stdout.write(f"{label}: 不可用，跳过")
+                continue
+            results[label] = self.run(label, reranker, cases)
+
+        if len(results) == 2:
+            self.report_agreement(cases, *results.values())
+
+    @staticmethod
+    def load_paragraphs(path):
+        if not path:
+            return SAMPLE_PARAGRAPHS
+        with open(path, encoding='utf-8') as f:
+            paragraphs = [p.strip() for p in f.read().split('\n\n') if p.strip()]
+        return paragraphs or SAMPLE_PARAGRAPHS
+
+    def run(self, label, reranker, cases):
+        """逐个查询计时，返回每个查询的分数（失败为 None）"""
+        try:
+            # 预热：加载模型、建立连接
+            reranker.compute_score([[cases[0][0], doc] for doc in cases[0][1]])
+        except Exception as e:
+            self.stdout.write(f"{label}: 预热失败（{e}），跳过")
+            return [None] * len(cases)
+
+        latencies = []
+        all_scores = []
+        errors = 0
+        for query, docs in cases:
+            start = time.perf_counter()
+            try:
+                all_scores.append(reranker.compute_score([[query, doc] for doc in docs]))
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors += 1
+                all_scores.append(None)
+                print(f"{label} 重排序出错: {e}")
+
+        if latencies:
+            latencies.sort()
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            total_docs = sum(len(docs) for _, docs in cases) * len(latencies) / len(cases)
+            self.stdout.write(
+                f"{label}: 平均 {statistics.mean(latencies) * 1000:.1f}ms，"
+                f"P50 {statistics.median(latencies) * 1000:.1f}ms，P95 {p95 * 1000:.1f}ms，"
+                f"{total_docs / sum(latencies):.0f} 文档/秒，失败 {errors}"
+            )
+        else:
+            self.stdout.write(f"{label}: 全部失败（{errors}）")
+        return all_scores
+
+    def report_agreement(self, cases, local_scores, remote_scores):
+        """两种方式前3名文档的重合程度"""
+        overlaps = []
+        for (_, docs), local, remote in zip(cases, local_scores, remote_scores):
+            if local is None or remote is None:
+                continue
+            top = min(3, len(docs))
+            local_top = set(sorted(range(len(docs)), key=lambda i: local[i], reverse=True)[:top])
+            remote_top = set(sorted(range(len(docs)), key=lambda i: remote[i], reverse=True)[:top])
+            overlaps.append(len(local_top & remote_top) / top)
+        if overlaps:
+            self.stdout.write(f"前3名文档平均重合率: {statistics.mean(overlaps):.0%}")
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-16 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0003_chatmessage_attachments"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chathistory",
+            name="summary",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="chathistory",
+            name="summary_message_id",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
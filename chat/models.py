@@ -8,6 +8,9 @@ class ChatHistory(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     config = models.JSONField(blank=True, null=True)
+    # 滚动摘要：超出上下文窗口的早期消息压缩后保存在这里，summary_message_id 为已并入摘要的最后一条消息
+    summary = models.TextField(blank=True, null=True)
+    summary_message_id = models.BigIntegerField(blank=True, null=True)
     
     def __str__(self):
         return f"{self.title or '未命名会话'} - {self.created_at.strftime('%Y-%m-%d %H:%M')}"
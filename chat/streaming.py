@@ -0,0 +1,161 @@
+# chat/streaming.py
+"""
+流式聊天接口（Server-Sent Events）。
+先发送检索到的相关文档，然后逐块发送思考过程和回答，生成结束后保存助手消息。
+前端使用 fetch 发送POST请求并读取响应流，访问令牌和消息内容不出现在URL和访问日志中。
+"""
+import json
+from django.http import StreamingHttpResponse
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.response import Response
+from core.llm.services import get_llm_service
+from .models import ChatMessage
+from .serializers import ChatInputSerializer
+from .views import get_default_model, prepare_chat_messages
+
+def sse_event(event, data):
+    """按SSE格式编码一个事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+class EventStreamRenderer(BaseRenderer):
+    """请求的 Accept 为 text/event-stream 时，出错时把错误信息作为 error 事件返回"""
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return sse_event('error', data).encode(self.charset)
+
+def _get_field(obj, name, default=None):
+    # 本地模型的流式块是字典，其他模型是OpenAI的Chunk对象
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+def iter_stream_deltas(stream):
+    """
+    把 LLMService.generate(stream=True) 的输出统一为 (thinking_delta, answer_delta) 序列。
+    本地模型的 <think> 块由 _handle_local_stream 拆分，远程推理模型的思考过程在 reasoning_content 中。
+    """
+    thinking_sent = 0
+    for chunk in stream:
+        choices = _get_field(chunk, 'choices') or []
+        if not choices:
+            continue
+        choice = choices[0]
+        delta = _get_field(choice, 'delta') or {}
+        answer_delta = _get_field(delta, 'content') or ''
+        thinking_delta = ''
+
+        if _get_field(choice, 'final_answer') is not None:
+            # 本地模型的结束块只包含汇总结果
+            continue
+        if _get_field(choice, 'thinking_end'):
+            # 思考结束块中的 thinking_content 是完整的思考过程，只发送尚未发送的部分
+            thinking_delta = (_get_field(choice, 'thinking_content') or '')[thinking_sent:]
+        elif _get_field(choice, 'thinking'):
+            thinking_delta = _get_field(choice, 'thinking_content') or ''
+        else:
+            thinking_delta = _get_field(delta, 'reasoning_content') or ''
+
+        thinking_sent += len(thinking_delta)
+        if thinking_delta or answer_delta:
+            yield thinking_delta, answer_delta
+
+def iter_chat_events(llm_service, messages, chat_history, related_docs):
+    """生成SSE事件流，结束（或客户端断开）时保存已生成的回复"""
+    thinking_parts = []
+    answer_parts = []
+
+    def save_reply():
+        answer = "".join(answer_parts).strip()
+        thinking = "".join(thinking_parts).strip()
+        if not answer and not thinking:
+            return None
+        return ChatMessage.objects.create(
+            chat_history=chat_history,
+            role='assistant',
+            content=answer,
+            thinking_process=thinking or None
+        )
+
+    yield sse_event('related_docs', {'history_id': chat_history.id, 'related_docs': related_docs})
+
+    error = None
+    stream = None
+    try:
+        stream = llm_service.generate(messages, stream=True)
+        for thinking_delta, answer_delta in iter_stream_deltas(stream):
+            if thinking_delta:
+                thinking_parts.append(thinking_delta)
+                yield sse_event('thinking', {'content': thinking_delta})
+            if answer_delta:
+                answer_parts.append(answer_delta)
+                yield sse_event('answer', {'content': answer_delta})
+    except GeneratorExit:
+        # 客户端断开连接：关闭上游的模型流（释放连接，模型不再继续生成），保存已经生成的部分
+        close = getattr(stream, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                print(f"关闭模型流式响应时出错: {str(e)}")
+        save_reply()
+        raise
+    except Exception as e:
+        print(f"流式生成回复时出错: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        error = str(e)
+
+    assistant_message = save_reply()
+    if error:
+        yield sse_event('error', {'error': f'生成回复时出错: {error}'})
+    yield sse_event('done', {
+        'history_id': chat_history.id,
+        'message_id': assistant_message.id if assistant_message else None,
+    })
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+def stream_chat(request):
+    """流式聊天：POST JSON 与 ChatMessageView 相同，通过 Authorization 请求头认证"""
+    serializer = ChatInputSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    default_model = get_default_model()
+    if not default_model:
+        return Response(
+            {'error': '没有可用的模型，请在管理界面添加并激活至少一个模型'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    model_name = serializer.validated_data.get('model', default_model)
+    llm_service = get_llm_service(model_name)
+    if not llm_service:
+        return Response(
+            {'error': f'模型 {model_name} 不存在或未激活，请选择其他模型'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    chat_history, messages, related_docs = prepare_chat_messages(
+        request.user, serializer.validated_data['message'], model_name,
+        history_id=serializer.validated_data.get('history_id'),
+        use_rag=serializer.validated_data.get('use_rag', False),
+        knowledge_base=serializer.validated_data.get('knowledge_base', ''),
+        system_prompt_id=serializer.validated_data.get('system_prompt_id'),
+        context_length=llm_service.context_length,
+    )
+
+    response = StreamingHttpResponse(
+        iter_chat_events(llm_service, messages, chat_history, related_docs),
+        content_type='text/event-stream'
+    )
+    # 禁止缓存和反向代理缓冲，保证每个事件立即发送
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,11 +1,15 @@
 from django.urls import path
 from . import views
-# from . import streaming
+from . import streaming
+from . import async_views
 
 urlpatterns = [
     path('', views.ChatMessageView.as_view(), name='chat_message'),
     path('with-files/', views.ChatMessageWithFilesView.as_view(), name='chat_message_with_files'),
+    # 异步版本，需要通过ASGI服务器运行
+    path('async/', async_views.chat_message, name='chat_message_async'),
+    path('with-files/async/', async_views.chat_message_with_files, name='chat_message_with_files_async'),
     path('history/', views.ChatHistoryListView.as_view(), name='chat_history_list'),
     path('history/<int:pk>/', views.ChatHistoryDetailView.as_view(), name='chat_history_detail'),
-    # path('stream/', streaming.stream_chat, name='stream_chat'),
+    path('stream/', streaming.stream_chat, name='stream_chat'),
 ]
\ No newline at end of file
@@ -1,24 +1,180 @@
 from django.conf import settings
 import requests
 import json
-from openai import OpenAI
+import hashlib
+import threading
+import time
+import httpx
+from uuid import uuid4
+from asgiref.sync import sync_to_async
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from core.utils import get_loop_bound_client
 import re
+import weakref
+from functools import cached_property
 
-def get_llm_service(model_name):
-    """获取LLM服务实例"""
-    # 先从数据库查询
-    from model_manager.models import LLMModel
-    try:
-        model = LLMModel.objects.get(name=model_name, is_active=True)
-        return LLMService(
-            model_name=model.name,
-            api_key=model.api_key,
-            base_url=model.base_url,
-            provider=model.provider
-        )
-    except LLMModel.DoesNotExist:
-        print(f"错误: 模型 {model_name} 不存在或未激活")
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 共享缓存中的模型配置版本标记，任一进程修改模型后更新
+MODEL_VERSION_KEY = 'llm:models:version'
+
+def get_llm_client_config():
+    """读取 RAG_CONFIGS['llm_clients']"""
+    client_config = getattr(settings, 'RAG_CONFIGS', {}).get('llm_clients', {})
+    return {
+        'http2': bool(client_config.get('http2', True)),
+        'max_connections': int(client_config.get('max_connections', 100)),
+        'max_keepalive_connections': int(client_config.get('max_keepalive_connections', 20)),
+        'keepalive_expiry': float(client_config.get('keepalive_expiry', 60)),
+        'cache_alias': client_config.get('cache_alias', 'shared'),
+        'check_interval': float(client_config.get('check_interval', 5)),
+    }
+
+def get_http_client_options():
+    """LLM客户端的连接池参数，HTTP/2 需要安装 h2"""
+    config = get_llm_client_config()
+    return {
+        'http2': config['http2'] and HTTP2_AVAILABLE,
+        'limits': httpx.Limits(
+            max_connections=config['max_connections'],
+            max_keepalive_connections=config['max_keepalive_connections'],
+            keepalive_expiry=config['keepalive_expiry'],
+        ),
+    }
+
+def get_model_fingerprint(model):
+    """模型配置指纹，名称、提供商、地址或密钥变化后需要重新创建客户端"""
+    raw = json.dumps([model.name, model.provider, model.base_url, model.api_key])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def _get_shared_cache():
+    from django.core.cache import caches
+    return caches[get_llm_client_config()['cache_alias']]
+
+class LLMServiceCache:
+    """
+    进程内LLM服务缓存。
+    按模型名称缓存 LLMService 及其配置指纹，同一模型的请求复用客户端和已建立的HTTP长连接，
+    不需要每条消息都查询数据库、重新握手。
+    LLMModel 变化时由 model_manager.signals 调用 invalidate：缓存标记为待校验，
+    下次使用时重新读取模型配置，指纹未变的服务（及其连接）继续使用。
+    其他进程通过共享缓存中的版本标记得知变化。
+    """
+    def __init__(self):
+        self._entries = {}
+        self._default_model = None
+        self._lock = threading.Lock()
+        self.version = 0
+        self._shared_version = None
+        self._last_check = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def _check_shared_version(self):
+        """按 check_interval 检查共享缓存中的版本标记，其他进程修改过模型时本进程的缓存需要重新校验"""
+        config = get_llm_client_config()
+        now = time.monotonic()
+        if now - self._last_check < config['check_interval']:
+            return
+        self._last_check = now
+        try:
+            shared_version = _get_shared_cache().get(MODEL_VERSION_KEY)
+        except Exception as e:
+            print(f"读取模型版本标记出错: {e}")
+            return
+        with self._lock:
+            if shared_version != self._shared_version:
+                self._shared_version = shared_version
+                self.version += 1
+
+    def get_cached(self, model_name):
+        """只从缓存中获取，缓存未命中或需要重新校验时返回 None"""
+        self._check_shared_version()
+        with self._lock:
+            entry = self._entries.get(model_name)
+            if entry and entry['version'] == self.version:
+                self.hits += 1
+                return entry['service']
         return None
+
+    def get(self, model_name):
+        """获取模型服务，未缓存或需要重新校验时查询数据库"""
+        service = self.get_cached(model_name)
+        if service is not None:
+            return service
+
+        from model_manager.models import LLMModel
+        with self._lock:
+            version = self.version
+        try:
+            model = LLMModel.objects.get(name=model_name, is_active=True)
+        except LLMModel.DoesNotExist:
+            print(f"错误: 模型 {model_name} 不存在或未激活")
+            with self._lock:
+                self._entries.pop(model_name, None)
+            return None
+
+        fingerprint = get_model_fingerprint(model)
+        with self._lock:
+            self.misses += 1
+            entry = self._entries.get(model_name)
+            if entry and entry['fingerprint'] == fingerprint:
+                # 配置没有变化，继续使用已建立的连接
+                service = entry['service']
+                service.context_length = model.context_length
+            else:
+                service = LLMService(
+                    model_name=model.name,
+                    api_key=model.api_key,
+                    base_url=model.base_url,
+                    provider=model.provider,
+                    context_length=model.context_length
+                )
+            # 记录查询前的版本，查询期间发生的修改会在下次使用时重新校验
+            self._entries[model_name] = {'fingerprint': fingerprint, 'service': service, 'version': version}
+        return service
+
+    def get_cached_default_model(self):
+        """只从缓存中获取默认模型名称，返回 (是否命中, 名称)"""
+        self._check_shared_version()
+        with self._lock:
+            if self._default_model and self._default_model[0] == self.version:
+                return True, self._default_model[1]
+        return False, None
+
+    def get_default_model(self):
+        """获取默认激活的模型名称"""
+        found, model_name = self.get_cached_default_model()
+        if found:
+            return model_name
+
+        from model_manager.models import LLMModel
+        with self._lock:
+            version = self.version
+        model = LLMModel.objects.filter(is_active=True).first()
+        model_name = model.name if model else None
+        with self._lock:
+            self._default_model = (version, model_name)
+        return model_name
+
+    def invalidate(self):
+        """模型配置变化：本进程的缓存立即需要重新校验，并更新共享版本标记通知其他进程"""
+        with self._lock:
+            self.version += 1
+        try:
+            _get_shared_cache().set(MODEL_VERSION_KEY, uuid4().hex, timeout=None)
+        except Exception as e:
+            print(f"更新模型版本标记出错: {e}")
+
+llm_service_cache = LLMServiceCache()
+
+def get_llm_service(model_name):
+    """获取LLM服务实例（复用缓存中的实例）"""
+    return llm_service_cache.get(model_name)
     
     # 从设置文件获取配置-硬编码时
     # llm_configs = getattr(settings, 'LLM_CONFIGS', {})
@@ -33,21 +189,53 @@ def get_llm_service(model_name):
     
     # return None
 
+async def aget_llm_service(model_name):
+    """get_llm_service 的异步版本，缓存命中时不访问数据库"""
+    service = llm_service_cache.get_cached(model_name)
+    if service is not None:
+        return service
+    return await sync_to_async(get_llm_service)(model_name)
+
+def get_default_model_name():
+    """获取默认激活的模型名称（有缓存，模型变化后自动刷新）"""
+    return llm_service_cache.get_default_model()
+
+async def aget_default_model_name():
+    """get_default_model_name 的异步版本"""
+    found, model_name = llm_service_cache.get_cached_default_model()
+    if found:
+        return model_name
+    return await sync_to_async(get_default_model_name)()
+
+def invalidate_llm_services():
+    """清除LLM服务缓存，模型配置变化后调用"""
+    llm_service_cache.invalidate()
+
+# 异步客户端按事件循环和接口地址共享，避免每个请求重新创建连接池
+_async_clients = weakref.WeakKeyDictionary()
+
 class LLMService:
     """LLM服务"""
-    def __init__(self, model_name, api_key, base_url, provider='openai'):
+    def __init__(self, model_name, api_key, base_url, provider='openai', context_length=4096):
         self.model_name = model_name
         self.api_key = api_key
         self.base_url = base_url
         self.provider = provider
-        self.client = self._init_client()
+        self.context_length = context_length
+    
+    @cached_property
+    def client(self):
+        """同步客户端，首次使用时创建（异步视图不需要）"""
+        return self._init_client()
     
     def _init_client(self):
         """初始化客户端"""
         try:
             # 对于OpenAI、Ollama和SiliconFlow，都使用OpenAI客户端
             if self.provider in ['openai', 'ollama', 'siliconflow']:
-                return OpenAI(api_key=self.api_key, base_url=self.base_url, timeout=180.0)  # 增加超时时间到180秒
+                # 服务实例被缓存复用，客户端使用带长连接的连接池
+                return OpenAI(api_key=self.api_key, base_url=self.base_url, timeout=180.0,  # 增加超时时间到180秒
+                              http_client=DefaultHttpxClient(**get_http_client_options()))
             return None
         except Exception as e:
             print(f"初始化LLM客户端出错: {e}")
@@ -55,6 +243,60 @@ class LLMService:
             traceback.print_exc()
             return None
     
+    def _get_async_client(self):
+        """当前事件循环中的异步客户端，供异步视图使用"""
+        if self.provider not in ['openai', 'ollama', 'siliconflow']:
+            return None
+        return get_loop_bound_client(
+            _async_clients, (self.api_key, self.base_url),
+            lambda: AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, timeout=180.0,
+                                http_client=DefaultAsyncHttpxClient(**get_http_client_options()))
+        )
+
+    def _is_local_model(self):
+        """是否是本地模型（Ollama或特定模型），这类模型的思考过程在<think>标签中"""
+        return self.provider == 'ollama' or 'deepseek-r1' in self.model_name or 'glm' in self.model_name
+
+    def _build_result(self, response):
+        """把非流式响应转换为字典，本地模型的思考过程放在 thinking_process 中"""
+        if self._is_local_model():
+            # 处理本地模型的完整输出
+            # 检查输出中是否有思考过程标签
+            content = response.choices[0].message.content
+            think_content, answer_content = self._extract_thinking(content)
+            
+            # 将思考过程添加到响应中
+            result = response.model_dump()
+            if think_content:
+                result['thinking_process'] = think_content
+                result['choices'][0]['message']['content'] = answer_content
+            
+            return result
+        else:
+            # 普通模型响应
+            return response.model_dump()
+
+    async def agenerate(self, messages, temperature=0.1):
+        """异步生成回复（非流式），等待模型响应期间不占用线程"""
+        client = self._get_async_client()
+        if not client:
+            raise Exception(f"未初始化 {self.provider} 客户端")
+        
+        try:
+            response = await client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=temperature,
+                stream=False,
+                timeout=180
+            )
+            return self._build_result(response)
+        except Exception as e:
+            print(f"调用模型API错误: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            raise
+
     def generate(self, messages, temperature=0.1, stream=False):
         """生成回复"""
         if not self.client:
@@ -66,7 +308,7 @@ class LLMService:
             # print(f"API密钥前缀: {self.api_key[:4]}***")
             
             # 检查是否是本地模型（Ollama或特定模型）
-            is_local_model = self.provider == 'ollama' or 'deepseek-r1' in self.model_name or 'glm' in self.model_name
+            is_local_model = self._is_local_model()
             
             # 构建响应
             if stream:
@@ -95,22 +337,7 @@ class LLMService:
                     timeout=180  # 增加超时时间
                 )
                 
-                if is_local_model:
-                    # 处理本地模型的完整输出
-                    # 检查输出中是否有思考过程标签
-                    content = response.choices[0].message.content
-                    think_content, answer_content = self._extract_thinking(content)
-                    
-                    # 将思考过程添加到响应中
-                    result = response.model_dump()
-                    if think_content:
-                        result['thinking_process'] = think_content
-                        result['choices'][0]['message']['content'] = answer_content
-                    
-                    return result
-                else:
-                    # 普通模型响应
-                    return response.model_dump()
+                return self._build_result(response)
         except Exception as e:
             print(f"调用模型API错误: {str(e)}")
             # 获取更详细的错误信息
@@ -140,82 +367,86 @@ class LLMService:
             answer_buffer = []
             in_thinking = False
             
-            for chunk in stream_response:
-                delta = chunk.choices[0].delta.content or ""
+            # 生成器被提前关闭（客户端断开）时同时关闭底层的流式响应，模型不再继续生成
+            try:
+                for chunk in stream_response:
+                    delta = chunk.choices[0].delta.content or ""
                 
-                if "<think>" in delta:
-                    in_thinking = True
-                    # 将<think>前的部分加入答案
-                    pre_think = delta.split("<think>")[0]
-                    if pre_think:
-                        answer_buffer.append(pre_think)
-                    # 将<think>后的部分加入思考
-                    post_think = delta.split("<think>")[-1]
-                    thinking_buffer.append(post_think)
+                    if "<think>" in delta:
+                        in_thinking = True
+                        # 将<think>前的部分加入答案
+                        pre_think = delta.split("<think>")[0]
+                        if pre_think:
+                            answer_buffer.append(pre_think)
+                        # 将<think>后的部分加入思考
+                        post_think = delta.split("<think>")[-1]
+                        thinking_buffer.append(post_think)
                     
-                    # 构建包含thinking字段的特殊块
-                    yield {
-                        "choices": [{
-                            "delta": {"content": pre_think, "role": "assistant"},
-                            "index": 0,
-                            "thinking": True,
-                            "thinking_content": post_think
-                        }],
-                        "object": "chat.completion.chunk"
-                    }
-                elif "</think>" in delta:
-                    in_thinking = False
-                    # 将</think>前的部分加入思考
-                    pre_end = delta.split("</think>")[0]
-                    thinking_buffer.append(pre_end)
-                    # 将</think>后的部分加入答案
-                    post_end = delta.split("</think>")[-1]
-                    answer_buffer.append(post_end)
+                        # 构建包含thinking字段的特殊块
+                        yield {
+                            "choices": [{
+                                "delta": {"content": pre_think, "role": "assistant"},
+                                "index": 0,
+                                "thinking": True,
+                                "thinking_content": post_think
+                            }],
+                            "object": "chat.completion.chunk"
+                        }
+                    elif "</think>" in delta:
+                        in_thinking = False
+                        # 将</think>前的部分加入思考
+                        pre_end = delta.split("</think>")[0]
+                        thinking_buffer.append(pre_end)
+                        # 将</think>后的部分加入答案
+                        post_end = delta.split("</think>")[-1]
+                        answer_buffer.append(post_end)
                     
-                    # 构建thinking结束和answer开始的特殊块
-                    yield {
-                        "choices": [{
-                            "delta": {"content": post_end, "role": "assistant"},
-                            "index": 0,
-                            "thinking": False,
-                            "thinking_end": True,
-                            "thinking_content": "".join(thinking_buffer)
-                        }],
-                        "object": "chat.completion.chunk"
-                    }
-                elif in_thinking:
-                    thinking_buffer.append(delta)
-                    # 构建thinking内容块
-                    yield {
-                        "choices": [{
-                            "delta": {"content": "", "role": "assistant"},
-                            "index": 0,
-                            "thinking": True,
-                            "thinking_content": delta
-                        }],
-                        "object": "chat.completion.chunk"
-                    }
-                else:
-                    answer_buffer.append(delta)
-                    # 构建普通内容块
-                    yield {
-                        "choices": [{
-                            "delta": {"content": delta, "role": "assistant"},
-                            "index": 0
-                        }],
-                        "object": "chat.completion.chunk"
-                    }
+                        # 构建thinking结束和answer开始的特殊块
+                        yield {
+                            "choices": [{
+                                "delta": {"content": post_end, "role": "assistant"},
+                                "index": 0,
+                                "thinking": False,
+                                "thinking_end": True,
+                                "thinking_content": "".join(thinking_buffer)
+                            }],
+                            "object": "chat.completion.chunk"
+                        }
+                    elif in_thinking:
+                        thinking_buffer.append(delta)
+                        # 构建thinking内容块
+                        yield {
+                            "choices": [{
+                                "delta": {"content": "", "role": "assistant"},
+                                "index": 0,
+                                "thinking": True,
+                                "thinking_content": delta
+                            }],
+                            "object": "chat.completion.chunk"
+                        }
+                    else:
+                        answer_buffer.append(delta)
+                        # 构建普通内容块
+                        yield {
+                            "choices": [{
+                                "delta": {"content": delta, "role": "assistant"},
+                                "index": 0
+                            }],
+                            "object": "chat.completion.chunk"
+                        }
             
-            # 返回完整的思考过程和答案
-            yield {
-                "choices": [{
-                    "delta": {"content": None, "role": None},
-                    "index": 0,
-                    "finish_reason": "stop",
-                    "final_thinking": "".join(thinking_buffer),
-                    "final_answer": "".join(answer_buffer)
-                }],
-                "object": "chat.completion.chunk"
-            }
+                # 返回完整的思考过程和答案
+                yield {
+                    "choices": [{
+                        "delta": {"content": None, "role": None},
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "final_thinking": "".join(thinking_buffer),
+                        "final_answer": "".join(answer_buffer)
+                    }],
+                    "object": "chat.completion.chunk"
+                }
+            finally:
+                stream_response.close()
         
         return stream_processor()
\ No newline at end of file
@@ -0,0 +1,51 @@
+# core/llm/tokenizer.py
+"""
+对话消息的token计数。
+编码器只加载一次；相同文本（系统提示词、历史消息）的计数结果有缓存，
+每轮对话只需要对新消息编码。
+"""
+from functools import lru_cache
+from django.conf import settings
+
+# 每条消息的格式开销（角色、分隔符）和回复的起始开销，按OpenAI的计算方式估计
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+def get_encoding_name():
+    return getattr(settings, 'RAG_CONFIGS', {}).get('chat_history', {}).get('encoding', 'cl100k_base')
+
+@lru_cache(maxsize=4)
+def get_encoding(encoding_name):
+    """加载tiktoken编码器，没有安装tiktoken或无法下载编码文件时返回 None（使用估算）"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        print(f"加载tiktoken编码器 {encoding_name} 失败，使用估算的token数: {e}")
+        return None
+
+def estimate_tokens(text):
+    """没有编码器时的估算：非ASCII字符（如中文）每个约1个token，ASCII字符约4个为1个token"""
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return non_ascii + -(-(len(text) - non_ascii) // 4)
+
+@lru_cache(maxsize=4096)
+def _count_tokens(text, encoding_name):
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_tokens(text):
+    """文本的token数"""
+    if not text:
+        return 0
+    return _count_tokens(text, get_encoding_name())
+
+def count_message_tokens(message):
+    """一条 {'role', 'content'} 消息的token数（含格式开销）"""
+    return TOKENS_PER_MESSAGE + count_tokens(message.get('content') or '')
+
+def count_messages_tokens(messages):
+    """整个消息列表的token数"""
+    return sum(count_message_tokens(message) for message in messages) + TOKENS_PER_REPLY
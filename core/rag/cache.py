@@ -0,0 +1,129 @@
+# core/rag/cache.py
+from django.conf import settings
+import re
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional
+from langchain_core.documents import Document
+
+def normalize_query(query: str) -> str:
+    """规范化查询文本：全角转半角、去除首尾空白、合并连续空白、英文转小写"""
+    query = unicodedata.normalize('NFKC', query or '')
+    query = re.sub(r'\s+', ' ', query).strip()
+    return query.lower()
+
+class LocalCacheBackend:
+    """进程内LRU+TTL缓存，读写和淘汰均为O(1)"""
+    def __init__(self, max_entries=1000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class DjangoCacheBackend:
+    """基于Django缓存框架的后端，配置共享缓存（文件、数据库、Redis等）后可在多个工作进程间共享"""
+    def __init__(self, alias='default', ttl=3600):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, timeout=self.ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+class RetrievalCache:
+    """
+    检索结果缓存。
+    键由规范化后的查询、索引名称及版本、检索参数组成，索引重建后旧结果自然失效。
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, index_name: str, index_version, query: str, **params) -> str:
+        """生成缓存键"""
+        param_str = ",".join(f"{k}={params[k]}" for k in sorted(params))
+        combined = f"{index_name}|{index_version}|{normalize_query(query)}|{param_str}"
+        return "rag:retrieval:" + hashlib.sha256(combined.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[List[Document]]:
+        """读取缓存，返回文档副本（调用方可能修改元数据）"""
+        entries = self.backend.get(key)
+        if entries is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [Document(page_content=content, metadata=dict(metadata)) for content, metadata in entries]
+
+    def set(self, key: str, docs: List[Document]):
+        """写入缓存，只保存文本和元数据"""
+        entries = [(doc.page_content, dict(doc.metadata)) for doc in docs]
+        self.backend.set(key, entries)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+_retrieval_cache = None
+_retrieval_cache_lock = threading.Lock()
+
+def get_retrieval_cache() -> RetrievalCache:
+    """根据 RAG_CONFIGS['retrieval_cache'] 获取全局检索缓存"""
+    global _retrieval_cache
+    if _retrieval_cache is None:
+        with _retrieval_cache_lock:
+            if _retrieval_cache is None:
+                cache_config = getattr(settings, 'RAG_CONFIGS', {}).get('retrieval_cache', {})
+                ttl = cache_config.get('ttl', 3600)
+                if cache_config.get('backend', 'local') == 'django':
+                    backend = DjangoCacheBackend(alias=cache_config.get('cache_alias', 'default'), ttl=ttl)
+                else:
+                    backend = LocalCacheBackend(max_entries=cache_config.get('max_entries', 1000), ttl=ttl)
+                _retrieval_cache = RetrievalCache(backend)
+    return _retrieval_cache
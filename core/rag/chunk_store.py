@@ -0,0 +1,331 @@
+# core/rag/chunk_store.py
+import os
+import json
+import mmap
+import shutil
+from collections.abc import Mapping
+from typing import Iterable, Iterator, List, Optional
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+
+CHUNK_STORE_VERSION = 2
+
+# 按列存储的元数据字段
+# 字符串列使用字典编码：codes为int32（-1表示缺失），values为去重后的取值列表
+CATEGORY_COLUMNS = ['law_name', 'content_type', 'parent_id', 'source']
+# 整数列：int32数组，INT_NULL表示缺失
+INT_COLUMNS = ['article_num', 'chapter_num', 'document_id']
+INT_NULL = np.iinfo(np.int32).min
+
+def get_chunk_store_path(db_vector_path: str, index_name: str) -> str:
+    """文本块存储目录，与 .faiss 文件放在一起"""
+    return os.path.join(db_vector_path, f"{index_name}.chunks")
+
+def iter_vectorstore_documents(vectorstore) -> Iterator[Document]:
+    """按FAISS内部位置顺序遍历向量库中的文档"""
+    for i in range(vectorstore.index.ntotal):
+        yield vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+
+def _write_blob(path: str, items: Iterable[bytes]) -> np.ndarray:
+    """依次写入二进制片段，返回长度为 n+1 的偏移数组"""
+    offsets = [0]
+    with open(path, 'wb') as f:
+        for data in items:
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    return np.asarray(offsets, dtype=np.int64)
+
+def _is_int_value(value) -> bool:
+    return isinstance(value, (int, np.integer)) and not isinstance(value, bool) \
+        and INT_NULL < value <= np.iinfo(np.int32).max
+
+def write_chunk_store(path: str, documents: Iterable[Document]) -> int:
+    """
+    写入列式文本块存储：
+      text.bin / text_offsets.npy            所有文本拼接成的UTF-8数据及偏移
+      {列名}.codes.npy / {列名}.values.json   字典编码的字符串元数据列
+      {列名}.npy                             整数元数据列
+      extra.bin / extra_offsets.npy           其余元数据（JSON，无其余字段时为空）
+    第i个文本块对应FAISS索引中的第i个向量。先写入临时目录再替换，读取方不会看到写了一半的数据。
+    """
+    documents = list(documents)
+    count = len(documents)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    text_offsets = _write_blob(
+        os.path.join(tmp_path, 'text.bin'),
+        (doc.page_content.encode('utf-8') for doc in documents)
+    )
+    np.save(os.path.join(tmp_path, 'text_offsets.npy'), text_offsets)
+
+    extras = [dict(doc.metadata) for doc in documents]
+
+    for column in CATEGORY_COLUMNS:
+        codes = np.full(count, -1, dtype=np.int32)
+        values = {}
+        for i, metadata in enumerate(extras):
+            value = metadata.get(column)
+            if isinstance(value, str):
+                codes[i] = values.setdefault(value, len(values))
+                del metadata[column]
+        np.save(os.path.join(tmp_path, f'{column}.codes.npy'), codes)
+        with open(os.path.join(tmp_path, f'{column}.values.json'), 'w', encoding='utf-8') as f:
+            json.dump(list(values), f, ensure_ascii=False)
+
+    for column in INT_COLUMNS:
+        data = np.full(count, INT_NULL, dtype=np.int32)
+        for i, metadata in enumerate(extras):
+            value = metadata.get(column)
+            if _is_int_value(value):
+                data[i] = value
+                del metadata[column]
+        np.save(os.path.join(tmp_path, f'{column}.npy'), data)
+
+    extra_offsets = _write_blob(
+        os.path.join(tmp_path, 'extra.bin'),
+        (json.dumps(metadata, ensure_ascii=False, default=str).encode('utf-8') if metadata else b''
+         for metadata in extras)
+    )
+    np.save(os.path.join(tmp_path, 'extra_offsets.npy'), extra_offsets)
+
+    with open(os.path.join(tmp_path, 'info.json'), 'w', encoding='utf-8') as f:
+        json.dump({'version': CHUNK_STORE_VERSION, 'count': count}, f)
+
+    # 目录不能原子覆盖，先移走旧目录再替换
+    old_path = path + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return count
+
+def _mmap_file(path: str):
+    """只读映射文件，空文件返回空bytes（mmap不支持长度为0的文件）"""
+    if os.path.getsize(path) == 0:
+        return b''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class ChunkStore:
+    """
+    只读的列式文本块存储。
+    数据通过mmap访问，多个工作进程加载同一知识库时共享操作系统页缓存，
+    只有被检索命中的文本块才会解码成Document。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'info.json'), encoding='utf-8') as f:
+            self.info = json.load(f)
+        self.text = _mmap_file(os.path.join(path, 'text.bin'))
+        self.text_offsets = np.load(os.path.join(path, 'text_offsets.npy'), mmap_mode='r')
+        self.extra = _mmap_file(os.path.join(path, 'extra.bin'))
+        self.extra_offsets = np.load(os.path.join(path, 'extra_offsets.npy'), mmap_mode='r')
+
+        self.category_codes = {}
+        self.category_values = {}
+        for column in CATEGORY_COLUMNS:
+            self.category_codes[column] = np.load(os.path.join(path, f'{column}.codes.npy'), mmap_mode='r')
+            with open(os.path.join(path, f'{column}.values.json'), encoding='utf-8') as f:
+                self.category_values[column] = json.load(f)
+        self.int_columns = {}
+        for column in INT_COLUMNS:
+            column_path = os.path.join(path, f'{column}.npy')
+            if os.path.exists(column_path):
+                self.int_columns[column] = np.load(column_path, mmap_mode='r')
+            else:
+                # 较早写入的存储没有该列
+                self.int_columns[column] = np.full(len(self.text_offsets) - 1, INT_NULL, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.text_offsets) - 1
+
+    def get_text(self, i: int) -> str:
+        start, end = int(self.text_offsets[i]), int(self.text_offsets[i + 1])
+        return self.text[start:end].decode('utf-8')
+
+    def get_metadata(self, i: int) -> dict:
+        start, end = int(self.extra_offsets[i]), int(self.extra_offsets[i + 1])
+        metadata = json.loads(self.extra[start:end].decode('utf-8')) if end > start else {}
+        for column in CATEGORY_COLUMNS:
+            code = int(self.category_codes[column][i])
+            if code >= 0:
+                metadata[column] = self.category_values[column][code]
+        for column in INT_COLUMNS:
+            value = int(self.int_columns[column][i])
+            if value != INT_NULL:
+                metadata[column] = value
+        return metadata
+
+    def get(self, i: int) -> Document:
+        return Document(page_content=self.get_text(i), metadata=self.get_metadata(i))
+
+    def get_column(self, column: str):
+        """
+        读取整列元数据，用于批量过滤：
+          字符串列返回 (codes, values)
+          整数列返回数组（缺失值为 INT_NULL）
+        """
+        if column in self.category_codes:
+            return self.category_codes[column], self.category_values[column]
+        if column in self.int_columns:
+            return self.int_columns[column]
+        raise KeyError(column)
+
+    def find_document_rows(self, document_id: int, source: Optional[str] = None) -> np.ndarray:
+        """
+        返回属于某个上传文档的文本块位置。
+        旧索引的文本块没有 document_id，此时按来源文件名匹配。
+        """
+        document_ids = np.asarray(self.int_columns['document_id'])
+        mask = document_ids == document_id
+        if source:
+            codes, values = self.get_column('source')
+            if source in values:
+                mask |= (document_ids == INT_NULL) & (np.asarray(codes) == values.index(source))
+        return np.flatnonzero(mask)
+
+    def nbytes(self) -> int:
+        """存储文件的总大小（字节）"""
+        return sum(
+            os.path.getsize(os.path.join(self.path, name))
+            for name in os.listdir(self.path)
+        )
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        """存储存在且为当前版本"""
+        try:
+            with open(os.path.join(path, 'info.json'), encoding='utf-8') as f:
+                return json.load(f).get('version') == CHUNK_STORE_VERSION
+        except (OSError, ValueError):
+            return False
+
+class ChunkStoreDocstore(Docstore):
+    """把ChunkStore包装成langchain的Docstore，文档id为其在索引中的位置"""
+    def __init__(self, store: ChunkStore):
+        self.store = store
+
+    def search(self, search: str):
+        try:
+            i = int(search)
+        except (TypeError, ValueError):
+            return f"ID {search} not found."
+        if not 0 <= i < len(self.store):
+            return f"ID {search} not found."
+        return self.store.get(i)
+
+    def delete(self, ids: List) -> None:
+        raise NotImplementedError("只读文本块存储不支持删除")
+
+class IdentityIndexMapping(Mapping):
+    """FAISS位置到文档id的恒等映射，避免为每个向量创建字典项"""
+    def __init__(self, size: int):
+        self.size = size
+
+    def __getitem__(self, i):
+        i = int(i)
+        if not 0 <= i < self.size:
+            raise KeyError(i)
+        return str(i)
+
+    def __iter__(self):
+        return iter(range(self.size))
+
+    def __len__(self):
+        return self.size
+
+def load_readonly_vectorstore(db_vector_path: str, index_name: str, embeddings) -> Optional[object]:
+    """
+    以只读方式加载向量库：FAISS索引通过mmap读取，文档来自文本块存储。
+    文本块存储不存在或与索引不一致时返回None，由调用方回退到 load_vectorstore。
+    """
+    from langchain_community.vectorstores import FAISS
+    from core.rag.faiss_index import read_index_mmap
+
+    store_path = get_chunk_store_path(db_vector_path, index_name)
+    if not ChunkStore.exists(store_path):
+        return None
+
+    store = ChunkStore(store_path)
+    index = read_index_mmap(os.path.join(db_vector_path, f"{index_name}.faiss"))
+    if index.ntotal != len(store):
+        print(f"文本块存储与索引数量不一致 ({len(store)} != {index.ntotal})，使用常规方式加载")
+        return None
+
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=ChunkStoreDocstore(store),
+        index_to_docstore_id=IdentityIndexMapping(len(store)),
+    )
+
+def save_index(index, documents: Iterable[Document], db_vector_path: str, index_name: str):
+    """
+    保存索引和文本块存储，不再生成 .pkl。
+    索引先写入临时文件再替换，旧的 .pkl 会被删除，避免与新索引不一致。
+    """
+    import faiss
+    os.makedirs(db_vector_path, exist_ok=True)
+    index_path = os.path.join(db_vector_path, f"{index_name}.faiss")
+    tmp_index_path = index_path + '.tmp'
+    faiss.write_index(index, tmp_index_path)
+    os.replace(tmp_index_path, index_path)
+    write_chunk_store(get_chunk_store_path(db_vector_path, index_name), documents)
+
+    pkl_path = os.path.join(db_vector_path, f"{index_name}.pkl")
+    if os.path.exists(pkl_path):
+        os.remove(pkl_path)
+
+def save_vectorstore(vectorstore, db_vector_path: str, index_name: str):
+    """保存向量库：写入 .faiss 索引和列式文本块存储"""
+    save_index(vectorstore.index, iter_vectorstore_documents(vectorstore), db_vector_path, index_name)
+
+def migrate_pickle_store(db_vector_path: str, index_name: str, embeddings):
+    """
+    把旧格式（.pkl）的文档存储转换为列式文本块存储，返回加载好的向量库。
+    转换后保留 .pkl，直到下一次保存索引时删除。
+    """
+    from langchain_community.vectorstores import FAISS
+    vectorstore = FAISS.load_local(
+        folder_path=db_vector_path,
+        embeddings=embeddings,
+        index_name=index_name,
+        allow_dangerous_deserialization=True
+    )
+    try:
+        count = write_chunk_store(
+            get_chunk_store_path(db_vector_path, index_name),
+            iter_vectorstore_documents(vectorstore)
+        )
+        print(f"已将 {index_name}.pkl 转换为文本块存储，共 {count} 个文本块")
+    except Exception as e:
+        print(f"转换文本块存储失败: {e}")
+    return vectorstore
+
+def load_vectorstore(db_vector_path: str, index_name: str, embeddings):
+    """
+    加载可写的向量库（用于追加文档）。
+    优先从文本块存储构建内存docstore，旧索引从 .pkl 加载并顺便转换。
+    """
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    import faiss
+
+    store_path = get_chunk_store_path(db_vector_path, index_name)
+    if ChunkStore.exists(store_path):
+        store = ChunkStore(store_path)
+        index = faiss.read_index(os.path.join(db_vector_path, f"{index_name}.faiss"))
+        if index.ntotal == len(store):
+            return FAISS(
+                embedding_function=embeddings,
+                index=index,
+                docstore=InMemoryDocstore({str(i): store.get(i) for i in range(len(store))}),
+                index_to_docstore_id={i: str(i) for i in range(len(store))},
+            )
+        print(f"文本块存储与索引数量不一致 ({len(store)} != {index.ntotal})")
+
+    return migrate_pickle_store(db_vector_path, index_name, embeddings)
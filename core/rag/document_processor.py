@@ -1,13 +1,25 @@
 from django.conf import settings
 import os
 import re
-import hashlib
+import faiss
+import numpy as np
 import pandas as pd
 import json
 import uuid
 import asyncio
 import threading
 import time
+import queue
+import itertools
+import multiprocessing
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from langchain_community.document_loaders import (
     PyPDFLoader,
     Docx2txtLoader,
@@ -22,9 +34,20 @@ from langchain_community.document_loaders import (
     UnstructuredPowerPointLoader,
 )
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from core.utils import read_json_file, save_json_file, print_colorful, Fore
+from core.utils import read_json_file, print_colorful, get_hash_of_file, Fore
 from core.rag.embedding import get_embeddings
+from core.rag.faiss_index import (
+    INDEX_FLAT, GroundTruthTracker, build_recall_report,
+    create_index, get_index_type, get_train_size, remove_rows, save_recall_report,
+)
+from core.rag.chunk_store import (
+    ChunkStore, get_chunk_store_path, load_vectorstore, migrate_pickle_store, save_index, save_vectorstore,
+)
+from core.rag.lexical_index import build_lexical_index
+from core.rag.services import invalidate_rag_service
+from core.rag.task_progress import get_task_group, is_task_cancelled, set_task_progress
 from core.rag.text_splitters import ChineseRecursiveTextSplitter, split_by_chapter_section_article
 from langchain_core.document_loaders.base import BaseLoader
 from langchain_core.documents import Document
@@ -91,6 +114,52 @@ def get_file_loader(file_path):
     
     raise ValueError(f"不支持的文件类型: {ext}")
 
+# 估计进度时每个字符平均占用的文件字节数（压缩格式和带标记的格式取较大值）
+BYTES_PER_CHAR = {
+    '.txt': 2,
+    '.md': 2,
+    '.csv': 2,
+    '.html': 6,
+    '.eml': 3,
+    '.enex': 4,
+    '.docx': 8,
+    '.doc': 8,
+    '.odt': 8,
+    '.epub': 8,
+    '.ppt': 20,
+    '.pptx': 20,
+    '.xlsx': 4,
+    '.xls': 4,
+}
+# PDF每页的平均字符数
+PDF_CHARS_PER_PAGE = 800
+
+def get_pdf_page_count(file_path):
+    """只读取PDF的页面树获取页数，不提取文本"""
+    from pypdf import PdfReader
+    return len(PdfReader(file_path).pages)
+
+def estimate_file_chunks(file_path, chunk_size=512):
+    """
+    用廉价信号估计文件会切分出的块数，仅用于显示进度。
+    PDF使用页数，其他格式使用文件大小，实际块数在切分后修正。
+    """
+    chunk_size = max(chunk_size or 512, 1)
+    ext = os.path.splitext(file_path)[1].lower()
+    try:
+        if ext == '.pdf':
+            try:
+                num_chars = get_pdf_page_count(file_path) * PDF_CHARS_PER_PAGE
+            except Exception as e:
+                print_colorful(f"读取PDF页数失败，按文件大小估计: {str(e)}", text_color=Fore.YELLOW)
+                num_chars = os.path.getsize(file_path) // 20
+        else:
+            num_chars = os.path.getsize(file_path) // BYTES_PER_CHAR.get(ext, 2)
+    except OSError as e:
+        print_colorful(f"估计总块数时出错: {str(e)}", text_color=Fore.RED)
+        return 1
+    return max(1, -(-num_chars // chunk_size))
+
 def precise_token_count(text: str, model: str = "text-embedding-ada-002") -> int:
     """
     使用 tiktoken 库计算文本的精确 token 数。
@@ -322,11 +391,12 @@ def ensure_chunk_limit(doc, limit: int = 8192, model: str = "text-embedding-ada-
         # 使用递归分块代替滑动窗口
         return recursive_split_document(doc, limit, overlap)
 
-def build_law_structure(law_docs, law_title, source):
+def build_law_structure(law_docs, law_title, source, document_id=None):
     """构建法律结构数据"""
     structure = {
         "law_name": law_title,
         "source": source,
+        "document_id": document_id,
         "chapters": {},
         "articles": {}
     }
@@ -395,12 +465,6 @@ def process_tabular_file(file_path, merge_rows=2):
    
    return docs
 
-def get_hash_of_file(path):
-   """获取文件的MD5哈希值"""
-   with open(path, "rb") as f:
-       readable_hash = hashlib.md5(f.read()).hexdigest()
-   return readable_hash
-
 def merge_article_blocks(documents):
     """合并相同条款的文档块"""
     from collections import defaultdict
@@ -421,11 +485,11 @@ def merge_article_blocks(documents):
     return merged_docs
 
 def update_progress(task_id, kb_name, status, message, progress, total):
-    """更新处理进度，并存储在settings中"""
+    """更新处理进度，写入多进程共享的进度存储（同一状态下的频繁更新会被限流）"""
     if task_id is None:
         return
         
-    group_name = f'kb_{kb_name}_{task_id}'
+    group_name = get_task_group(kb_name, task_id)
     
     # 修复进度和总数为0的情况
     if total <= 0:
@@ -452,7 +516,7 @@ def update_progress(task_id, kb_name, status, message, progress, total):
     }
     
     # 存储任务状态
-    settings.PROCESSING_TASKS[group_name] = data
+    set_task_progress(group_name, data)
     
     # 添加简单的日志输出
     # print(f"更新任务状态: {group_name} = {status}, {progress}/{total}, {message}")
@@ -462,28 +526,423 @@ def check_task_cancelled(task_id, kb_name):
     if task_id is None:
         return False
         
-    group_name = f'kb_{kb_name}_{task_id}'
-    task_status = settings.PROCESSING_TASKS.get(group_name, {})
-    return task_status.get('status') == 'cancelled'
+    return is_task_cancelled(get_task_group(kb_name, task_id))
+
+def get_embedding_batch_size(embeddings, default=32):
+    """
+    根据嵌入模型确定每次提交的文本数量。
+    模型内部会按 max_batch_size 切分并以 max_concurrency 并发请求，
+    提交 max_batch_size * max_concurrency 个文本可以让并发请求保持满载。
+    """
+    batch_size = getattr(embeddings, 'max_batch_size', None) or default
+    concurrency = getattr(embeddings, 'max_concurrency', None) or 1
+    return max(1, int(batch_size) * int(concurrency))
+
+def _iter_batches(items, batch_size):
+    """把可迭代对象按固定大小分批"""
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def stream_documents_to_vectorstore(docs, embeddings, vectorstore=None, batch_size=None,
+                                    on_batch=None, should_cancel=None, index_type=INDEX_FLAT,
+                                    index_params=None, on_vectors=None, on_flush=None):
+    """
+    分批嵌入文档并直接追加到同一个FAISS索引和docstore中。
+    新建索引时按 index_type 创建，需要训练的索引（IVF）先收集训练样本，
+    训练完成后再写入缓存的批次；已有索引时直接追加。
+    之后每批调用 add_embeddings，避免为每个小批次创建临时向量库再反复 merge_from。
+
+    参数：
+      vectorstore: 已有的向量库，为None时新建
+      index_type / index_params: 新建索引的类型和参数
+      on_batch: 每批完成后的回调 on_batch(done, total)，docs为迭代器时total为None
+      on_vectors: 向量写入索引前的回调 on_vectors(vectors)，按写入顺序调用
+      on_flush: 每批写入索引后的回调 on_flush(vectorstore, done)，可用于保存检查点
+      should_cancel: 返回True时中止处理
+    返回：
+      向量库；被取消时返回None
+    """
+    if batch_size is None:
+        batch_size = get_embedding_batch_size(embeddings)
+    # docs可以是列表，也可以是切分阶段持续产出文档的迭代器（此时总数未知）
+    total = len(docs) if hasattr(docs, '__len__') else None
+    train_size = get_train_size(index_type, index_params) if vectorstore is None else 0
+    pending = []  # 等待训练的批次 (texts, metadatas, vectors)
+
+    def add_batch(texts, metadatas, vectors):
+        if on_vectors:
+            on_vectors(vectors)
+        vectorstore.add_embeddings(list(zip(texts, vectors.tolist())), metadatas=metadatas)
+
+    def create_vectorstore():
+        train_vectors = np.vstack([item[2] for item in pending])
+        index = create_index(index_type, train_vectors.shape[1], train_vectors, index_params)
+        return FAISS(
+            embedding_function=embeddings,
+            index=index,
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={},
+        )
+
+    done = 0
+    for batch in _iter_batches(docs, batch_size):
+        if should_cancel and should_cancel():
+            return None
+
+        texts = [doc.page_content for doc in batch]
+        metadatas = [doc.metadata for doc in batch]
+        vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+
+        if vectorstore is None:
+            pending.append((texts, metadatas, vectors))
+            if sum(len(item[2]) for item in pending) >= train_size:
+                vectorstore = create_vectorstore()
+                for item in pending:
+                    add_batch(*item)
+                pending = []
+        else:
+            add_batch(texts, metadatas, vectors)
+
+        done += len(batch)
+        if on_batch:
+            on_batch(done, total)
+        if on_flush and vectorstore is not None:
+            on_flush(vectorstore, done)
+
+    # 文档总数不足训练样本数时，使用全部文档训练
+    if pending:
+        vectorstore = create_vectorstore()
+        for item in pending:
+            add_batch(*item)
+
+    return vectorstore
+
+# 同一索引的写操作（追加文档、删除文档）需要串行执行。
+# 追加文档在 process_kb_jobs 进程中执行，删除文档在Web进程中执行，所以除了进程内的锁，
+# 还要对索引旁边的 {index_name}.lock 文件加文件锁
+_index_locks = {}
+_index_locks_lock = threading.Lock()
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    # Windows：LK_LOCK 最多等待约10秒后抛出 OSError，一直重试到获得锁
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+@contextmanager
+def get_index_lock(db_vector_path, index_name):
+    """持有索引的写锁（进程内和跨进程）"""
+    with _index_locks_lock:
+        thread_lock = _index_locks.setdefault(index_name, threading.Lock())
+    with thread_lock:
+        os.makedirs(db_vector_path, exist_ok=True)
+        with open(os.path.join(db_vector_path, f"{index_name}.lock"), 'a+b') as f:
+            f.seek(0)
+            _lock_file(f)
+            try:
+                yield
+            finally:
+                _unlock_file(f)
+
+def save_lexical_index(db_vector_path, index_name):
+    """在保存向量索引和文本块存储之后重建BM25索引，失败时只打印警告（加载知识库时会再次尝试）"""
+    try:
+        count = build_lexical_index(db_vector_path, index_name)
+        if count is not None:
+            print(f"已生成BM25索引: {index_name}，共 {count} 个文本块")
+    except Exception as e:
+        print_colorful(f"生成BM25索引失败: {str(e)}", text_color=Fore.YELLOW)
+
+def remove_law_structures(db_vector_path, document_id):
+    """删除由该文档生成的法律结构文件"""
+    law_structure_dir = os.path.join(db_vector_path, "law_structure")
+    if not os.path.isdir(law_structure_dir):
+        return 0
+    removed = 0
+    for filename in os.listdir(law_structure_dir):
+        if not filename.endswith('.json'):
+            continue
+        path = os.path.join(law_structure_dir, filename)
+        structure = read_json_file(path)
+        if structure.get("document_id") == document_id:
+            os.remove(path)
+            removed += 1
+    return removed
+
+def remove_document_rows(db_vector_path, index_name, documents, match_source=True):
+    """
+    从索引中删除若干文档的全部文本块并写回索引，调用方需持有索引锁。
+    match_source 为 True 时，没有文档ID的旧文本块按文件名匹配。
+    返回删除的文本块数量。
+    """
+    index_path = os.path.join(db_vector_path, f"{index_name}.faiss")
+    if not documents or not os.path.exists(index_path):
+        return 0
+
+    store_path = get_chunk_store_path(db_vector_path, index_name)
+    if not ChunkStore.exists(store_path):
+        # 旧格式索引先转换为文本块存储
+        migrate_pickle_store(db_vector_path, index_name, embeddings=None)
+    store = ChunkStore(store_path)
+    rows = np.unique(np.concatenate([
+        store.find_document_rows(document.id, source=document.filename if match_source else None)
+        for document in documents
+    ]))
+    if not len(rows):
+        return 0
+
+    index = faiss.read_index(index_path)
+    index = remove_rows(index, rows)
+    keep = np.ones(len(store), dtype=bool)
+    keep[rows] = False
+    # 剩余文本块按原顺序写回，与索引重新编号后的位置一致
+    save_index(index, [store.get(int(row)) for row in np.flatnonzero(keep)], db_vector_path, index_name)
+    save_lexical_index(db_vector_path, index_name)
+    return len(rows)
+
+def remove_document_from_index(knowledge_base, document):
+    """
+    从知识库索引中删除某个文档的全部文本块和法律结构，无需重新嵌入其他文档。
+    返回删除的文本块数量。
+    """
+    user_id = knowledge_base.user.id
+    db_vector_path = os.path.join(settings.MEDIA_ROOT, 'faiss_index')
+    index_name = f"user_{user_id}_{knowledge_base.name}"
+
+    with get_index_lock(db_vector_path, index_name):
+        removed = remove_document_rows(db_vector_path, index_name, [document])
+        if removed:
+            print_colorful(f"已从索引 {index_name} 中删除文档 {document.filename} 的 {removed} 个文本块", text_color=Fore.GREEN)
+
+        law_removed = remove_law_structures(db_vector_path, document.id)
+        if law_removed:
+            print_colorful(f"已删除文档 {document.filename} 的 {law_removed} 个法律结构文件", text_color=Fore.GREEN)
+
+    # 索引已重写，清除已缓存的RAG服务
+    invalidate_rag_service(user_id, knowledge_base.name)
+    return removed
+
+def split_file(file_path, document_id=None, chunk_size=512, chunk_overlap=50, merge_rows=2, max_token_limit=8192):
+    """
+    加载并切分单个文件。
+    在进程池中执行，参数和返回值都需要可序列化；进度和取消状态由主进程处理。
+    返回：
+      {'docs': 文档块列表, 'law_structure': (法律名称, 法律结构) 或 None}
+    """
+    file_name = os.path.basename(file_path)
+    print_colorful(f"处理文件: {file_name}", text_color=Fore.CYAN)
+    law_structure = None
+    
+    # 获取加载器
+    loader_class = get_file_loader(file_path)
+    
+    # 特殊处理CSV文件
+    if file_path.lower().endswith(('.csv', '.xlsx', '.xls')):
+        docs = process_tabular_file(file_path, merge_rows)
+    else:
+        # 创建文本分割器
+        chinese_splitter = ChineseRecursiveTextSplitter(
+            keep_separator=True,
+            is_separator_regex=True,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+        )
+        
+        # 加载文档
+        loader = loader_class(file_path)
+        raw_docs = loader.load()
+        
+        # 检查是否是法律文档
+        content = "".join([d.page_content for d in raw_docs]).strip()
+        if is_law_document(content):
+            # 法律文档特殊处理
+            print_colorful(f"检测到法律文档: {file_name}", text_color=Fore.GREEN)
+            
+            # 提取法律名称
+            law_title_match = re.search(r'^([\u4e00-\u9fa5《》、]{4,}法)', content)
+            law_title = law_title_match.group(1) if law_title_match else "未知法律"
+            
+            # 使用法律专用分割器
+            law_docs = split_by_chapter_section_article(
+                content, 
+                source=file_name,
+                include_overview=True
+            )
+            
+            # 构建法律结构
+            if law_docs:
+                law_structure = (law_title, build_law_structure(
+                    law_docs, 
+                    law_title, 
+                    file_name,
+                    document_id=document_id
+                ))
+                
+                # 处理条文块，按照旧文档中的分块规则处理
+                refined_docs = []
+                for doc in law_docs:
+                    # 确保每个文档块都有law_name字段
+                    if "law_name" not in doc.metadata:
+                        doc.metadata["law_name"] = law_title
+                    
+                    # 对于条文块，直接保留完整内容（确保检索返回完整条文）；只有超过token限制才需要分割
+                    tokens = precise_token_count(doc.page_content)
+                    if tokens > max_token_limit:
+                        block_type = "条文块" if doc.metadata.get("content_type") == "article_content" else "非条文块"
+                        print_colorful(
+                            f"文件 {file_name} {block_type} token 数 {tokens} 超过{max_token_limit}，进行递归分块",
+                            text_color=Fore.YELLOW
+                        )
+                        split_chunks = recursive_split_document(doc, max_token_limit, overlap=10)
+                        refined_docs.extend(split_chunks)
+                    else:
+                        refined_docs.append(doc)
+                
+                # 合并相同条款的文档块
+                docs = merge_article_blocks(refined_docs)
+                print_colorful(
+                    f"文件 {file_name} 使用法律分块方式处理，共生成 {len(docs)} 个块",
+                    text_color=Fore.GREEN
+                )
+            else:
+                # 法律分块失败，使用普通分块方式
+                print_colorful(f"文件 {file_name} 法律分块失败，使用普通分块", text_color=Fore.YELLOW)
+                docs = chinese_splitter.split_documents(raw_docs)
+        else:
+            # 非法律文档使用中文递归分割器
+            docs = chinese_splitter.split_documents(raw_docs)
+            
+            # 检查是否有块超过限制
+            final_docs = []
+            for doc in docs:
+                tokens = precise_token_count(doc.page_content)
+                if tokens > max_token_limit:
+                    print_colorful(
+                        f"文件 {file_name} 普通块 token 数 {tokens} 超过{max_token_limit}，进行递归分块",
+                        text_color=Fore.YELLOW
+                    )
+                    split_chunks = recursive_split_document(doc, max_token_limit, overlap=10)
+                    final_docs.extend(split_chunks)
+                else:
+                    final_docs.append(doc)
+            docs = final_docs
+            
+            print_colorful(
+                f"文件 {file_name} 使用普通切分方式处理，共生成 {len(docs)} 个块",
+                text_color=Fore.GREEN
+            )
+    
+    # 设置元数据，记录所属文档以便删除文档时移除对应的向量
+    for doc in docs:
+        doc.metadata["source"] = file_name
+        doc.metadata["document_id"] = document_id
+    
+    return {'docs': docs, 'law_structure': law_structure}
 
-def process_documents(knowledge_base, force_create=False, progress_callback=None, task_id=None):
-    """处理知识库文档"""
+def iter_split_files(file_paths, split_options, workers=1, start_method='spawn', should_cancel=None):
+    """
+    加载并切分多个文件，按提交顺序逐个返回 (file_path, result, error)。
+    workers大于1时使用进程池并行执行（PDF解析、条款切分都是CPU密集型，线程受GIL限制），
+    同时在途的任务不超过 workers*2 个，避免切分结果堆积在内存中。
+    
+    参数：
+      split_options: {file_path: split_file的关键字参数}
+      should_cancel: 返回True时停止提交新任务
+    """
+    if workers <= 1 or len(file_paths) <= 1:
+        for file_path in file_paths:
+            if should_cancel and should_cancel():
+                return
+            try:
+                yield file_path, split_file(file_path, **split_options[file_path]), None
+            except Exception as e:
+                yield file_path, None, e
+        return
+    
+    context = multiprocessing.get_context(start_method)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        paths = iter(file_paths)
+        pending = deque()
+        
+        def submit_next():
+            file_path = next(paths, None)
+            if file_path is None:
+                return False
+            pending.append((file_path, executor.submit(split_file, file_path, **split_options[file_path])))
+            return True
+        
+        for _ in range(workers * 2):
+            if not submit_next():
+                break
+        
+        while pending:
+            if should_cancel and should_cancel():
+                for _, future in pending:
+                    future.cancel()
+                return
+            file_path, future = pending.popleft()
+            try:
+                yield file_path, future.result(), None
+            except Exception as e:
+                yield file_path, None, e
+            submit_next()
+
+def save_law_structure(db_vector_path, law_title, law_structure):
+    """保存法律结构"""
+    law_structure_dir = os.path.join(db_vector_path, "law_structure")
+    os.makedirs(law_structure_dir, exist_ok=True)
+    law_structure_path = os.path.join(law_structure_dir, f"{law_title}.json")
+    with open(law_structure_path, "w", encoding="utf-8") as f:
+        json.dump(law_structure, f, ensure_ascii=False, indent=2)
+
+def get_ingestion_config():
+    """读取 RAG_CONFIGS['ingestion']，workers为0时使用全部CPU核心"""
+    ingestion_config = getattr(settings, 'RAG_CONFIGS', {}).get('ingestion', {})
+    workers = ingestion_config.get('workers', 4) or os.cpu_count() or 1
+    return {
+        'workers': max(1, int(workers)),
+        'queue_size': max(1, int(ingestion_config.get('queue_size', 16))),
+        'start_method': ingestion_config.get('start_method', 'spawn'),
+        'checkpoint_interval': max(0, float(ingestion_config.get('checkpoint_interval', 60))),
+    }
+
+def mark_documents_processed(documents, failed_docs):
+    """更新文档处理状态：失败的文件记录错误并保持未处理，之后的任务会重新尝试"""
+    for doc in documents:
+        error = failed_docs.get(doc.file.path) if doc.file else None
+        doc.processed = error is None
+        doc.processing_error = error
+        doc.save(update_fields=['processed', 'processing_error'])
+
+def process_documents(knowledge_base, force_create=False, progress_callback=None, task_id=None,
+                      checkpoint_callback=None):
+    """
+    处理知识库文档。
+    checkpoint_callback(document_ids) 在每次保存检查点后调用，传入本次标记为已处理的文档ID。
+    """
     # 生成任务ID (如果未提供)
     if task_id is None:
         task_id = str(uuid.uuid4())
     
     kb_name = str(knowledge_base.id)
     user_id = knowledge_base.user.id  # 获取用户ID
-    group_name = f'kb_{kb_name}_{task_id}'
-    
-    # 初始化任务状态
-    settings.PROCESSING_TASKS[group_name] = {
-        'status': 'initializing',
-        'message': '正在初始化...',
-        'progress': 0,
-        'total': 0,
-        'task_id': task_id
-    }
     
     # 发送初始状态
     update_progress(task_id, kb_name, 'initializing', '正在初始化...', 0, 0)
@@ -491,56 +950,48 @@ def process_documents(knowledge_base, force_create=False, progress_callback=None
     # 获取配置
     rag_configs = getattr(settings, 'RAG_CONFIGS', {})
     db_docs_path = os.path.join(settings.MEDIA_ROOT, 'documents')
-    hash_file_path = os.path.join(db_docs_path, 'hash_file.json')
     db_vector_path = os.path.join(settings.MEDIA_ROOT, 'faiss_index')
     
     # 创建目录
     os.makedirs(db_docs_path, exist_ok=True)
     os.makedirs(db_vector_path, exist_ok=True)
     
-    # 读取哈希数据
-    hash_data = read_json_file(hash_file_path)
-    
-    # 生成包含用户ID的键名，确保不同用户的知识库不会相互干扰
-    user_kb_key = f"user_{user_id}_{knowledge_base.name}"
-    kb_hash_list = hash_data.get(user_kb_key, [])
+    # 补全旧文档缺失的哈希（上传时已计算的文档不再读取文件）
+    for doc in knowledge_base.documents.filter(file_hash=''):
+        if doc.file and os.path.exists(doc.file.path):
+            doc.file_hash = get_hash_of_file(doc.file.path)
+            doc.save(update_fields=['file_hash'])
     
     # 获取文档列表
     documents = knowledge_base.documents.filter(processed=False) if not force_create else knowledge_base.documents.all()
-    file_paths = [doc.file.path for doc in documents]
     
-    # 过滤已处理文件（除非强制重新创建）
+    # 过滤已处理文件（除非强制重新创建）：同一知识库中已处理过相同内容的文档直接跳过
     if not force_create:
-        filtered_file_paths = []
-        for file_path in file_paths:
-            file_hash = get_hash_of_file(file_path)
-            if file_hash not in kb_hash_list:
-                filtered_file_paths.append(file_path)
-                kb_hash_list.append(file_hash)
-        file_paths = filtered_file_paths
+        pending_documents = list(documents)
+        processed_hashes = set(
+            knowledge_base.documents
+            .filter(processed=True, file_hash__in=[doc.file_hash for doc in pending_documents if doc.file_hash])
+            .values_list('file_hash', flat=True)
+        )
+        new_documents = []
+        for doc in pending_documents:
+            if doc.file_hash and doc.file_hash in processed_hashes:
+                print(f"跳过重复文件: {doc.filename}")
+                continue
+            if doc.file_hash:
+                processed_hashes.add(doc.file_hash)
+            new_documents.append(doc)
     else:
-        # 强制重新创建时更新所有文件哈希
-        kb_hash_list = [get_hash_of_file(file_path) for file_path in file_paths]
-    
-    # 更新哈希数据 - 使用含用户ID的键名
-    hash_data[user_kb_key] = list(set(kb_hash_list))
-    save_json_file(hash_data, hash_file_path)
+        new_documents = list(documents)
+    file_paths = [doc.file.path for doc in new_documents]
+    document_ids = {doc.file.path: doc.id for doc in new_documents}
     
     # 更新任务状态
     update_progress(task_id, kb_name, 'processing', '正在分析文档...', 0, len(file_paths))
     
     # 处理文档
-    all_docs = []
     failed_docs = {}
     
-    # 创建文本分割器
-    chinese_splitter = ChineseRecursiveTextSplitter(
-        keep_separator=True,
-        is_separator_regex=True,
-        chunk_size=knowledge_base.chunk_size,
-        chunk_overlap=knowledge_base.chunk_overlap,
-    )
-    
     # 配置嵌入模型
     embedding_config = rag_configs.get('embedding', {}).copy()
     
@@ -559,349 +1010,270 @@ def process_documents(knowledge_base, force_create=False, progress_callback=None
             del embedding_config['local_model']
         max_token_limit = 8192  # 远程模型也支持8192 tokens
     
-    # 逐个加载和分割文档
+    # 加载和分割文档
     total_files = len(file_paths)
     total_chunks = 0
-    processed_chunks = 0
-
-    # 第一次扫描获取总块数
-    for idx, file_path in enumerate(file_paths):
-        # 检查是否被取消
-        if check_task_cancelled(task_id, kb_name):
-            return {'task_cancelled': True}
 
-        try:
-            # 获取加载器
-            loader_class = get_file_loader(file_path)
-            
-            # 特殊处理CSV文件
-            if file_path.lower().endswith(('.csv', '.xlsx', '.xls')):
-                # 估计每个文件生成5个块用于进度显示
-                total_chunks += 5
-            else:
-                # 加载文档
-                loader = loader_class(file_path)
-                raw_docs = loader.load()
-                
-                # 检查是否是法律文档
-                content = "".join([d.page_content for d in raw_docs]).strip()
-                if is_law_document(content):
-                    # 法律文档估计生成更多块
-                    total_chunks += 15
-                else:
-                    # 普通文档估计生成的块数
-                    total_chunks += 10
-        except Exception as e:
-            total_chunks += 1  # 即使文件加载失败也计入总数
-            print_colorful(f"估计总块数时出错: {str(e)}", text_color=Fore.RED)
+    # 根据文件大小和PDF页数估计总块数，不在这里解析文件，每个文件只在切分阶段加载一次
+    for file_path in file_paths:
+        total_chunks += estimate_file_chunks(file_path, knowledge_base.chunk_size)
 
     # 更新总块数
     update_progress(task_id, kb_name, 'processing', '开始处理文档...', 0, total_chunks)
     
-    # 逐个处理文档
-    for idx, file_path in enumerate(file_paths):
-        # 检查是否被取消
-        if check_task_cancelled(task_id, kb_name):
-            return {'task_cancelled': True}
-            
+    if not file_paths:
+        update_progress(task_id, kb_name, 'completed', '没有需要处理的新文档', total_chunks, total_chunks)
+        return failed_docs
+    
+    # 流水线：进程池加载并切分文件 -> 有界队列 -> 当前线程嵌入并写入索引（唯一写入方）
+    ingestion_config = get_ingestion_config()
+    split_options = {
+        file_path: {
+            'document_id': document_ids.get(file_path),
+            'chunk_size': knowledge_base.chunk_size,
+            'chunk_overlap': knowledge_base.chunk_overlap,
+            'merge_rows': knowledge_base.merge_rows,
+            'max_token_limit': max_token_limit,
+        }
+        for file_path in file_paths
+    }
+    chunk_queue = queue.Queue(maxsize=ingestion_config['queue_size'])
+    stop_event = threading.Event()
+    split_state = {'files': 0, 'chunks': 0}
+    
+    def should_stop():
+        return stop_event.is_set() or check_task_cancelled(task_id, kb_name)
+    
+    def queue_put(item):
+        # 队列已满时等待嵌入阶段消费，流水线停止后放弃
+        while not stop_event.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def run_split_stage():
         try:
-            print_colorful(f"处理文件: {os.path.basename(file_path)}", text_color=Fore.CYAN)
-            update_progress(task_id, kb_name, 'processing', f'处理文件: {os.path.basename(file_path)}', processed_chunks, total_chunks)
-            
-            # 获取加载器
-            loader_class = get_file_loader(file_path)
-            
-            # 特殊处理CSV文件
-            if file_path.lower().endswith(('.csv', '.xlsx', '.xls')):
-                docs = process_tabular_file(file_path, knowledge_base.merge_rows)
+            results = iter_split_files(
+                file_paths,
+                split_options,
+                workers=min(ingestion_config['workers'], total_files),
+                start_method=ingestion_config['start_method'],
+                should_cancel=should_stop,
+            )
+            for file_path, result, error in results:
+                file_name = os.path.basename(file_path)
+                if error is not None:
+                    print_colorful(f"处理文件 {file_name} 失败: {str(error)}", text_color=Fore.RED)
+                    update_progress(task_id, kb_name, 'error', f'处理文件 {file_name} 失败: {str(error)}', split_state['chunks'], total_chunks)
+                    failed_docs[file_path] = str(error)
+                    continue
                 
-                # 更新进度
-                processed_chunks += len(docs)
-                update_progress(task_id, kb_name, 'processing', f'处理表格文件: {os.path.basename(file_path)}', processed_chunks, total_chunks)
-            else:
-                # 加载文档
-                loader = loader_class(file_path)
-                raw_docs = loader.load()
+                if result['law_structure']:
+                    save_law_structure(db_vector_path, *result['law_structure'])
                 
-                # 检查是否是法律文档
-                content = "".join([d.page_content for d in raw_docs]).strip()
-                if is_law_document(content):
-                    # 法律文档特殊处理
-                    print_colorful(f"检测到法律文档: {os.path.basename(file_path)}", text_color=Fore.GREEN)
-                    update_progress(task_id, kb_name, 'processing', f'检测到法律文档: {os.path.basename(file_path)}', processed_chunks, total_chunks)
-                    
-                    # 提取法律名称
-                    law_title_match = re.search(r'^([\u4e00-\u9fa5《》、]{4,}法)', content)
-                    law_title = law_title_match.group(1) if law_title_match else "未知法律"
-                    
-                    # 使用法律专用分割器
-                    law_docs = split_by_chapter_section_article(
-                        content, 
-                        source=os.path.basename(file_path),
-                        include_overview=True
-                    )
-                    
-                    # 更新进度
-                    chunk_step = len(law_docs) / 10  # 每10%更新一次
-                    chunk_threshold = chunk_step
-                    
-                    # 构建法律结构
-                    if law_docs:
-                        law_structure = build_law_structure(
-                            law_docs, 
-                            law_title, 
-                            os.path.basename(file_path)
-                        )
-                        
-                        # 保存法律结构
-                        law_structure_dir = os.path.join(db_vector_path, "law_structure")
-                        os.makedirs(law_structure_dir, exist_ok=True)
-                        law_structure_path = os.path.join(law_structure_dir, f"{law_title}.json")
-                        with open(law_structure_path, "w", encoding="utf-8") as f:
-                            json.dump(law_structure, f, ensure_ascii=False, indent=2)
-                        
-                        # 处理条文块，按照旧文档中的分块规则处理
-                        refined_docs = []
-                        for i, doc in enumerate(law_docs):
-                            # 检查是否被取消
-                            if check_task_cancelled(task_id, kb_name):
-                                return {'task_cancelled': True}
-                                
-                            # 确保每个文档块都有law_name字段
-                            if "law_name" not in doc.metadata:
-                                doc.metadata["law_name"] = law_title
-                            
-                            # 对于条文块，直接保留完整内容（确保检索返回完整条文）
-                            if doc.metadata.get("content_type") == "article_content":
-                                # 只有超过token限制才需要分割
-                                tokens = precise_token_count(doc.page_content)
-                                if tokens > max_token_limit:
-                                    print_colorful(
-                                        f"文件 {os.path.basename(file_path)} 条文块 token 数 {tokens} 超过{max_token_limit}，进行递归分块",
-                                        text_color=Fore.YELLOW
-                                    )
-                                    split_chunks = recursive_split_document(doc, max_token_limit, overlap=10)
-                                    refined_docs.extend(split_chunks)
-                                else:
-                                    refined_docs.append(doc)
-                            else:
-                                # 对于非条文块，检查是否需要进一步分割
-                                tokens = precise_token_count(doc.page_content)
-                                if tokens > max_token_limit:
-                                    print_colorful(
-                                        f"文件 {os.path.basename(file_path)} 非条文块 token 数 {tokens} 超过{max_token_limit}，进行递归分块",
-                                        text_color=Fore.YELLOW
-                                    )
-                                    split_chunks = recursive_split_document(doc, max_token_limit, overlap=10)
-                                    refined_docs.extend(split_chunks)
-                                else:
-                                    refined_docs.append(doc)
-                            
-                            # 更新进度
-                            if i >= chunk_threshold:
-                                processed_chunks += 1
-                                chunk_threshold += chunk_step
-                                update_progress(task_id, kb_name, 'processing', 
-                                               f'处理法律文档: {os.path.basename(file_path)}', 
-                                               processed_chunks, total_chunks)
-                        
-                        # 合并相同条款的文档块
-                        docs = merge_article_blocks(refined_docs)
-                        print_colorful(
-                            f"文件 {os.path.basename(file_path)} 使用法律分块方式处理，共生成 {len(docs)} 个块",
-                            text_color=Fore.GREEN
-                        )
-                    else:
-                        # 法律分块失败，使用普通分块方式
-                        print_colorful(f"文件 {os.path.basename(file_path)} 法律分块失败，使用普通分块", text_color=Fore.YELLOW)
-                        update_progress(task_id, kb_name, 'processing', f'法律分块失败，使用普通分块: {os.path.basename(file_path)}', processed_chunks, total_chunks)
-                        docs = chinese_splitter.split_documents(raw_docs)
-                else:
-                    # 非法律文档使用中文递归分割器
-                    docs = chinese_splitter.split_documents(raw_docs)
-                    
-                    # 检查是否有块超过限制
-                    final_docs = []
-                    chunk_step = len(docs) / 10  # 每10%更新一次
-                    chunk_threshold = chunk_step
-                    
-                    for i, doc in enumerate(docs):
-                        # 检查是否被取消
-                        if check_task_cancelled(task_id, kb_name):
-                            return {'task_cancelled': True}
-                            
-                        tokens = precise_token_count(doc.page_content)
-                        if tokens > max_token_limit:
-                            print_colorful(
-                                f"文件 {os.path.basename(file_path)} 普通块 token 数 {tokens} 超过{max_token_limit}，进行递归分块",
-                                text_color=Fore.YELLOW
-                            )
-                            split_chunks = recursive_split_document(doc, max_token_limit, overlap=10)
-                            final_docs.extend(split_chunks)
-                        else:
-                            final_docs.append(doc)
-                        
-                        # 更新进度
-                        if i >= chunk_threshold:
-                            processed_chunks += 1
-                            chunk_threshold += chunk_step
-                            update_progress(task_id, kb_name, 'processing', 
-                                           f'处理文档: {os.path.basename(file_path)}', 
-                                           processed_chunks, total_chunks)
-                    
-                    docs = final_docs
-                    
-                    print_colorful(
-                        f"文件 {os.path.basename(file_path)} 使用普通切分方式处理，共生成 {len(docs)} 个块",
-                        text_color=Fore.GREEN
-                    )
-            
-            # 设置元数据
-            for doc in docs:
-                doc.metadata["source"] = os.path.basename(file_path)
-            
-            all_docs.extend(docs)
-            print_colorful(f"成功处理 {len(docs)} 个文档块", text_color=Fore.GREEN)
-            
-            # 更新处理进度
-            if progress_callback:
-                progress_callback((idx + 1) / total_files)
-            
+                docs = result['docs']
+                split_state['files'] += 1
+                split_state['chunks'] += len(docs)
+                print_colorful(f"成功处理 {len(docs)} 个文档块", text_color=Fore.GREEN)
+                
+                # 更新处理进度
+                if progress_callback:
+                    progress_callback(split_state['files'] / total_files)
+                
+                if docs and not queue_put((file_path, docs)):
+                    return
         except Exception as e:
-            print_colorful(f"处理文件 {os.path.basename(file_path)} 失败: {str(e)}", text_color=Fore.RED)
-            update_progress(task_id, kb_name, 'error', f'处理文件 {os.path.basename(file_path)} 失败: {str(e)}', processed_chunks, total_chunks)
+            print_colorful(f"切分文档失败: {str(e)}", text_color=Fore.RED)
             import traceback
             traceback.print_exc()
-            failed_docs[file_path] = str(e)
+            for file_path in file_paths:
+                failed_docs.setdefault(file_path, f"切分文档失败: {str(e)}")
+        finally:
+            # 结束标记
+            queue_put(None)
     
-    # 创建或更新向量数据库
-    if all_docs:
-        try:
-            update_progress(task_id, kb_name, 'embedding', '正在创建向量数据库...', processed_chunks, total_chunks)
-            
-            # 获取嵌入模型
-            embeddings = get_embeddings(embedding_config)
-            if not embeddings:
-                error_msg = "无法初始化嵌入模型"
-                update_progress(task_id, kb_name, 'error', error_msg, processed_chunks, total_chunks)
-                raise ValueError(error_msg)
-            
-            # 生成包含用户ID的索引名称
-            index_name = f"user_{user_id}_{knowledge_base.name}"
-            
-            # 检查是否存在现有向量数据库 - 使用新的索引名称
-            existing_index = os.path.join(db_vector_path, f"{index_name}.faiss")
-            
-            # 显示嵌入进度
-            total_embeddings = len(all_docs)
-            batch_size = 5  # 每批次处理的文档数
-            
+    # 已取出的文件及其最后一个文档块的序号，嵌入进度越过该序号说明文件已全部写入索引
+    queued_files = []
+    
+    def iter_queued_documents():
+        queued_count = 0
+        while True:
+            try:
+                item = chunk_queue.get(timeout=0.5)
+            except queue.Empty:
+                if should_stop():
+                    return
+                continue
+            if item is None:
+                return
+            file_path, docs = item
+            queued_count += len(docs)
+            queued_files.append((file_path, queued_count))
+            yield from docs
+    
+    checkpoint_state = {'saved_at': time.time(), 'files': 0}
+    
+    def save_checkpoint(vectorstore, done):
+        # 定期保存索引，并把已全部写入索引的文件标记为已处理，任务中断后只需处理剩余文件
+        checkpoint_interval = ingestion_config['checkpoint_interval']
+        if not checkpoint_interval or time.time() - checkpoint_state['saved_at'] < checkpoint_interval:
+            return
+        completed = []
+        for file_path, end in queued_files[checkpoint_state['files']:]:
+            if end > done:
+                break
+            completed.append(file_path)
+        if not completed:
+            return
+        save_vectorstore(vectorstore, db_vector_path, index_name)
+        save_lexical_index(db_vector_path, index_name)
+        completed_ids = [document_ids[file_path] for file_path in completed if file_path in document_ids]
+        knowledge_base.documents.filter(id__in=completed_ids).update(processed=True, processing_error=None)
+        checkpoint_state['saved_at'] = time.time()
+        checkpoint_state['files'] += len(completed)
+        invalidate_rag_service(user_id, knowledge_base.name)
+        print(f"已保存检查点: {checkpoint_state['files']}/{total_files} 个文件")
+        if checkpoint_callback:
+            checkpoint_callback(completed_ids)
+    
+    split_thread = threading.Thread(target=run_split_stage, daemon=True)
+    embedded_count = 0
+    
+    try:
+        update_progress(task_id, kb_name, 'embedding', '正在创建向量数据库...', 0, total_chunks)
+        
+        # 获取嵌入模型
+        embeddings = get_embeddings(embedding_config)
+        if not embeddings:
+            error_msg = "无法初始化嵌入模型"
+            update_progress(task_id, kb_name, 'error', error_msg, 0, total_chunks)
+            raise ValueError(error_msg)
+        
+        # 生成包含用户ID的索引名称
+        index_name = f"user_{user_id}_{knowledge_base.name}"
+        
+        # 检查是否存在现有向量数据库 - 使用新的索引名称
+        existing_index = os.path.join(db_vector_path, f"{index_name}.faiss")
+        
+        # 显示嵌入进度
+        batch_size = get_embedding_batch_size(embeddings)  # 每批次处理的文档数
+        print(f"嵌入批次大小: {batch_size}, 切分进程数: {ingestion_config['workers']}")
+        
+        def report_embedding_progress(done, total):
+            nonlocal embedded_count
+            embedded_count = done
+            # 切分和嵌入同时进行，总数取估计值和已切分块数中的较大者
+            current_total = max(total_chunks, split_state['chunks'])
+            update_progress(task_id, kb_name, 'embedding', 
+                            f'已切分 {split_state["files"]}/{total_files} 个文件，正在生成向量 ({done}/{split_state["chunks"]})...', 
+                            done, current_total)
+        
+        # 加载、追加和保存期间持有索引写锁，避免与删除文档同时修改索引
+        with get_index_lock(db_vector_path, index_name):
+            vectorstore = None
             if os.path.exists(existing_index) and not force_create:
                 # 加载现有数据库并添加新文档 - 使用新的索引名称
                 print(f"加载现有向量数据库: {existing_index}")
-                update_progress(task_id, kb_name, 'embedding', '加载现有向量数据库...', processed_chunks, total_chunks)
-                
-                vectorstore = FAISS.load_local(
-                    folder_path=db_vector_path,
-                    embeddings=embeddings,
-                    index_name=index_name,
-                    allow_dangerous_deserialization=True
-                )
-                
-                # 分批处理嵌入以更新进度
-                for i in range(0, total_embeddings, batch_size):
-                    # 检查是否被取消
-                    if check_task_cancelled(task_id, kb_name):
-                        return {'task_cancelled': True}
-                        
-                    batch = all_docs[i:i+batch_size]
-                    batch_size_actual = len(batch)
-                    
-                    # 计算当前进度，确保不超过总数
-                    current_progress = min(processed_chunks + i, total_chunks)
-                    
-                    update_progress(task_id, kb_name, 'embedding', 
-                                    f'正在生成向量 ({i+1}-{min(i+batch_size_actual, total_embeddings)}/{total_embeddings})...', 
-                                    current_progress, total_chunks)
-                    
-                    # 创建批次向量
-                    batch_vectorstore = FAISS.from_documents(batch, embeddings)
-                    
-                    # 合并到主向量存储
-                    vectorstore.merge_from(batch_vectorstore)
-                
-                # 保存更新后的向量数据库 - 使用新的索引名称
-                vectorstore.save_local(db_vector_path, index_name)
-                
-                print_colorful(f"成功将 {len(all_docs)} 个新文档添加到向量数据库", text_color=Fore.GREEN)
-                update_progress(task_id, kb_name, 'completed', f'完成! 成功处理 {len(all_docs)} 个文档块', total_chunks, total_chunks)
+                update_progress(task_id, kb_name, 'embedding', '加载现有向量数据库...', 0, total_chunks)
+
+                # 中断前的检查点可能包含未处理文档的部分文本块，先删除再重新追加，避免重复
+                removed = remove_document_rows(db_vector_path, index_name, list(documents), match_source=False)
+                if removed:
+                    print_colorful(f"已删除上次中断时写入的 {removed} 个未完成文本块", text_color=Fore.YELLOW)
+
+                vectorstore = load_vectorstore(db_vector_path, index_name, embeddings)
+                existing_type = get_index_type(vectorstore.index)
+                if existing_type != knowledge_base.index_type:
+                    print_colorful(
+                        f"现有索引类型为 {existing_type}，与知识库设置 {knowledge_base.index_type} 不一致，"
+                        f"新文档将追加到现有索引，重新创建知识库后生效",
+                        text_color=Fore.YELLOW
+                    )
             else:
                 # 创建新的向量数据库 - 使用新的索引名称
-                print(f"创建包含 {len(all_docs)} 个文档的新向量数据库...")
-                update_progress(task_id, kb_name, 'embedding', f'创建包含 {len(all_docs)} 个文档的新向量数据库...', processed_chunks, total_chunks)
-                
-                # 分批处理嵌入以更新进度
-                batch_vectors = []
-                
-                for i in range(0, total_embeddings, batch_size):
-                    # 检查是否被取消
-                    if check_task_cancelled(task_id, kb_name):
-                        return {'task_cancelled': True}
-                        
-                    batch = all_docs[i:i+batch_size]
-                    batch_size_actual = len(batch)
-                    
-                    update_progress(task_id, kb_name, 'embedding', 
-                                   f'正在生成向量 ({i+1}-{min(i+batch_size_actual, total_embeddings)}/{total_embeddings})...', 
-                                   processed_chunks + i, total_chunks)
-                    
-                    # 创建批次向量
-                    batch_vectorstore = FAISS.from_documents(batch, embeddings)
-                    batch_vectors.append(batch_vectorstore)
-                
-                # 合并所有批次向量
-                if batch_vectors:
-                    vectorstore = batch_vectors[0]
-                    for vs in batch_vectors[1:]:
-                        vectorstore.merge_from(vs)
-                    
-                    # 保存向量数据库 - 使用新的索引名称
-                    vectorstore.save_local(db_vector_path, index_name)
-                
-                print_colorful(f"成功创建包含 {len(all_docs)} 个文档的新向量数据库", text_color=Fore.GREEN)
-                update_progress(task_id, kb_name, 'completed', f'完成! 成功处理 {len(all_docs)} 个文档块', total_chunks, total_chunks)
+                print(f"创建新的向量数据库: {index_name}")
+                update_progress(task_id, kb_name, 'embedding', '创建新的向量数据库...', 0, total_chunks)
             
-            # 更新文档处理状态
-            for doc in documents:
-                doc.processed = True
-                doc.save()
-                
-            # 发送最终完成消息
-            if task_id:
-                time.sleep(1)  # 等待1秒确保之前的消息已经发送
-                
-                # 再次发送完成消息以确保前端更新
-                final_message = f'完成! 成功处理 {len(all_docs) if all_docs else 0} 个文档块'
-                update_progress(task_id, kb_name, 'completed', final_message, 
-                              total_chunks, total_chunks)
-                
-        except Exception as e:
-            print_colorful(f"创建向量数据库失败: {str(e)}", text_color=Fore.RED)
-            update_progress(task_id, kb_name, 'error', f'创建向量数据库失败: {str(e)}', processed_chunks, total_chunks)
-            import traceback
-            traceback.print_exc()
-            for file_path in file_paths:
-                if file_path not in failed_docs:
-                    failed_docs[file_path] = f"向量数据库创建失败: {str(e)}"
-    else:
-        update_progress(task_id, kb_name, 'completed', '没有需要处理的新文档', total_chunks, total_chunks)
+            # 新建索引时同步计算查询样本的精确结果，用于生成召回率报告
+            faiss_params = rag_configs.get('database', {}).get('faiss_params', {})
+            report_config = faiss_params.get('report', {})
+            tracker = None
+            if vectorstore is None and report_config.get('enabled', True):
+                tracker = GroundTruthTracker(
+                    num_queries=report_config.get('num_queries', 100),
+                    k=report_config.get('k', 10),
+                )
+            
+            # 启动切分阶段，边切分边嵌入并直接写入索引
+            split_thread.start()
+            vectorstore = stream_documents_to_vectorstore(
+                iter_queued_documents(),
+                embeddings,
+                vectorstore=vectorstore,
+                batch_size=batch_size,
+                on_batch=report_embedding_progress,
+                should_cancel=lambda: check_task_cancelled(task_id, kb_name),
+                index_type=knowledge_base.index_type,
+                index_params=knowledge_base.index_params,
+                on_vectors=tracker.update if tracker else None,
+                on_flush=save_checkpoint,
+            )
+            if check_task_cancelled(task_id, kb_name):
+                return {'task_cancelled': True}
+            split_thread.join()
+            
+            if embedded_count == 0:
+                # 所有文件都没有产生文档块
+                mark_documents_processed(documents, failed_docs)
+                update_progress(task_id, kb_name, 'completed', '没有需要处理的新文档', total_chunks, total_chunks)
+                return failed_docs
+            
+            # 保存向量数据库（.faiss + 文本块存储） - 使用新的索引名称
+            save_vectorstore(vectorstore, db_vector_path, index_name)
+            save_lexical_index(db_vector_path, index_name)
         
+        # 生成召回率-延迟报告，便于选择 nprobe/efSearch
+        if tracker:
+            try:
+                update_progress(task_id, kb_name, 'embedding', '正在评估索引召回率...', embedded_count, embedded_count)
+                report = build_recall_report(vectorstore.index, tracker, faiss_params)
+                save_recall_report(report, db_vector_path, index_name)
+            except Exception as e:
+                print_colorful(f"生成召回率报告失败: {str(e)}", text_color=Fore.YELLOW)
+        
+        print_colorful(f"成功将 {embedded_count} 个文档块写入向量数据库", text_color=Fore.GREEN)
+        update_progress(task_id, kb_name, 'completed', f'完成! 成功处理 {embedded_count} 个文档块', embedded_count, embedded_count)
+        
+        # 索引已重写，清除已缓存的RAG服务
+        invalidate_rag_service(user_id, knowledge_base.name)
+        
+        # 更新文档处理状态
+        mark_documents_processed(documents, failed_docs)
+            
         # 发送最终完成消息
         if task_id:
             time.sleep(1)  # 等待1秒确保之前的消息已经发送
             
             # 再次发送完成消息以确保前端更新
-            update_progress(task_id, kb_name, 'completed', '没有需要处理的新文档', 
-                          total_chunks, total_chunks)
+            final_message = f'完成! 成功处理 {embedded_count} 个文档块'
+            update_progress(task_id, kb_name, 'completed', final_message, 
+                          embedded_count, embedded_count)
+            
+    except Exception as e:
+        print_colorful(f"创建向量数据库失败: {str(e)}", text_color=Fore.RED)
+        update_progress(task_id, kb_name, 'error', f'创建向量数据库失败: {str(e)}', embedded_count, total_chunks)
+        import traceback
+        traceback.print_exc()
+        for file_path in file_paths:
+            if file_path not in failed_docs:
+                failed_docs[file_path] = f"向量数据库创建失败: {str(e)}"
+    finally:
+        # 停止切分阶段（取消或出错时不再等待剩余文件）
+        stop_event.set()
+        if split_thread.is_alive():
+            split_thread.join()
     
-    return failed_docs
\ No newline at end of file
+    return failed_docs
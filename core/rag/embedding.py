@@ -1,5 +1,6 @@
 # core/rag/embedding.py
-from openai import OpenAI
+import os
+from openai import OpenAI, AsyncOpenAI
 from typing import List
 import time
 import re
@@ -7,7 +8,30 @@ from langchain_core.embeddings import Embeddings
 import subprocess
 import json
 import httpx
+import random
+import threading
+import asyncio
+import weakref
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from core.utils import get_loop_bound_client
+
+# 查询嵌入使用的异步客户端，按事件循环共享
+_async_clients = weakref.WeakKeyDictionary()
+
+def _with_cache(embeddings, provider: str, model_name: str):
+    """按 RAG_CONFIGS['embedding_cache'] 为嵌入模型加上持久化缓存"""
+    from django.conf import settings
+    cache_config = getattr(settings, 'RAG_CONFIGS', {}).get('embedding_cache', {})
+    if not cache_config.get('enabled', True):
+        return embeddings
+    try:
+        from core.rag.embedding_cache import CachedEmbeddings, get_embedding_cache
+        cache_path = cache_config.get('path') or os.path.join(settings.MEDIA_ROOT, 'embedding_cache', 'embeddings.sqlite3')
+        return CachedEmbeddings(embeddings, get_embedding_cache(cache_path), provider, model_name)
+    except Exception as e:
+        print(f"初始化嵌入缓存失败，将不使用缓存: {e}")
+        return embeddings
 
 def get_embeddings(embedding_cfg: dict):
     """获取嵌入模型"""
@@ -26,6 +50,8 @@ def get_embeddings(embedding_cfg: dict):
             embeddings = OllamaEmbedding(
                 model_name=model_name,
                 base_url=embedding_cfg.get('base_url', 'http://localhost:11434/api'),
+                batch_size=embedding_cfg.get('local_batch_size', 32),
+                max_concurrency=embedding_cfg.get('local_max_concurrency', 2),
             )
             
             # 测试嵌入功能
@@ -35,14 +61,16 @@ def get_embeddings(embedding_cfg: dict):
             except Exception as e:
                 print(f"本地嵌入测试失败: {e}")
             
-            return embeddings
+            return _with_cache(embeddings, provider, model_name)
         elif provider in ['openai', 'siliconflow', 'ollama']:
             print(f"使用 {provider} API 进行嵌入")
             embeddings = OpenAIEmbedding(
                 model_name=model_name,
                 api_key=embedding_cfg.get('api_key', ''),
                 base_url=embedding_cfg.get('base_url', ''),
-                provider=provider
+                provider=provider,
+                max_concurrency=embedding_cfg.get('max_concurrency', 4),
+                rate_limit=embedding_cfg.get('rate_limit')
             )
             
             # 测试嵌入功能
@@ -52,7 +80,7 @@ def get_embeddings(embedding_cfg: dict):
             except Exception as e:
                 print(f"嵌入测试失败: {e}")
             
-            return embeddings
+            return _with_cache(embeddings, provider, model_name)
     except Exception as e:
         print(f"初始化嵌入模型失败: {e}")
         import traceback
@@ -60,13 +88,78 @@ def get_embeddings(embedding_cfg: dict):
     
     return None
 
+class TokenBucket:
+    """令牌桶：以固定速率补充令牌，允许一定突发"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1):
+        """获取令牌，不足时阻塞等待；超过桶容量的请求按容量计算"""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+class RateLimiter:
+    """按每分钟请求数（rpm）和每分钟token数（tpm）限制调用"""
+    def __init__(self, rpm: int = None, tpm: int = None):
+        self.request_bucket = TokenBucket(rpm / 60.0, max(1, rpm / 60.0)) if rpm else None
+        self.token_bucket = TokenBucket(tpm / 60.0, tpm / 60.0) if tpm else None
+
+    def acquire(self, tokens: int = 0):
+        if self.request_bucket:
+            self.request_bucket.acquire(1)
+        if self.token_bucket and tokens:
+            self.token_bucket.acquire(tokens)
+
+# 同一提供商的所有嵌入实例共享限速器
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(provider: str, base_url: str, rate_limit: dict = None):
+    """获取提供商共享的限速器，未配置时返回None"""
+    if not rate_limit or not (rate_limit.get('rpm') or rate_limit.get('tpm')):
+        return None
+    key = (provider, base_url)
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(rpm=rate_limit.get('rpm'), tpm=rate_limit.get('tpm'))
+            _rate_limiters[key] = limiter
+        return limiter
+
 class OllamaEmbedding(Embeddings):
     """本地Ollama API嵌入模型"""
-    def __init__(self, model_name: str, base_url: str = "http://localhost:11434/api"):
+    def __init__(self, model_name: str, base_url: str = "http://localhost:11434/api",
+                 batch_size: int = 32, max_concurrency: int = 2, max_connections: int = 8):
         self.model_name = model_name
         self.base_url = base_url
-        self.client = httpx.Client(timeout=120.0)  # 设置较长的超时时间
+        # 复用连接池，保持HTTP长连接
+        self.client = httpx.Client(
+            timeout=120.0,  # 设置较长的超时时间
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60.0,
+            ),
+        )
         self.max_token_limit = 8192  # 本地模型通常可以处理更长的文本
+        self.max_batch_size = max(1, batch_size)
+        self.max_concurrency = max(1, max_concurrency)
+        # 是否支持批量接口 /api/embed（None表示尚未探测，旧版本Ollama只有 /api/embeddings）
+        self.supports_batch = None
+        self.max_connections = max_connections
         self.request_count = 0
     
     def clear_text(self, text: str) -> str:
@@ -83,83 +176,175 @@ class OllamaEmbedding(Embeddings):
         # 估算token数量
         tokens = chinese_chars + english_chars / 4
         return int(tokens)
-    
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        """嵌入多个文档"""
-        embeddings = []
-        for i, text in enumerate(texts):
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> List[float]:
+        """L2归一化。/api/embed 返回归一化向量，旧接口的结果也归一化以保持一致"""
+        arr = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(arr)
+        if norm == 0:
+            return arr.tolist()
+        return (arr / norm).tolist()
+
+    @staticmethod
+    def _is_endpoint_missing(response) -> bool:
+        """
+        /api/embed 返回的404是否表示接口不存在（旧版本Ollama，返回纯文本“404 page not found”）。
+        模型不存在时也返回404，但响应是带 error 字段的JSON，这种情况不能关闭批量接口。
+        """
+        if response.status_code != 404:
+            return False
+        try:
+            result = response.json()
+        except ValueError:
+            return True
+        return not (isinstance(result, dict) and result.get("error"))
+
+    def _embed_single(self, text: str) -> List[float]:
+        """调用旧版单文本接口 /api/embeddings"""
+        response = self.client.post(
+            f"{self.base_url}/embeddings",
+            json={"model": self.model_name, "prompt": text}
+        )
+        response.raise_for_status()
+        result = response.json()
+        if "embedding" not in result:
+            raise ValueError(f"API返回中没有找到embedding字段: {result}")
+        return self._normalize(result["embedding"])
+
+    def _embed_batch(self, batch: List[str]) -> list:
+        """
+        嵌入一个批次，返回与输入一一对应的向量列表（失败的位置为None）。
+        优先使用批量接口 /api/embed，服务端不支持时回退到逐条请求。
+        """
+        if self.supports_batch is not False:
             try:
-                # 检查文本长度
-                token_estimate = self._get_chunk_size(text)
-                if token_estimate > self.max_token_limit:
-                    print(f"警告: 文本可能超过token限制 (估计: {token_estimate}), 可能导致截断")
-                
-                # 调用Ollama API
                 response = self.client.post(
-                    f"{self.base_url}/embeddings",
-                    json={"model": self.model_name, "prompt": self.clear_text(text)}
+                    f"{self.base_url}/embed",
+                    json={"model": self.model_name, "input": batch}
                 )
-                
-                # 只记录第一次HTTP请求
-                if i == 0:
-                    print(f'HTTP Request: POST {self.base_url}/embeddings "{response.status_code} {response.reason_phrase}"')
-                
-                response.raise_for_status()
-                result = response.json()
-                
-                if "embedding" in result:
-                    embeddings.append(result["embedding"])
+                if self.supports_batch is None and self._is_endpoint_missing(response):
+                    # 旧版本Ollama没有批量接口，之后统一使用单条接口
+                    print(f"Ollama不支持批量嵌入接口 {self.base_url}/embed，回退到 /embeddings")
+                    self.supports_batch = False
                 else:
-                    raise ValueError(f"API返回中没有找到embedding字段: {result}")
-                
+                    response.raise_for_status()
+                    result = response.json()
+                    if "embeddings" not in result or len(result["embeddings"]) != len(batch):
+                        raise ValueError(f"API返回的embeddings字段无效: {str(result)[:200]}")
+                    self.supports_batch = True
+                    return result["embeddings"]
+            except Exception as e:
+                print(f"批量嵌入文档时出错: {e}")
+                return [None] * len(batch)
+
+        vectors = []
+        for text in batch:
+            try:
+                vectors.append(self._embed_single(text))
             except Exception as e:
                 print(f"嵌入文档时出错: {e}")
-                import traceback
-                traceback.print_exc()
-                # 出错时返回零向量（避免整个过程失败）
-                if embeddings and len(embeddings) > 0:
-                    # 使用第一个向量的维度作为零向量的维度
-                    embeddings.append([0.0] * len(embeddings[0]))
-                else:
-                    # 如果还没有成功的向量，使用默认维度（如768或1024）
-                    embeddings.append([0.0] * 1024)
+                vectors.append(None)
+        return vectors
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """嵌入多个文档：按批次并发请求，结果保持输入顺序"""
+        cleaned = []
+        for text in texts:
+            # 检查文本长度
+            token_estimate = self._get_chunk_size(text)
+            if token_estimate > self.max_token_limit:
+                print(f"警告: 文本可能超过token限制 (估计: {token_estimate}), 可能导致截断")
+            cleaned.append(self.clear_text(text))
         
-        return embeddings
+        batches = [(start, cleaned[start:start + self.max_batch_size])
+                   for start in range(0, len(cleaned), self.max_batch_size)]
+        results = [None] * len(cleaned)
+        
+        # 第一个批次先同步执行，确定服务端是否支持批量接口
+        if batches:
+            start, batch = batches[0]
+            results[start:start + len(batch)] = self._embed_batch(batch)
+        
+        if len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches) - 1)) as executor:
+                futures = {executor.submit(self._embed_batch, batch): (start, len(batch)) for start, batch in batches[1:]}
+                for future in as_completed(futures):
+                    start, size = futures[future]
+                    try:
+                        results[start:start + size] = future.result()
+                    except Exception as e:
+                        print(f"嵌入文档批次时出错: {e}")
+        
+        # 出错时返回零向量（避免整个过程失败），使用成功向量的维度，否则使用默认维度
+        dim = next((len(v) for v in results if v is not None), 1024)
+        return [v if v is not None else [0.0] * dim for v in results]
     
     def embed_query(self, text: str) -> List[float]:
-        """嵌入单个查询"""
+        """嵌入单个查询，与文档使用相同的接口以保证向量一致"""
+        vector = self._embed_batch([self.clear_text(text)])[0]
+        if vector is None:
+            # 出错时返回零向量
+            return [0.0] * 1024  # 使用默认维度
+        return vector
+
+    def _get_async_client(self):
+        return get_loop_bound_client(_async_clients, ('ollama', self.base_url), lambda: httpx.AsyncClient(
+            timeout=120.0,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=60.0,
+            ),
+        ))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """异步嵌入单个查询，接口选择与 embed_query 相同"""
+        client = self._get_async_client()
+        text = self.clear_text(text)
         try:
-            # 调用Ollama API
-            response = self.client.post(
+            if self.supports_batch is not False:
+                response = await client.post(
+                    f"{self.base_url}/embed",
+                    json={"model": self.model_name, "input": [text]}
+                )
+                if self.supports_batch is None and self._is_endpoint_missing(response):
+                    print(f"Ollama不支持批量嵌入接口 {self.base_url}/embed，回退到 /embeddings")
+                    self.supports_batch = False
+                else:
+                    response.raise_for_status()
+                    result = response.json()
+                    if not result.get("embeddings"):
+                        raise ValueError(f"API返回的embeddings字段无效: {str(result)[:200]}")
+                    self.supports_batch = True
+                    return result["embeddings"][0]
+
+            response = await client.post(
                 f"{self.base_url}/embeddings",
-                json={"model": self.model_name, "prompt": self.clear_text(text)}
+                json={"model": self.model_name, "prompt": text}
             )
-            
-            # 记录HTTP请求
-            # print(f'HTTP Request: POST {self.base_url}/embeddings "{response.status_code} {response.reason_phrase}"')
-            
             response.raise_for_status()
             result = response.json()
-            
-            if "embedding" in result:
-                return result["embedding"]
-            else:
+            if "embedding" not in result:
                 raise ValueError(f"API返回中没有找到embedding字段: {result}")
-                
+            return self._normalize(result["embedding"])
         except Exception as e:
             print(f"嵌入查询时出错: {e}")
-            import traceback
-            traceback.print_exc()
             # 出错时返回零向量
-            return [0.0] * 1024  # 使用默认维度
+            return [0.0] * 1024
 
 
 class OpenAIEmbedding(Embeddings):
     """OpenAI API嵌入模型"""
-    def __init__(self, model_name: str, api_key: str, base_url: str, provider: str = 'openai') -> None:
+    def __init__(self, model_name: str, api_key: str, base_url: str, provider: str = 'openai',
+                 max_concurrency: int = 4, rate_limit: dict = None) -> None:
         self.model_name = model_name
         self.provider = provider
         self.client = OpenAI(api_key=api_key, base_url=base_url)
+        # 并发请求数和提供商级别的速率限制
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate_limiter = get_rate_limiter(provider, base_url, rate_limit)
+        self._adapt_lock = threading.Lock()
         
         # 根据模型名称设置不同的参数
         if 'bge-m3' in model_name.lower():
@@ -256,251 +441,150 @@ class OpenAIEmbedding(Embeddings):
         
         return final_result
 
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        """嵌入多个文档"""
-        import numpy as np
-        
-        # 记录当前HTTP请求
-        http_request_shown = False
-        
-        # 首先处理所有文本，确保它们都在token限制内
-        processed_texts = []
-        for text in texts:
-            if self._get_chunk_size(text) > self.max_token_limit:
-                # 如果文本超过token限制，分割它
-                chunks = self._split_text_by_token_limit(self.clear_text(text), self.max_token_limit)
-                processed_texts.extend(chunks)
-            else:
-                processed_texts.append(self.clear_text(text))
+    def _prepare_text(self, text: str) -> List[str]:
+        """清理文本并按token限制分割，返回该文本对应的片段列表"""
+        text = self.clear_text(text)
+        if self._get_chunk_size(text) > self.max_token_limit:
+            pieces = self._split_text_by_token_limit(text, self.max_token_limit)
+        else:
+            pieces = [text]
         
-        # 再次检查每个块的大小
-        final_processed_texts = []
-        for text in processed_texts:
-            if self._get_chunk_size(text) > self.max_token_limit:
-                # 如果还是超过，使用更保守的分割
-                smaller_chunks = self._split_text_by_token_limit(text, int(self.max_token_limit * 0.8))
-                final_processed_texts.extend(smaller_chunks)
+        # 再次检查每个片段的大小，仍然超过时使用更保守的分割
+        final_pieces = []
+        for piece in pieces:
+            if self._get_chunk_size(piece) > self.max_token_limit:
+                final_pieces.extend(self._split_text_by_token_limit(piece, int(self.max_token_limit * 0.8)))
             else:
-                final_processed_texts.append(text)
+                final_pieces.append(piece)
+        return final_pieces or [text]
+
+    def _acquire_rate_limit(self, batch: List[str]):
+        """按提供商的令牌桶限制请求数和token数"""
+        if not self.rate_limiter:
+            return
+        self.rate_limiter.acquire(sum(self._get_chunk_size(t) for t in batch))
+
+    def _shrink_batch_size(self, failed_size: int):
+        """服务端提示批次过大时，减小后续批次大小"""
+        with self._adapt_lock:
+            new_size = max(1, min(self.max_batch_size, failed_size // 2))
+            if new_size < self.max_batch_size:
+                print(f"警告：批处理大小超出限制，批次大小调整为 {new_size}")
+                self.max_batch_size = new_size
+
+    def _shrink_token_limit(self) -> int:
+        """服务端提示输入token过多时，降低后续文本的token限制"""
+        with self._adapt_lock:
+            self.max_token_limit = max(16, int(self.max_token_limit * 0.7))
+            print(f"警告：输入超过token限制，token限制调整为 {self.max_token_limit}")
+            return self.max_token_limit
+
+    def _embed_oversized_text(self, text: str, max_tokens: int):
+        """将单个超限文本进一步分割后嵌入，返回各片段的平均向量"""
+        pieces = self._split_text_by_token_limit(text, max_tokens)
+        vectors = []
+        for i in range(0, len(pieces), self.max_batch_size):
+            vectors.extend(self._embed_batch(pieces[i:i + self.max_batch_size], allow_split=False))
+        vectors = [v for v in vectors if v is not None]
+        if not vectors:
+            return None
+        if len(vectors) == 1:
+            return vectors[0]
+        return np.mean(vectors, axis=0).tolist()
+
+    def _embed_batch(self, batch: List[str], allow_split: bool = True) -> list:
+        """
+        嵌入一个批次，返回与输入一一对应的向量列表（失败的位置为None）。
+        在线程池中执行，重试等待只阻塞当前批次。
+        """
+        max_retry_times = 10
+        retry_count = 0
+        _sleep_time = 1
         
-        # 准备批次，确保每个批次大小不超过最大批处理大小
-        batches = []
-        for i in range(0, len(final_processed_texts), self.max_batch_size):
-            batches.append(final_processed_texts[i:i + self.max_batch_size])
+        while True:
+            self._acquire_rate_limit(batch)
+            try:
+                response = self.client.embeddings.create(
+                    input=batch, 
+                    model=self.model_name, 
+                    encoding_format="float"
+                )
+                return [r.embedding for r in response.data]
+            except Exception as e:
+                if "maximum allowed batch size" in str(e) and len(batch) > 1:
+                    # 批处理大小错误：减小批次大小，将当前批次分成两半处理
+                    self._shrink_batch_size(len(batch))
+                    half_size = len(batch) // 2
+                    return (self._embed_batch(batch[:half_size], allow_split) +
+                            self._embed_batch(batch[half_size:], allow_split))
+                
+                if "input must have less than 512 tokens" in str(e):
+                    if not allow_split:
+                        print(f"警告：文本分割后仍超过token限制：{str(e)}")
+                        return [None] * len(batch)
+                    # Token限制错误：降低token限制，逐个文本再分割后取平均，保持与输入对应
+                    new_max_tokens = self._shrink_token_limit()
+                    return [self._embed_oversized_text(text, new_max_tokens) for text in batch]
+                
+                # 其他错误（如速度限制），带抖动的指数退避后重试
+                retry_count += 1
+                if retry_count >= max_retry_times:
+                    print(f"错误：达到最大重试次数，使用零向量: {str(e)}")
+                    return [None] * len(batch)
+                _sleep_time *= 1.5
+                print(f"速度限制, 稍后重试[{retry_count}/{max_retry_times}]")
+                time.sleep(_sleep_time * random.uniform(0.5, 1.5))
+
+    def _embed_texts_concurrently(self, texts: List[str]) -> list:
+        """将文本分批并发嵌入，结果按输入顺序返回"""
+        batch_size = self.max_batch_size
+        batches = [(start, texts[start:start + batch_size]) for start in range(0, len(texts), batch_size)]
+        results = [None] * len(texts)
         
-        all_embeddings = []
+        if len(batches) == 1 or self.max_concurrency <= 1:
+            for start, batch in batches:
+                results[start:start + len(batch)] = self._embed_batch(batch)
+            return results
         
-        # 处理每个批次
-        for batch_idx, batch in enumerate(batches):
-            max_retry_times = 10
-            retry_count = 0
-            _sleep_time = 1
-            
-            while retry_count < max_retry_times:
+        # 同时保持 max_concurrency 个批次在途
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            futures = {executor.submit(self._embed_batch, batch): (start, len(batch)) for start, batch in batches}
+            for future in as_completed(futures):
+                start, size = futures[future]
                 try:
-                    # 发送请求
-                    response = self.client.embeddings.create(
-                        input=batch, 
-                        model=self.model_name, 
-                        encoding_format="float"
-                    )
-                    
-                    # 只记录第一次请求
-                    if not http_request_shown:
-                        # print(f'HTTP Request: POST {self.client.base_url}/embeddings "HTTP/1.1 200 OK"')
-                        http_request_shown = True
-                    
-                    # 提取嵌入
-                    batch_embeddings = [r.embedding for r in response.data]
-                    all_embeddings.extend(batch_embeddings)
-                    break
-                    
+                    results[start:start + size] = future.result()
                 except Exception as e:
-                    # 记录错误
-                    if "input must have less than 512 tokens" in str(e):
-                        # Token限制错误
-                        if not http_request_shown:
-                            # print(f'HTTP Request: POST {self.client.base_url}/embeddings "HTTP/1.1 413 Request Entity Too Large"')
-                            http_request_shown = True
-                        
-                        print(f"警告：输入超过{self.max_token_limit}个tokens限制，尝试进一步分割文本")
-                        
-                        # 进一步减少批次大小和token限制
-                        new_max_tokens = int(self.max_token_limit * 0.7)  # 更激进的减少
-                        sub_batches = []
-                        
-                        for text in batch:
-                            sub_chunks = self._split_text_by_token_limit(text, new_max_tokens)
-                            sub_batches.extend(sub_chunks)
-                        
-                        # 将大批次分成更小的批次
-                        sub_batch_size = max(1, self.max_batch_size // 2)  # 最小批次大小为1
-                        mini_batches = []
-                        
-                        for i in range(0, len(sub_batches), sub_batch_size):
-                            mini_batches.append(sub_batches[i:i + sub_batch_size])
-                        
-                        # 处理每个小批次
-                        for mini_batch in mini_batches:
-                            try:
-                                mini_response = self.client.embeddings.create(
-                                    input=mini_batch, 
-                                    model=self.model_name, 
-                                    encoding_format="float"
-                                )
-                                mini_embeddings = [r.embedding for r in mini_response.data]
-                                all_embeddings.extend(mini_embeddings)
-                            except Exception as mini_e:
-                                # 如果还有错误，使用零向量
-                                print(f"警告：处理小批次时出错：{str(mini_e)}")
-                                # 添加零向量
-                                if all_embeddings:
-                                    dim = len(all_embeddings[0])
-                                    for _ in range(len(mini_batch)):
-                                        all_embeddings.append([0.0] * dim)
-                                else:
-                                    # 默认维度
-                                    for _ in range(len(mini_batch)):
-                                        all_embeddings.append([0.0] * 1024)
-                        
-                        # 已经处理完这个批次
-                        break
-                        
-                    elif "maximum allowed batch size" in str(e):
-                        # 批处理大小错误
-                        if not http_request_shown:
-                            # print(f'HTTP Request: POST {self.client.base_url}/embeddings "HTTP/1.1 413 Request Entity Too Large"')
-                            http_request_shown = True
-                        
-                        print(f"警告：批处理大小超出限制，尝试减小批次")
-                        
-                        # 将批次分成两半
-                        half_size = len(batch) // 2
-                        first_half = batch[:half_size]
-                        second_half = batch[half_size:]
-                        
-                        # 处理第一半
-                        try:
-                            resp1 = self.client.embeddings.create(
-                                input=first_half, 
-                                model=self.model_name, 
-                                encoding_format="float"
-                            )
-                            emb1 = [r.embedding for r in resp1.data]
-                            all_embeddings.extend(emb1)
-                        except Exception as e1:
-                            print(f"警告：处理第一半批次时出错：{str(e1)}")
-                            # 添加零向量
-                            if all_embeddings:
-                                dim = len(all_embeddings[0])
-                                for _ in range(len(first_half)):
-                                    all_embeddings.append([0.0] * dim)
-                            else:
-                                # 默认维度
-                                for _ in range(len(first_half)):
-                                    all_embeddings.append([0.0] * 1024)
-                        
-                        # 处理第二半
-                        try:
-                            resp2 = self.client.embeddings.create(
-                                input=second_half, 
-                                model=self.model_name, 
-                                encoding_format="float"
-                            )
-                            emb2 = [r.embedding for r in resp2.data]
-                            all_embeddings.extend(emb2)
-                        except Exception as e2:
-                            print(f"警告：处理第二半批次时出错：{str(e2)}")
-                            # 添加零向量
-                            if all_embeddings:
-                                dim = len(all_embeddings[0])
-                                for _ in range(len(second_half)):
-                                    all_embeddings.append([0.0] * dim)
-                            else:
-                                # 默认维度
-                                for _ in range(len(second_half)):
-                                    all_embeddings.append([0.0] * 1024)
-                        
-                        # 已经处理完这个批次
-                        break
-                    
-                    else:
-                        # 其他错误，重试
-                        retry_count += 1
-                        _sleep_time *= 1.5
-                        print(f"速度限制, 稍后重试[{retry_count}/{max_retry_times}]")
-                        time.sleep(_sleep_time)
-                        
-                        # 如果最后一次重试仍然失败
-                        if retry_count == max_retry_times:
-                            print(f"错误：达到最大重试次数，使用零向量")
-                            # 添加零向量
-                            if all_embeddings:
-                                dim = len(all_embeddings[0])
-                                for _ in range(len(batch)):
-                                    all_embeddings.append([0.0] * dim)
-                            else:
-                                # 默认维度
-                                for _ in range(len(batch)):
-                                    all_embeddings.append([0.0] * 1024)
+                    print(f"警告：嵌入批次出错：{str(e)}")
+        return results
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """嵌入多个文档"""
+        # 首先处理所有文本，确保它们都在token限制内，并记录每个原始文本对应的片段数量
+        pieces_per_text = []
+        processed_texts = []
+        for text in texts:
+            pieces = self._prepare_text(text)
+            pieces_per_text.append(len(pieces))
+            processed_texts.extend(pieces)
         
-        # 确保返回的嵌入数量与原始文本数量一致
-        if len(all_embeddings) != len(texts):
-            # 如果嵌入数量不匹配，需要重新映射
-            # 这种情况是因为我们可能分割了某些文本
-            original_to_processed = {}
-            processed_idx = 0
-            
-            for i, text in enumerate(texts):
-                if self._get_chunk_size(text) > self.max_token_limit:
-                    # 对于被分割的文本，记录它对应的所有分割块
-                    chunks = self._split_text_by_token_limit(self.clear_text(text), self.max_token_limit)
-                    chunk_indices = list(range(processed_idx, processed_idx + len(chunks)))
-                    original_to_processed[i] = chunk_indices
-                    processed_idx += len(chunks)
-                else:
-                    # 对于未分割的文本，直接记录
-                    original_to_processed[i] = [processed_idx]
-                    processed_idx += 1
-            
-            # 创建最终的嵌入列表
-            final_embeddings = []
-            
-            for i in range(len(texts)):
-                if i in original_to_processed:
-                    # 获取原始文本对应的所有分割块的索引
-                    indices = original_to_processed[i]
-                    
-                    if len(indices) == 1:
-                        # 如果只有一个块，直接使用
-                        if indices[0] < len(all_embeddings):
-                            final_embeddings.append(all_embeddings[indices[0]])
-                        else:
-                            # 防止索引越界
-                            print(f"警告：索引 {indices[0]} 超出嵌入列表范围 {len(all_embeddings)}")
-                            if all_embeddings:
-                                final_embeddings.append([0.0] * len(all_embeddings[0]))
-                            else:
-                                final_embeddings.append([0.0] * 1024)
-                    else:
-                        # 如果有多个块，取平均值
-                        valid_indices = [idx for idx in indices if idx < len(all_embeddings)]
-                        
-                        if valid_indices:
-                            # 计算平均嵌入
-                            avg_embedding = np.mean([all_embeddings[idx] for idx in valid_indices], axis=0).tolist()
-                            final_embeddings.append(avg_embedding)
-                        else:
-                            # 没有有效索引
-                            print(f"警告：没有有效的嵌入索引")
-                            if all_embeddings:
-                                final_embeddings.append([0.0] * len(all_embeddings[0]))
-                            else:
-                                final_embeddings.append([0.0] * 1024)
-            
-            return final_embeddings
+        all_embeddings = self._embed_texts_concurrently(processed_texts)
         
-        return all_embeddings
+        # 失败的片段使用零向量
+        dim = next((len(v) for v in all_embeddings if v is not None), 1024)
+        all_embeddings = [v if v is not None else [0.0] * dim for v in all_embeddings]
+        
+        # 将片段映射回原始文本：未分割的直接使用，被分割的取平均值
+        final_embeddings = []
+        pos = 0
+        for count in pieces_per_text:
+            group = all_embeddings[pos:pos + count]
+            pos += count
+            if count == 1:
+                final_embeddings.append(group[0])
+            else:
+                final_embeddings.append(np.mean(group, axis=0).tolist())
+        
+        return final_embeddings
 
     def embed_query(self, text: str) -> List[float]:
         """嵌入单个查询"""
@@ -514,6 +598,7 @@ class OpenAIEmbedding(Embeddings):
                 embeddings = []
                 for chunk in chunks:
                     try:
+                        self._acquire_rate_limit([chunk])
                         response = self.client.embeddings.create(
                             input=[chunk], model=self.model_name, encoding_format="float"
                         )
@@ -540,6 +625,7 @@ class OpenAIEmbedding(Embeddings):
         
         # 一般情况，直接嵌入
         try:
+            self._acquire_rate_limit([text])
             response = self.client.embeddings.create(
                 input=[text], model=self.model_name, encoding_format="float"
             )
@@ -551,4 +637,28 @@ class OpenAIEmbedding(Embeddings):
         except Exception as e:
             print(f"嵌入查询时出错: {e}")
             # 出错时返回零向量
-            return [0.0] * 1024  # 使用默认维度
\ No newline at end of file
+            return [0.0] * 1024  # 使用默认维度
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """异步嵌入单个查询"""
+        text = self.clear_text(text)
+        if self._get_chunk_size(text) > self.max_token_limit:
+            # 超长查询需要分块嵌入，很少出现，放到线程中按同步方式处理
+            return await asyncio.to_thread(self.embed_query, text)
+
+        client = get_loop_bound_client(
+            _async_clients, (self.provider, self.client.api_key, str(self.client.base_url)),
+            lambda: AsyncOpenAI(api_key=self.client.api_key, base_url=self.client.base_url)
+        )
+        try:
+            if self.rate_limiter:
+                # 令牌桶等待会阻塞，放到线程中执行
+                await asyncio.to_thread(self._acquire_rate_limit, [text])
+            response = await client.embeddings.create(
+                input=[text], model=self.model_name, encoding_format="float"
+            )
+            return response.data[0].embedding
+        except Exception as e:
+            print(f"嵌入查询时出错: {e}")
+            # 出错时返回零向量
+            return [0.0] * 1024  # 使用默认维度
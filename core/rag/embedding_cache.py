@@ -0,0 +1,204 @@
+# core/rag/embedding_cache.py
+import os
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from typing import List, Dict, Iterable, Tuple
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+def text_hash(text: str) -> str:
+    """计算文本的SHA-256摘要，作为缓存的内容地址"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class EmbeddingCache:
+    """
+    基于SQLite的持久化嵌入缓存。
+    以 (provider, model_name, sha256(text)) 为键，向量以float32二进制存储，
+    知识库重建和查询共享同一份缓存。
+    """
+    # SQLite单条语句的参数数量有限，批量查询时分段执行
+    QUERY_CHUNK_SIZE = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._local = threading.local()
+        conn = self._get_conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " provider TEXT NOT NULL,"
+            " model_name TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " dim INTEGER NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " PRIMARY KEY (provider, model_name, text_hash)"
+            ") WITHOUT ROWID"
+        )
+        conn.commit()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        """每个线程使用独立连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, provider: str, model_name: str, hashes: Iterable[str]) -> Dict[str, List[float]]:
+        """批量读取向量，返回 {text_hash: vector}"""
+        hashes = list(dict.fromkeys(hashes))
+        found = {}
+        conn = self._get_conn()
+        for i in range(0, len(hashes), self.QUERY_CHUNK_SIZE):
+            chunk = hashes[i:i + self.QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT text_hash, vector FROM embeddings "
+                f"WHERE provider = ? AND model_name = ? AND text_hash IN ({placeholders})",
+                [provider, model_name, *chunk]
+            ).fetchall()
+            for h, blob in rows:
+                found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, provider: str, model_name: str, items: Iterable[Tuple[str, List[float]]]):
+        """批量写入向量"""
+        rows = []
+        for h, vector in items:
+            arr = np.asarray(vector, dtype=np.float32)
+            rows.append((provider, model_name, h, int(arr.shape[0]), arr.tobytes()))
+        if not rows:
+            return
+        conn = self._get_conn()
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (provider, model_name, text_hash, dim, vector) "
+            "VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        conn.commit()
+
+class CachedEmbeddings(Embeddings):
+    """为嵌入模型增加透明的持久化缓存，只对缓存中不存在的文本调用底层模型"""
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, provider: str, model_name: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.provider = provider
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # 其他属性（如 max_batch_size、client）转发给底层嵌入模型
+        embeddings = self.__dict__.get('embeddings')
+        if embeddings is None:
+            raise AttributeError(name)
+        return getattr(embeddings, name)
+
+    def _count(self, hits: int, misses: int):
+        with self._stats_lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    @staticmethod
+    def _is_valid(vector) -> bool:
+        # 底层模型出错时会返回零向量，这类结果不写入缓存
+        return bool(vector) and any(v != 0.0 for v in vector)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """嵌入多个文档，命中缓存的文本不再请求模型"""
+        hashes = [text_hash(text) for text in texts]
+        try:
+            cached = self.cache.get_many(self.provider, self.model_name, hashes)
+        except sqlite3.Error as e:
+            print(f"读取嵌入缓存出错: {e}")
+            cached = {}
+
+        # 去重后只嵌入缺失的文本
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in cached and h not in missing:
+                missing[h] = text
+
+        if missing:
+            missing_hashes = list(missing.keys())
+            vectors = self.embeddings.embed_documents([missing[h] for h in missing_hashes])
+            new_items = []
+            for h, vector in zip(missing_hashes, vectors):
+                cached[h] = vector
+                if self._is_valid(vector):
+                    new_items.append((h, vector))
+            try:
+                self.cache.put_many(self.provider, self.model_name, new_items)
+            except sqlite3.Error as e:
+                print(f"写入嵌入缓存出错: {e}")
+
+        hits = len(texts) - sum(1 for h in hashes if h in missing)
+        self._count(hits, len(texts) - hits)
+        if len(texts) > 1:
+            print(f"嵌入缓存命中 {hits}/{len(texts)}，需要请求模型 {len(missing)} 个文本")
+        return [cached[h] for h in hashes]
+
+    def _get_cached_query(self, h: str):
+        try:
+            cached = self.cache.get_many(self.provider, self.model_name, [h])
+        except sqlite3.Error as e:
+            print(f"读取嵌入缓存出错: {e}")
+            cached = {}
+        if h in cached:
+            self._count(1, 0)
+        return cached.get(h)
+
+    def _put_query(self, h: str, vector: List[float]):
+        self._count(0, 1)
+        if self._is_valid(vector):
+            try:
+                self.cache.put_many(self.provider, self.model_name, [(h, vector)])
+            except sqlite3.Error as e:
+                print(f"写入嵌入缓存出错: {e}")
+
+    def embed_query(self, text: str) -> List[float]:
+        """嵌入单个查询，重复问题直接使用缓存"""
+        h = text_hash(text)
+        vector = self._get_cached_query(h)
+        if vector is not None:
+            return vector
+
+        vector = self.embeddings.embed_query(text)
+        self._put_query(h, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """异步嵌入单个查询，缓存未命中时等待底层模型的异步接口；SQLite读写在线程中执行，不阻塞事件循环"""
+        h = text_hash(text)
+        vector = await asyncio.to_thread(self._get_cached_query, h)
+        if vector is not None:
+            return vector
+
+        vector = await self.embeddings.aembed_query(text)
+        await asyncio.to_thread(self._put_query, h, vector)
+        return vector
+
+_embedding_caches = {}
+_embedding_caches_lock = threading.Lock()
+
+def get_embedding_cache(path: str) -> EmbeddingCache:
+    """按路径共享缓存实例"""
+    with _embedding_caches_lock:
+        cache = _embedding_caches.get(path)
+        if cache is None:
+            cache = EmbeddingCache(path)
+            _embedding_caches[path] = cache
+        return cache
@@ -0,0 +1,403 @@
+# core/rag/faiss_index.py
+import os
+import json
+import time
+import math
+from typing import Dict, List, Optional
+import numpy as np
+import faiss
+
+# 支持的索引类型
+INDEX_FLAT = 'flat'
+INDEX_IVF_FLAT = 'ivf_flat'
+INDEX_IVF_PQ = 'ivf_pq'
+INDEX_HNSW = 'hnsw'
+INDEX_TYPES = [INDEX_FLAT, INDEX_IVF_FLAT, INDEX_IVF_PQ, INDEX_HNSW]
+
+# 需要训练的索引类型
+TRAINED_INDEX_TYPES = [INDEX_IVF_FLAT, INDEX_IVF_PQ]
+
+# k-means每个聚类中心至少需要的训练样本数（低于该值faiss会给出警告，聚类质量下降）
+MIN_POINTS_PER_CENTROID = 39
+
+DEFAULT_INDEX_PARAMS = {
+    'nlist': None,             # IVF聚类数，None表示按训练样本数自动选择
+    'pq_m': None,              # PQ子空间数，None表示自动选择能整除维度的值
+    'pq_nbits': 8,             # 每个子空间的编码位数
+    'hnsw_m': 32,              # HNSW每个节点的邻居数
+    'ef_construction': 200,    # HNSW构建时的搜索宽度
+    'train_size': 50000,       # 训练样本数上限
+}
+
+# 各索引类型可以设置的参数及其取值范围 (最小值, 最大值)，None表示不限
+INDEX_PARAM_RANGES = {
+    INDEX_FLAT: {},
+    INDEX_IVF_FLAT: {
+        'nlist': (1, 65536),
+        'train_size': (MIN_POINTS_PER_CENTROID, None),
+    },
+    INDEX_IVF_PQ: {
+        'nlist': (1, 65536),
+        'pq_m': (1, None),
+        'pq_nbits': (1, 16),
+        'train_size': (MIN_POINTS_PER_CENTROID, None),
+    },
+    INDEX_HNSW: {
+        'hnsw_m': (2, 256),
+        'ef_construction': (1, None),
+    },
+}
+
+def validate_index_params(index_type: str, index_params) -> Dict:
+    """
+    检查知识库的索引参数，返回去掉空值后的参数；参数名或取值不合法时抛出 ValueError。
+    只允许该索引类型使用的参数，取值必须是范围内的整数（None表示使用默认值）。
+    """
+    if index_params in (None, ''):
+        return {}
+    if not isinstance(index_params, dict):
+        raise ValueError("索引参数必须是JSON对象")
+    if index_type not in INDEX_PARAM_RANGES:
+        raise ValueError(f"未知的索引类型: {index_type}")
+
+    ranges = INDEX_PARAM_RANGES[index_type]
+    unknown = sorted(set(index_params) - set(ranges))
+    if unknown:
+        allowed = '、'.join(ranges) or '无'
+        raise ValueError(f"{index_type} 索引不支持参数 {'、'.join(unknown)}（可用参数: {allowed}）")
+
+    params = {}
+    for key, value in index_params.items():
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(f"参数 {key} 必须是整数")
+        low, high = ranges[key]
+        if value < low or (high is not None and value > high):
+            limit = f"{low} ~ {high}" if high is not None else f"不小于 {low}"
+            raise ValueError(f"参数 {key} 超出范围（{limit}）")
+        params[key] = value
+
+    # 每个聚类中心至少需要 MIN_POINTS_PER_CENTROID 个训练样本
+    if 'nlist' in params:
+        train_size = params.get('train_size', DEFAULT_INDEX_PARAMS['train_size'])
+        if params['nlist'] * MIN_POINTS_PER_CENTROID > train_size:
+            raise ValueError(
+                f"聚类数 nlist={params['nlist']} 过大，训练样本数 {train_size} "
+                f"最多支持 {train_size // MIN_POINTS_PER_CENTROID} 个聚类"
+            )
+    return params
+
+def get_index_params(index_params: Optional[Dict] = None) -> Dict:
+    """合并默认参数和知识库自定义参数"""
+    params = dict(DEFAULT_INDEX_PARAMS)
+    params.update({k: v for k, v in (index_params or {}).items() if v is not None})
+    return params
+
+def get_train_size(index_type: str, index_params: Optional[Dict] = None) -> int:
+    """构建索引前需要收集的训练样本数，不需要训练的索引返回0"""
+    if index_type not in TRAINED_INDEX_TYPES:
+        return 0
+    return int(get_index_params(index_params)['train_size'])
+
+def _choose_nlist(n: int, nlist: Optional[int]) -> int:
+    """选择IVF聚类数：默认约为 4*sqrt(n)，并保证每个聚类中心有足够的训练样本"""
+    if not nlist:
+        nlist = int(4 * math.sqrt(max(n, 1)))
+    return max(1, min(int(nlist), n // MIN_POINTS_PER_CENTROID))
+
+def _choose_pq_m(dim: int, pq_m: Optional[int]) -> int:
+    """选择PQ子空间数，必须能整除向量维度"""
+    if pq_m and dim % int(pq_m) == 0:
+        return int(pq_m)
+    if pq_m:
+        print(f"PQ子空间数 {pq_m} 不能整除向量维度 {dim}，将自动选择")
+    # 每个子空间约8维
+    for m in range(max(1, dim // 8), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+def create_index(index_type: str, dim: int, train_vectors: Optional[np.ndarray] = None,
+                 index_params: Optional[Dict] = None) -> faiss.Index:
+    """
+    创建（并训练）FAISS索引。
+    训练样本不足以支撑所选索引类型时退化为精确的Flat索引。
+    """
+    params = get_index_params(index_params)
+    if index_type not in INDEX_TYPES:
+        print(f"未知的索引类型 {index_type}，使用 {INDEX_FLAT}")
+        index_type = INDEX_FLAT
+
+    if index_type == INDEX_HNSW:
+        index = faiss.IndexHNSWFlat(dim, int(params['hnsw_m']))
+        index.hnsw.efConstruction = int(params['ef_construction'])
+        return index
+
+    if index_type in TRAINED_INDEX_TYPES:
+        n = 0 if train_vectors is None else len(train_vectors)
+        nlist = _choose_nlist(n, params['nlist'])
+        nbits = int(params['pq_nbits'])
+        if n < MIN_POINTS_PER_CENTROID or (index_type == INDEX_IVF_PQ and n < (1 << nbits) * 4):
+            print(f"训练样本数 {n} 不足以训练 {index_type} 索引，使用 {INDEX_FLAT}")
+            return faiss.IndexFlatL2(dim)
+
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == INDEX_IVF_FLAT:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            pq_m = _choose_pq_m(dim, params['pq_m'])
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, nbits)
+
+        start_time = time.time()
+        index.train(np.ascontiguousarray(train_vectors, dtype=np.float32))
+        print(f"{index_type} 索引训练完成: nlist={nlist}, 样本数={n}, 耗时 {time.time() - start_time:.2f}秒")
+        return index
+
+    return faiss.IndexFlatL2(dim)
+
+def get_index_type(index: faiss.Index) -> str:
+    """根据已加载的索引判断其类型"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return INDEX_HNSW
+    if isinstance(index, faiss.IndexIVFPQ):
+        return INDEX_IVF_PQ
+    if isinstance(index, faiss.IndexIVF):
+        return INDEX_IVF_FLAT
+    return INDEX_FLAT
+
+def apply_search_params(index: faiss.Index, faiss_params: Optional[Dict] = None):
+    """
+    设置查询参数：
+      nprobe: IVF索引每次查询访问的聚类数
+      efSearch: HNSW索引查询时的搜索宽度
+    """
+    faiss_params = faiss_params or {}
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        nprobe = faiss_params.get('nprobe')
+        if nprobe:
+            index.nprobe = min(int(nprobe), index.nlist)
+    elif isinstance(index, faiss.IndexHNSW):
+        ef_search = faiss_params.get('efSearch')
+        if ef_search:
+            index.hnsw.efSearch = int(ef_search)
+
+def read_index_mmap(path: str) -> faiss.Index:
+    """
+    以只读mmap方式读取索引。
+    IO_FLAG_MMAP 只对IVF索引的倒排表生效；Flat/HNSW的向量存储需要 IO_FLAG_MMAP_IFC，
+    当前依赖的 faiss-cpu 1.10.0 没有该选项，这两种索引仍会完整读入每个进程的私有内存（会打印警告）。
+    两种方式都失败时回退为常规读取。
+    """
+    read_only = getattr(faiss, 'IO_FLAG_READ_ONLY', 0)
+    has_mmap_ifc = hasattr(faiss, 'IO_FLAG_MMAP_IFC')
+    flag_options = []
+    if has_mmap_ifc:
+        flag_options.append(faiss.IO_FLAG_MMAP | faiss.IO_FLAG_MMAP_IFC | read_only)
+    flag_options.append(faiss.IO_FLAG_MMAP | read_only)
+
+    for flags in flag_options:
+        try:
+            index = faiss.read_index(path, flags)
+        except RuntimeError:
+            continue
+        if not (has_mmap_ifc and flags & faiss.IO_FLAG_MMAP_IFC) and get_index_type(index) in (INDEX_FLAT, INDEX_HNSW):
+            print(f"警告: 当前faiss不支持 IO_FLAG_MMAP_IFC，{get_index_type(index)} 索引的向量已读入进程内存，"
+                  f"多个进程之间不共享: {path}")
+        return index
+    print(f"无法以mmap方式读取索引，使用常规方式: {path}")
+    return faiss.read_index(path)
+
+def remove_rows(index: faiss.Index, rows: np.ndarray) -> faiss.Index:
+    """
+    从索引中删除指定位置的向量，剩余向量按原顺序重新编号为 0..n-1（与文本块存储的行号一致）。
+      Flat: remove_ids 本身会压缩编号
+      IVF: remove_ids 后按删除前后的位置映射改写倒排表中的id
+      HNSW: 不支持删除，用保留的原始向量重建
+    返回修改后的索引（HNSW为新索引）。
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+        return index
+    ntotal = index.ntotal
+    keep = np.ones(ntotal, dtype=bool)
+    keep[rows] = False
+    # downcast得到的对象不持有底层索引，操作期间需保留原对象的引用
+    typed_index = faiss.downcast_index(index)
+
+    if isinstance(typed_index, faiss.IndexHNSW):
+        vectors = index.reconstruct_n(0, ntotal)[keep]
+        new_index = faiss.IndexHNSWFlat(index.d, typed_index.hnsw.nb_neighbors(1))
+        new_index.hnsw.efConstruction = typed_index.hnsw.efConstruction
+        new_index.hnsw.efSearch = typed_index.hnsw.efSearch
+        if len(vectors):
+            new_index.add(vectors)
+        return new_index
+
+    index.remove_ids(faiss.IDSelectorBatch(rows))
+
+    if isinstance(typed_index, faiss.IndexIVF):
+        # 旧编号 -> 新编号
+        new_ids = np.cumsum(keep) - 1
+        invlists = typed_index.invlists
+        for list_no in range(typed_index.nlist):
+            size = invlists.list_size(list_no)
+            if size == 0:
+                continue
+            ids = faiss.rev_swig_ptr(invlists.get_ids(list_no), size)
+            remapped = np.ascontiguousarray(new_ids[ids], dtype=np.int64)
+            codes = faiss.rev_swig_ptr(invlists.get_codes(list_no), size * invlists.code_size).copy()
+            invlists.update_entries(list_no, 0, size, faiss.swig_ptr(remapped), faiss.swig_ptr(codes))
+        typed_index.make_direct_map(False)
+    return index
+
+# 过滤后选中的向量不超过该数量时，HNSW索引直接在这些向量上精确计算距离（图搜索在很小的子集上召回率很低）
+EXACT_SUBSET_SIZE = 4096
+
+def _exact_subset_search(index: faiss.Index, vectors: np.ndarray, k: int, bitmap: np.ndarray):
+    """在位图选中的向量上精确检索，返回的id为在原索引中的位置"""
+    rows = np.flatnonzero(np.unpackbits(bitmap, count=index.ntotal, bitorder='little'))
+    subset = faiss.IndexFlat(index.d, index.metric_type)
+    if len(rows):
+        subset.add(index.reconstruct_batch(rows))
+    distances, indices = subset.search(vectors, k)
+    return distances, np.where(indices >= 0, rows[np.maximum(indices, 0)], -1)
+
+def filtered_search(index: faiss.Index, vectors: np.ndarray, k: int, bitmap: np.ndarray, count: int):
+    """
+    只在位图选中的向量中检索（bitmap 为 np.packbits(选中标记, bitorder='little')，count 为选中数量），
+    返回与 index.search 相同的 (distances, indices)：
+      Flat: IDSelectorBitmap 跳过未选中的向量，结果精确
+      IVF: 按选中比例放大 nprobe，访问到的选中向量数与不过滤时相当
+      HNSW: 选中的向量较少时直接精确计算，否则按选中比例放大 efSearch
+    """
+    typed_index = faiss.downcast_index(index)
+    fraction = max(count, 1) / max(index.ntotal, 1)
+    selector = faiss.IDSelectorBitmap(index.ntotal, faiss.swig_ptr(bitmap))
+    if isinstance(typed_index, faiss.IndexIVF):
+        nprobe = min(typed_index.nlist, math.ceil(typed_index.nprobe / fraction))
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+    elif isinstance(typed_index, faiss.IndexHNSW):
+        if count <= EXACT_SUBSET_SIZE:
+            return _exact_subset_search(index, vectors, k, bitmap)
+        ef_search = min(index.ntotal, math.ceil(max(typed_index.hnsw.efSearch, k) / fraction))
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return index.search(vectors, k, params=params)
+
+def estimate_index_bytes(index: faiss.Index) -> int:
+    """估算索引占用的内存（字节）"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        # 向量存储 + 每层邻居表（底层2M个邻居，每个int32）
+        return index.ntotal * (index.d * 4 + index.hnsw.nb_neighbors(0) * 4 + 16)
+    if isinstance(index, faiss.IndexIVF):
+        # 编码 + 每条记录的id（int64） + 聚类中心
+        return index.ntotal * (index.code_size + 8) + index.nlist * index.d * 4
+    return index.ntotal * index.d * 4
+
+class GroundTruthTracker:
+    """
+    在流式构建过程中计算查询样本的精确top-k，用于评估近似索引的召回率。
+    只保存查询向量和当前top-k，不需要额外保存全部向量。
+    """
+    def __init__(self, num_queries: int = 100, k: int = 10, seed: int = 0):
+        self.num_queries = num_queries
+        self.k = k
+        self.seed = seed
+        self.queries = None
+        self.distances = None
+        self.ids = None
+        self.ntotal = 0
+
+    def update(self, vectors: np.ndarray):
+        """追加一批向量（id按添加顺序递增），更新查询样本的精确top-k"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return
+        if self.queries is None:
+            # 从最先到达的向量（训练样本或第一批）中抽取查询样本
+            rng = np.random.default_rng(self.seed)
+            size = min(self.num_queries, len(vectors))
+            self.queries = vectors[rng.choice(len(vectors), size=size, replace=False)].copy()
+            self.distances = np.full((size, 0), np.inf, dtype=np.float32)
+            self.ids = np.zeros((size, 0), dtype=np.int64)
+
+        distances, ids = faiss.knn(self.queries, vectors, min(self.k, len(vectors)))
+        ids = ids + self.ntotal
+        self.ntotal += len(vectors)
+
+        distances = np.hstack([self.distances, distances])
+        ids = np.hstack([self.ids, ids])
+        order = np.argsort(distances, axis=1)[:, :self.k]
+        self.distances = np.take_along_axis(distances, order, axis=1)
+        self.ids = np.take_along_axis(ids, order, axis=1)
+
+def _sweep_values(index_type: str, index: faiss.Index) -> List[Optional[int]]:
+    """报告中需要测试的查询参数取值"""
+    if index_type in TRAINED_INDEX_TYPES:
+        nlist = faiss.downcast_index(index).nlist
+        return [v for v in [1, 2, 4, 8, 16, 32, 64, 128, 256] if v <= nlist]
+    if index_type == INDEX_HNSW:
+        return [16, 32, 64, 128, 256]
+    return [None]
+
+def build_recall_report(index: faiss.Index, tracker: GroundTruthTracker,
+                        faiss_params: Optional[Dict] = None) -> Dict:
+    """
+    对比近似索引与精确结果，生成不同 nprobe/efSearch 下的召回率和查询延迟。
+    测试完成后恢复 faiss_params 中配置的查询参数。
+    """
+    index_type = get_index_type(index)
+    report = {
+        'index_type': index_type,
+        'ntotal': int(index.ntotal),
+        'dim': int(index.d),
+        'memory_bytes': int(estimate_index_bytes(index)),
+        'k': tracker.k,
+        'num_queries': 0 if tracker.queries is None else int(len(tracker.queries)),
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'results': [],
+    }
+    if tracker.queries is None or tracker.ntotal != index.ntotal:
+        print("召回率报告跳过：精确结果与索引数据不一致")
+        return report
+
+    param_name = {INDEX_HNSW: 'efSearch'}.get(index_type, 'nprobe' if index_type in TRAINED_INDEX_TYPES else None)
+    k = tracker.ids.shape[1]
+    for value in _sweep_values(index_type, index):
+        if param_name:
+            apply_search_params(index, {param_name: value})
+        start_time = time.perf_counter()
+        _, ids = index.search(tracker.queries, k)
+        elapsed = time.perf_counter() - start_time
+
+        hits = sum(len(set(found) & set(expected)) for found, expected in zip(ids.tolist(), tracker.ids.tolist()))
+        report['results'].append({
+            'param': param_name,
+            'value': value,
+            'recall': round(hits / (len(ids) * k), 4),
+            'latency_ms': round(elapsed * 1000 / len(ids), 4),
+        })
+
+    # 恢复配置中的查询参数
+    apply_search_params(index, faiss_params)
+    return report
+
+def get_report_path(db_vector_path: str, index_name: str) -> str:
+    """召回率报告路径，与索引文件放在一起"""
+    return os.path.join(db_vector_path, f"{index_name}.report.json")
+
+def save_recall_report(report: Dict, db_vector_path: str, index_name: str) -> str:
+    """保存召回率报告并打印摘要"""
+    report_path = get_report_path(db_vector_path, index_name)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    for row in report['results']:
+        param = f"{row['param']}={row['value']}" if row['param'] else '精确检索'
+        print(f"  {param}: recall@{report['k']}={row['recall']}, 延迟 {row['latency_ms']}ms/查询")
+    print(f"召回率报告已保存: {report_path}")
+    return report_path
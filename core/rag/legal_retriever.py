@@ -1,4 +1,5 @@
 import os
+import hashlib
 import json
 import re
 from typing import List, Dict, Any, Optional
@@ -10,8 +11,34 @@ class LegalRetriever:
     def __init__(self, db_vector_path):
         self.index_dir = os.path.join(db_vector_path, "law_structure")
         os.makedirs(self.index_dir, exist_ok=True)
+        self._signature = self._get_signature()
         self.law_indices = self._load_indices()
 
+    def _get_signature(self):
+        """获取法律结构目录的签名（文件名、修改时间和大小）"""
+        try:
+            entries = []
+            with os.scandir(self.index_dir) as it:
+                for entry in it:
+                    if entry.name.endswith('.json'):
+                        stat = entry.stat()
+                        entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+            return tuple(sorted(entries))
+        except OSError:
+            return ()
+
+    @property
+    def generation(self) -> str:
+        """法律结构的版本标识，用于检索缓存键"""
+        return hashlib.md5(repr(self._signature).encode('utf-8')).hexdigest()[:12]
+
+    def reload_if_changed(self):
+        """法律结构文件新增、修改或删除后重新加载索引"""
+        signature = self._get_signature()
+        if signature != self._signature:
+            self._signature = signature
+            self.law_indices = self._load_indices()
+
     def _load_indices(self) -> Dict:
         """加载所有法律结构索引并进行增强"""
         indices = {}
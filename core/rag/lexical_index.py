@@ -0,0 +1,236 @@
+# core/rag/lexical_index.py
+"""
+文本块的BM25倒排索引（{index_name}.lexical），与FAISS索引一起生成，用于精确词语和法律条款编号的检索。
+分词：中文按相邻两字（字二元组）切分，单独的汉字保留单字；英文单词和数字整体作为一个词；
+“第X条”“第X章”等条款编号整体作为一个词，查找某一条只需要读取一个倒排表。
+倒排表按CSR格式存储并通过mmap读取：
+  terms.npy    词的64位哈希（排序后）
+  offsets.npy  每个词的倒排表在 rows/weights 中的起止位置
+  rows.npy     文本块位置（与FAISS索引中的位置一致）
+  weights.npy  预先计算好的BM25权重（idf * 词频饱和项）
+"""
+import os
+import re
+import json
+import shutil
+import hashlib
+from array import array
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+import numpy as np
+from django.conf import settings
+from core.rag.chunk_store import ChunkStore, get_chunk_store_path
+
+LEXICAL_INDEX_VERSION = 1
+
+REFERENCE_RE = re.compile(r'第[零〇一二两三四五六七八九十百千万0-9]+[编章节条款项]')
+WORD_RE = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[a-z0-9]+')
+MAX_TOKEN_CHARS = 32
+
+def get_lexical_config():
+    """读取 RAG_CONFIGS['lexical']"""
+    config = getattr(settings, 'RAG_CONFIGS', {}).get('lexical', {})
+    return {
+        'enabled': bool(config.get('enabled', True)),
+        'k1': float(config.get('k1', 1.2)),
+        'b': float(config.get('b', 0.75)),
+        'top_k': int(config.get('top_k', 20)),
+        'rrf_k': int(config.get('rrf_k', 60)),
+    }
+
+def get_lexical_index_path(db_vector_path: str, index_name: str) -> str:
+    """BM25索引目录，与 .faiss 文件和文本块存储放在一起"""
+    return os.path.join(db_vector_path, f"{index_name}.lexical")
+
+def tokenize(text: str) -> List[str]:
+    """把文本切分为检索词（条款编号、中文字二元组、英文单词和数字）"""
+    text = (text or '').lower()
+    tokens = REFERENCE_RE.findall(text)
+    for match in WORD_RE.finditer(text):
+        word = match.group()
+        if word[0] < '\u0080':
+            tokens.append(word[:MAX_TOKEN_CHARS])
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+def _term_hash(term: str) -> int:
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def write_lexical_index(path: str, texts: Iterable[str], k1=1.2, b=0.75) -> int:
+    """
+    为文本块建立BM25倒排索引并写入 path，返回文本块数量。
+    第i个文本对应FAISS索引中的第i个向量。先写入临时目录再替换，读取方不会看到写了一半的数据。
+    """
+    term_ids = {}
+    # 所有 (词, 文本块, 词频) 三元组，用紧凑数组保存
+    posting_terms, posting_rows, posting_tfs = array('i'), array('i'), array('i')
+    lengths = array('i')
+    for row, text in enumerate(texts):
+        counts = Counter(tokenize(text))
+        lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+            posting_rows.append(row)
+            posting_tfs.append(tf)
+
+    count = len(lengths)
+    lengths = np.frombuffer(lengths, dtype=np.intc).astype(np.float32)
+    terms = np.frombuffer(posting_terms, dtype=np.intc)
+    rows = np.frombuffer(posting_rows, dtype=np.intc).astype(np.int32)
+    tfs = np.frombuffer(posting_tfs, dtype=np.intc).astype(np.float32)
+
+    # 词按哈希排序，同一个词的倒排表按文本块位置排列
+    hashes = np.fromiter((_term_hash(term) for term in term_ids), dtype=np.uint64, count=len(term_ids))
+    term_order = np.argsort(hashes, kind='stable')
+    term_rank = np.empty_like(term_order)
+    term_rank[term_order] = np.arange(len(term_order))
+    keys = term_rank[terms]
+    order = np.argsort(keys, kind='stable')
+    keys, rows, tfs = keys[order], rows[order], tfs[order]
+
+    df = np.bincount(keys, minlength=len(term_ids))
+    offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+    np.cumsum(df, out=offsets[1:])
+    avgdl = float(lengths.mean()) if count and lengths.sum() else 1.0
+    idf = np.log1p((count - df + 0.5) / (df + 0.5))
+    norm = k1 * (1 - b + b * lengths[rows] / avgdl)
+    weights = (idf[keys] * tfs * (k1 + 1) / (tfs + norm)).astype(np.float32)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, 'terms.npy'), hashes[term_order])
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmp_path, 'rows.npy'), rows)
+    np.save(os.path.join(tmp_path, 'weights.npy'), weights)
+    with open(os.path.join(tmp_path, 'info.json'), 'w', encoding='utf-8') as f:
+        json.dump({'version': LEXICAL_INDEX_VERSION, 'count': count, 'k1': k1, 'b': b, 'avgdl': avgdl}, f)
+
+    # 目录不能原子覆盖，先移走旧目录再替换
+    old_path = f"{path}.{os.getpid()}.old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return count
+
+class LexicalIndex:
+    """只读的BM25倒排索引，查询时对每个检索词做一次二分查找，再用一次 bincount 累加分数"""
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'info.json'), encoding='utf-8') as f:
+            self.info = json.load(f)
+        self.terms = np.load(os.path.join(path, 'terms.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.rows = np.load(os.path.join(path, 'rows.npy'), mmap_mode='r')
+        self.weights = np.load(os.path.join(path, 'weights.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return self.info['count']
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """词的倒排表：(文本块位置, BM25权重)，词不存在时为两个空数组"""
+        key = np.uint64(_term_hash(term))
+        i = int(np.searchsorted(self.terms, key))
+        if i < len(self.terms) and self.terms[i] == key:
+            start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+            return self.rows[start:end], self.weights[start:end]
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+    def search(self, query: str, k=20, required_terms=None, bitmap=None) -> List[Tuple[int, float]]:
+        """
+        返回BM25分数最高的 k 个 (文本块位置, 分数)。
+        required_terms 中的词（如“第十二条”）必须全部出现在文本块中；
+        bitmap 为元数据位图（np.packbits(..., bitorder='little')），只返回选中的文本块。
+        """
+        if not len(self):
+            return []
+        candidates = None
+        for term in required_terms or []:
+            rows = self.postings(term)[0]
+            candidates = rows if candidates is None else np.intersect1d(candidates, rows, assume_unique=True)
+            if not len(candidates):
+                return []
+
+        row_parts, weight_parts = [], []
+        for term, qtf in Counter(tokenize(query)).items():
+            rows, weights = self.postings(term)
+            if len(rows):
+                row_parts.append(rows)
+                weight_parts.append(weights * qtf if qtf > 1 else weights)
+        if row_parts:
+            scores = np.bincount(np.concatenate(row_parts), weights=np.concatenate(weight_parts),
+                                 minlength=len(self))
+        else:
+            scores = np.zeros(len(self))
+
+        if candidates is None:
+            candidates = np.flatnonzero(scores)
+        if bitmap is not None:
+            allowed = np.unpackbits(bitmap, count=len(self), bitorder='little').astype(bool)
+            candidates = candidates[allowed[candidates]]
+        candidate_scores = scores[candidates]
+        if k < len(candidates):
+            top = np.argpartition(-candidate_scores, k)[:k]
+            candidates, candidate_scores = candidates[top], candidate_scores[top]
+        order = np.argsort(-candidate_scores, kind='stable')
+        return [(int(candidates[i]), float(candidate_scores[i])) for i in order]
+
+    def nbytes(self) -> int:
+        """索引文件的总大小（字节）"""
+        return sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path))
+
+    @classmethod
+    def exists(cls, path: str, count: Optional[int] = None) -> bool:
+        """索引存在、为当前版本，且（指定 count 时）文本块数量一致"""
+        try:
+            with open(os.path.join(path, 'info.json'), encoding='utf-8') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return info.get('version') == LEXICAL_INDEX_VERSION and (count is None or info.get('count') == count)
+
+def build_lexical_index(db_vector_path: str, index_name: str) -> Optional[int]:
+    """从文本块存储重建BM25索引，返回文本块数量；未启用或文本块存储不存在时返回 None"""
+    config = get_lexical_config()
+    store_path = get_chunk_store_path(db_vector_path, index_name)
+    if not config['enabled'] or not ChunkStore.exists(store_path):
+        return None
+    store = ChunkStore(store_path)
+    return write_lexical_index(
+        get_lexical_index_path(db_vector_path, index_name),
+        (store.get_text(i) for i in range(len(store))),
+        k1=config['k1'], b=config['b'],
+    )
+
+def load_lexical_index(db_vector_path: str, index_name: str, count: int) -> Optional[LexicalIndex]:
+    """
+    加载BM25索引。索引不存在或与FAISS索引数量不一致时（旧知识库、中途保存的检查点）先从文本块存储重建。
+    未启用或无法建立时返回 None，检索只使用向量索引。
+    """
+    if not get_lexical_config()['enabled']:
+        return None
+    path = get_lexical_index_path(db_vector_path, index_name)
+    if not LexicalIndex.exists(path, count):
+        print(f"BM25索引不存在或已过期，从文本块存储重建: {index_name}")
+        if build_lexical_index(db_vector_path, index_name) != count:
+            return None
+    return LexicalIndex(path)
+
+def reciprocal_rank_fusion(ranked_lists, key, k=60) -> list:
+    """
+    倒数排名融合（RRF）：每个结果在各列表中的得分为 1 / (k + 名次)，累加后从高到低排序。
+    key 用于判断不同列表中的结果是否相同，返回 [(结果, 分数)]，相同结果保留最先出现的对象。
+    """
+    items = {}
+    scores = Counter()
+    for ranked in ranked_lists:
+        for rank, item in enumerate(ranked, start=1):
+            item_key = key(item)
+            items.setdefault(item_key, item)
+            scores[item_key] += 1.0 / (k + rank)
+    return [(items[item_key], score) for item_key, score in scores.most_common()]
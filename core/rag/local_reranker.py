@@ -0,0 +1,134 @@
+# core/rag/local_reranker.py
+"""
+本地CPU交叉编码器重排序（bge-reranker 等），使用 ONNX Runtime 推理，不需要请求远程接口。
+需要安装 onnxruntime 和 tokenizers；模型目录中放导出的 model.onnx 和 tokenizer.json，
+例如用 optimum 导出：optimum-cli export onnx --model BAAI/bge-reranker-v2-m3 --task text-classification <目录>
+"""
+import importlib.util
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from core.rag.reranker import BaseReranker
+
+REQUIRED_PACKAGES = ('onnxruntime', 'tokenizers')
+
+def check_dependencies():
+    """返回缺少的依赖包，不导入它们"""
+    return [name for name in REQUIRED_PACKAGES if importlib.util.find_spec(name) is None]
+
+def quantize_model(model_file, quantized_file):
+    """动态int8量化（权重量化为int8，激活在推理时量化），先写临时文件再替换，多个进程同时量化也不会读到半个文件"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    tmp_file = f"{quantized_file}.{os.getpid()}.tmp"
+    quantize_dynamic(model_file, tmp_file, weight_type=QuantType.QInt8)
+    os.replace(tmp_file, quantized_file)
+
+class LocalCrossEncoderReranker(BaseReranker):
+    """
+    本地交叉编码器重排序器。
+    - 模型在首次打分时加载；quantize 为 True 时使用（必要时生成）int8量化模型 model_int8.onnx
+    - 查询-文档对按token长度排序后分成 batch_size 大小的微批次，每个批次只填充到批次内最长的长度
+    - 微批次在线程池中并行推理（ONNX Runtime 的 run 可以多线程调用），每次推理使用 num_threads 个线程
+    """
+    def __init__(self, model_name, model_path, onnx_file='model.onnx', quantize=True, max_length=512,
+                 batch_size=8, num_threads=0, max_concurrency=2, cache_size=10000, cache_ttl=3600):
+        super().__init__(model_name, cache_size=cache_size, cache_ttl=cache_ttl)
+        self.model_path = model_path
+        self.onnx_file = onnx_file
+        self.quantize = bool(quantize)
+        self.max_length = int(max_length)
+        self.batch_size = max(1, int(batch_size))
+        self.num_threads = int(num_threads)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self._session = None
+        self._tokenizer = None
+        self._input_names = ()
+        self._pad_id = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='local-rerank')
+        self._load_lock = threading.Lock()
+
+    def _get_model_file(self):
+        model_file = os.path.join(self.model_path, self.onnx_file)
+        if not self.quantize:
+            return model_file
+        quantized_file = os.path.join(self.model_path, f"{os.path.splitext(self.onnx_file)[0]}_int8.onnx")
+        if not os.path.exists(quantized_file):
+            print(f"生成int8量化重排序模型: {quantized_file}")
+            try:
+                quantize_model(model_file, quantized_file)
+            except Exception as e:
+                print(f"量化重排序模型失败，使用原始模型: {e}")
+                return model_file
+        return quantized_file
+
+    def _load(self):
+        """加载ONNX模型和分词器（只加载一次）"""
+        if self._session is not None:
+            return
+        with self._load_lock:
+            if self._session is not None:
+                return
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+
+            tokenizer = Tokenizer.from_file(os.path.join(self.model_path, 'tokenizer.json'))
+            # 先读取模型配置的填充符，再关闭填充：只截断不填充，填充在每个微批次内按需进行
+            padding = tokenizer.padding or {}
+            pad_id = padding.get('pad_id')
+            tokenizer.enable_truncation(max_length=self.max_length)
+            tokenizer.no_padding()
+            if pad_id is None:
+                pad_id = next((tokenizer.token_to_id(t) for t in ('<pad>', '[PAD]')
+                               if tokenizer.token_to_id(t) is not None), 0)
+
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if self.num_threads > 0:
+                options.intra_op_num_threads = self.num_threads
+            model_file = self._get_model_file()
+            session = ort.InferenceSession(model_file, sess_options=options, providers=['CPUExecutionProvider'])
+            print(f"本地重排序模型已加载: {model_file}")
+
+            self._tokenizer = tokenizer
+            self._pad_id = pad_id
+            self._input_names = tuple(i.name for i in session.get_inputs())
+            self._session = session
+
+    def _batch_inputs(self, encodings):
+        """把一个微批次的编码填充到批次内最长的长度"""
+        length = max(len(e.ids) for e in encodings)
+        input_ids = np.full((len(encodings), length), self._pad_id, dtype=np.int64)
+        attention_mask = np.zeros((len(encodings), length), dtype=np.int64)
+        token_type_ids = np.zeros((len(encodings), length), dtype=np.int64)
+        for row, encoding in enumerate(encodings):
+            n = len(encoding.ids)
+            input_ids[row, :n] = encoding.ids
+            attention_mask[row, :n] = encoding.attention_mask
+            token_type_ids[row, :n] = encoding.type_ids
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask, 'token_type_ids': token_type_ids}
+        return {name: inputs[name] for name in self._input_names if name in inputs}
+
+    def _run_batch(self, encodings):
+        logits = self._session.run(None, self._batch_inputs(encodings))[0]
+        logits = np.asarray(logits, dtype=np.float32)
+        if logits.ndim == 2 and logits.shape[1] > 1:
+            # 二分类输出取“相关”类别的概率
+            exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+            return (exp[:, 1] / exp.sum(axis=1)).tolist()
+        # 单个logit输出与接口一致，用sigmoid归一化到0~1
+        return (1.0 / (1.0 + np.exp(-logits.reshape(-1)))).tolist()
+
+    def _score(self, query, docs, timeout=None) -> list[float]:
+        self._load()
+        encodings = self._tokenizer.encode_batch([(query, doc) for doc in docs])
+        # 按长度排序后分批，同一批次的长度接近，填充最少
+        order = sorted(range(len(encodings)), key=lambda i: len(encodings[i].ids))
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        results = self._executor.map(lambda batch: self._run_batch([encodings[i] for i in batch]), batches)
+
+        scores = [0.0] * len(docs)
+        for batch, batch_scores in zip(batches, results):
+            for i, score in zip(batch, batch_scores):
+                scores[i] = score
+        return scores
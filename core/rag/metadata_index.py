@@ -0,0 +1,136 @@
+# core/rag/metadata_index.py
+"""
+文本块元数据的位图索引，检索时把法律名称、通过年份、会议和内容类型过滤下推到FAISS（IDSelectorBitmap），
+只在满足条件的文本块中检索，而不是检索全部后再过滤。
+位图为 np.packbits(选中标记, bitorder='little')，第i位对应FAISS索引中的第i个向量：
+  法律名称、内容类型  来自文本块存储的字典编码列
+  通过年份、会议      按法律计算（来自每部法律的头部块），选中该法律的全部文本块
+位图在首次使用时计算并缓存。
+"""
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import numpy as np
+from core.rag.chunk_store import ChunkStore
+from core.rag.text_splitters.law_splitter import extract_law_metadata
+
+def get_law_header_info(metadata: dict) -> Tuple[List[str], List[str]]:
+    """
+    从文本块元数据中读取法律的通过日期和会议（含修正的会议），返回 (日期列表, 会议列表)。
+    支持法律头部块的 passed_date/meetings 字段和 law_header 结构。
+    """
+    law_header = metadata.get("law_header") or {}
+    adoption = law_header.get("adoption") or {}
+    dates = [adoption.get("date"), metadata.get("passed_date")]
+    meetings = [adoption.get("meeting")]
+    meetings.extend(amendment.get("meeting") for amendment in law_header.get("amendments") or [])
+    meetings.extend(metadata.get("meetings") or [])
+    return [d for d in dates if d], [m for m in meetings if m]
+
+class MetadataIndex:
+    """文本块元数据的位图索引（只读，与加载它的RAG服务共享生命周期）"""
+    def __init__(self, store: ChunkStore, max_cached=64):
+        self.size = len(store)
+        codes, self.law_values = store.get_column('law_name')
+        self.law_codes = np.asarray(codes)
+        codes, self.type_values = store.get_column('content_type')
+        self.type_codes = np.asarray(codes)
+
+        # 每部法律的通过日期和会议，来自该法律的头部块
+        # （较早生成的头部块元数据可能没有通过日期，再从头部文本中提取一次）
+        self.law_info = {}
+        if 'header' in self.type_values:
+            for row in np.flatnonzero(self.type_codes == self.type_values.index('header')):
+                metadata = store.get_metadata(int(row))
+                if not metadata.get('law_name'):
+                    continue
+                if not metadata.get('passed_date'):
+                    metadata = dict(metadata, **extract_law_metadata(store.get_text(int(row))))
+                dates, meetings = get_law_header_info(metadata)
+                info = self.law_info.setdefault(metadata['law_name'], ([], []))
+                info[0].extend(dates)
+                info[1].extend(meetings)
+
+        self.max_cached = max_cached
+        self._bitmaps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_law_info(self, law_name: Optional[str]) -> Tuple[List[str], List[str]]:
+        """法律的 (通过日期列表, 会议列表)，没有头部信息时为空"""
+        return self.law_info.get(law_name or '', ([], []))
+
+    def count(self, bitmap: np.ndarray) -> int:
+        return int(np.count_nonzero(np.unpackbits(bitmap, count=self.size, bitorder='little')))
+
+    def _cached(self, key, build):
+        with self._lock:
+            bitmap = self._bitmaps.get(key)
+            if bitmap is not None:
+                self._bitmaps.move_to_end(key)
+                return bitmap
+        bitmap = np.packbits(build(), bitorder='little')
+        with self._lock:
+            self._bitmaps[key] = bitmap
+            while len(self._bitmaps) > self.max_cached:
+                self._bitmaps.popitem(last=False)
+        return bitmap
+
+    def _law_bitmap(self, key, matches) -> np.ndarray:
+        """法律名称满足 matches 的所有文本块"""
+        codes = [code for code, law_name in enumerate(self.law_values) if matches(law_name)]
+        return self._cached(key, lambda: np.isin(self.law_codes, codes))
+
+    def law_name_bitmap(self, law_names: List[str]) -> np.ndarray:
+        """法律名称包含任一 law_names 的文本块（与 filter_docs_by_metadata 相同的子串匹配）"""
+        return self._law_bitmap(
+            ('law_name', tuple(law_names)),
+            lambda law_name: any(name in law_name for name in law_names),
+        )
+
+    def year_bitmap(self, years: List[str]) -> np.ndarray:
+        """通过日期包含任一年份（如“2015年”）的法律的全部文本块"""
+        return self._law_bitmap(
+            ('year', tuple(years)),
+            lambda law_name: any(year in date for date in self.get_law_info(law_name)[0] for year in years),
+        )
+
+    def meeting_bitmap(self, meetings: List[str]) -> np.ndarray:
+        """在任一会议上通过或修正的法律的全部文本块"""
+        return self._law_bitmap(
+            ('meeting', tuple(meetings)),
+            lambda law_name: any(m in meeting for meeting in self.get_law_info(law_name)[1] for m in meetings),
+        )
+
+    def content_type_bitmap(self, content_types: List[str]) -> np.ndarray:
+        codes = [self.type_values.index(t) for t in content_types if t in self.type_values]
+        return self._cached(('content_type', tuple(content_types)), lambda: np.isin(self.type_codes, codes))
+
+    def build_filter(self, query_info: dict, exclude_content_types=()) -> Optional[Tuple[np.ndarray, int]]:
+        """
+        按 parse_legal_query 的结果组合位图，返回 (位图, 选中数量)。
+        没有过滤条件、没有选中任何文本块或选中全部文本块时返回 None（不下推过滤，
+        检索结果仍由 filter_docs_by_metadata 过滤，没有结果时按原逻辑兜底）。
+        """
+        bitmaps = []
+        if query_info.get("year_refs"):
+            bitmaps.append(self.year_bitmap(query_info["year_refs"]))
+        if query_info.get("meeting_refs"):
+            # 与 filter_docs_by_metadata 一致：没有匹配的会议时不按会议过滤
+            bitmap = self.meeting_bitmap(query_info["meeting_refs"])
+            if self.count(bitmap):
+                bitmaps.append(bitmap)
+        if query_info.get("law_names"):
+            bitmaps.append(self.law_name_bitmap(query_info["law_names"]))
+        excluded = [t for t in exclude_content_types if t in self.type_values]
+        if excluded:
+            bitmaps.append(~self.content_type_bitmap(excluded))
+        if not bitmaps:
+            return None
+
+        bitmap = bitmaps[0]
+        for other in bitmaps[1:]:
+            bitmap = bitmap & other
+        count = self.count(bitmap)
+        if count == 0 or count == self.size:
+            return None
+        return bitmap, count
@@ -1,38 +1,205 @@
-import requests
+import asyncio
+import hashlib
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+import httpx
+from core.rag.cache import LocalCacheBackend
+from core.utils import get_loop_bound_client
+
+# 异步客户端按事件循环共享
+_async_clients = weakref.WeakKeyDictionary()
+
+# 相同配置的重排序器在所有知识库间共享（连接池和分数缓存）
+_rerankers = {}
+_rerankers_lock = threading.Lock()
+
+# 可以重试的HTTP状态码：超时、限流和服务端临时错误
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+class RerankError(Exception):
+    """重排序接口在截止时间内没有返回有效结果"""
+
+# 各提供商可以从配置中读取的参数
+RERANKER_OPTIONS = {
+    'siliconflow': (
+        'base_url', 'timeout', 'connect_timeout', 'max_retries', 'backoff',
+        'batch_size', 'max_concurrency', 'cache_size', 'cache_ttl',
+    ),
+    # 本地模型的参数在配置中带 local_ 前缀，与远程接口的参数分开
+    'local': (
+        'local_model_path', 'local_onnx_file', 'local_quantize', 'local_max_length',
+        'local_batch_size', 'local_num_threads', 'local_max_concurrency', 'cache_size', 'cache_ttl',
+    ),
+}
+
+def _create_reranker(provider, model_name, api_key, options):
+    if provider == 'siliconflow':
+        return SiliconflowReranker(model_name=model_name, api_key=api_key, **options)
+    if provider == 'local':
+        from core.rag.local_reranker import LocalCrossEncoderReranker, check_dependencies
+        missing = check_dependencies()
+        if missing:
+            print(f"未安装{'、'.join(missing)}，本地重排序不可用")
+            return None
+        options = {key[len('local_'):] if key.startswith('local_') else key: value
+                   for key, value in options.items()}
+        if not options.get('model_path'):
+            print("未配置本地重排序模型目录 local_model_path，本地重排序不可用")
+            return None
+        return LocalCrossEncoderReranker(model_name=model_name, **options)
+    return None
 
 def get_reranker(reranker_cfg: dict):
     """获取重排序器"""
     if not reranker_cfg:
         return None
-        
+
     provider = reranker_cfg.get('provider', '')
     model_name = reranker_cfg.get('model_name', '')
-    
-    if not provider or not model_name:
+
+    if not provider or not model_name or provider not in RERANKER_OPTIONS:
         return None
-    
-    if provider == 'siliconflow':
-        return SiliconflowReranker(
-            model_name=model_name,
-            api_key=reranker_cfg.get('api_key', '')
-        )
-    
-    return None
 
-class SiliconflowReranker:
-    """Silicon Flow 重排序器"""
-    def __init__(self, model_name, api_key) -> None:
+    options = {key: reranker_cfg[key] for key in RERANKER_OPTIONS[provider] if key in reranker_cfg}
+    api_key = reranker_cfg.get('api_key', '')
+    key = (provider, model_name, api_key, tuple(sorted(options.items())))
+    with _rerankers_lock:
+        if key not in _rerankers:
+            _rerankers[key] = _create_reranker(provider, model_name, api_key, options)
+        return _rerankers[key]
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class BaseReranker:
+    """
+    重排序器基类：compute_score / acompute_score 接收 [[查询, 文档], ...]，按文档顺序返回相关性分数。
+    (模型, 查询, 文档) 的分数有缓存，多轮对话中重复的候选文档不再重新计算；
+    子类实现 _score / _ascore，对缓存未命中的文档（已去重）打分。
+    """
+    def __init__(self, model_name, cache_size=10000, cache_ttl=3600):
         self.model = model_name
+        self.score_cache = LocalCacheBackend(max_entries=cache_size, ttl=cache_ttl)
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    def _cache_key(self, query_hash, doc):
+        return f"{self.model}:{query_hash}:{_text_hash(doc)}"
+
+    def _lookup(self, query_hash, docs):
+        """从缓存中读取分数，返回 (分数列表（未命中为 None）, 需要计算的文档（去重）)"""
+        scores = [self.score_cache.get(self._cache_key(query_hash, doc)) for doc in docs]
+        missing = list(dict.fromkeys(doc for doc, score in zip(docs, scores) if score is None))
+        misses = sum(1 for score in scores if score is None)
+        with self._stats_lock:
+            self.hits += len(docs) - misses
+            self.misses += misses
+        return scores, missing
+
+    def _store(self, query_hash, docs, scores, missing, missing_scores):
+        """保存新计算的分数，返回完整的分数列表"""
+        new_scores = dict(zip(missing, missing_scores))
+        for doc, score in new_scores.items():
+            self.score_cache.set(self._cache_key(query_hash, doc), score)
+        return [new_scores[doc] if score is None else score for doc, score in zip(docs, scores)]
+
+    @staticmethod
+    def _apply_top_n(scores, top_n):
+        """与远程接口的 top_n 一致：只保留分数最高的 top_n 个文档的分数，其他为0"""
+        if not top_n or top_n >= len(scores):
+            return scores
+        keep = set(sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:top_n])
+        return [score if i in keep else 0.0 for i, score in enumerate(scores)]
+
+    def _score(self, query, docs, timeout=None) -> list[float]:
+        raise NotImplementedError
+
+    async def _ascore(self, query, docs, timeout=None) -> list[float]:
+        return await asyncio.to_thread(self._score, query, docs, timeout)
+
+    def compute_score(self, docs: list, top_n=None, timeout=None) -> list[float]:
+        """
+        计算 [[查询, 文档], ...] 的相关性分数，按文档顺序返回。
+        timeout 为整个打分过程的截止时间（远程接口含重试），超时或失败时抛出 RerankError。
+        """
+        if not docs:
+            return []
+        query = docs[0][0]
+        docs = [i[1] for i in docs]
+        query_hash = _text_hash(query)
+        scores, missing = self._lookup(query_hash, docs)
+        if missing:
+            scores = self._store(query_hash, docs, scores, missing, self._score(query, missing, timeout))
+        return self._apply_top_n(scores, top_n)
+
+    async def acompute_score(self, docs: list, top_n=None, timeout=None) -> list[float]:
+        """异步计算相关性分数，不阻塞事件循环"""
+        if not docs:
+            return []
+        query = docs[0][0]
+        docs = [i[1] for i in docs]
+        query_hash = _text_hash(query)
+        scores, missing = self._lookup(query_hash, docs)
+        if missing:
+            scores = self._store(query_hash, docs, scores, missing, await self._ascore(query, missing, timeout))
+        return self._apply_top_n(scores, top_n)
+
+class SiliconflowReranker(BaseReranker):
+    """
+    Silicon Flow 重排序器。
+    - 同步和异步请求都使用带长连接的连接池
+    - 每次打分有总的截止时间（timeout），超时或临时错误按指数退避加随机抖动重试，最多 max_retries 次
+    - 候选文档较多时拆成 batch_size 大小的子批次并发请求
+    """
+    def __init__(self, model_name, api_key, base_url="https://api.siliconflow.cn/v1/rerank",
+                 timeout=10.0, connect_timeout=3.0, max_retries=2, backoff=0.2,
+                 batch_size=32, max_concurrency=4, cache_size=10000, cache_ttl=3600) -> None:
+        super().__init__(model_name, cache_size=cache_size, cache_ttl=cache_ttl)
         self.api_key = api_key
-        self.base_url = "https://api.siliconflow.cn/v1/rerank"
+        self.base_url = base_url
+        self.timeout = float(timeout)
+        self.connect_timeout = float(connect_timeout)
+        self.max_retries = int(max_retries)
+        self.backoff = float(backoff)
+        self.batch_size = max(1, int(batch_size))
+        self.max_concurrency = max(1, int(max_concurrency))
 
-    def _get_score(self, query, docs, top_n=None) -> list[float]:
+    def _limits(self):
+        return httpx.Limits(max_connections=self.max_concurrency * 2,
+                            max_keepalive_connections=self.max_concurrency)
+
+    @cached_property
+    def client(self):
+        """同步连接池，首次使用时创建，多个线程共享"""
+        return httpx.Client(limits=self._limits())
+
+    def _get_async_client(self):
+        return get_loop_bound_client(
+            _async_clients, ('siliconflow', self.max_concurrency),
+            lambda: httpx.AsyncClient(limits=self._limits())
+        )
+
+    def _build_request(self, query, docs, top_n=None):
         payload = {
             "model": self.model,
             "query": query,
             "documents": docs,
             "top_n": top_n,
-            "return_documents": True,
+            # 只需要分数，不需要接口返回文档内容
+            "return_documents": False,
             "max_chunks_per_doc": 123,
             "overlap_tokens": 79,
         }
@@ -40,17 +207,96 @@ class SiliconflowReranker:
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
         }
-        response = requests.request(
-            "POST", self.base_url, json=payload, headers=headers
-        )
-        response = sorted(response.json()["results"], key=lambda x: x["index"])
-        response = [i["relevance_score"] for i in response]
-        return response
+        return payload, headers
 
-    def compute_score(self, docs: list, top_n=None) -> list[float]:
-        if not docs:
-            return []
-        query = docs[0][0]
-        docs = [i[1] for i in docs]
-        top_n = top_n or len(docs)
-        return self._get_score(query=query, docs=docs, top_n=top_n)
\ No newline at end of file
+    @staticmethod
+    def _parse_scores(result, size) -> list[float]:
+        """按文档顺序返回分数，接口没有返回的文档（如超出 top_n）分数为0"""
+        scores = [0.0] * size
+        for item in result["results"]:
+            scores[item["index"]] = item["relevance_score"]
+        return scores
+
+    def _request_timeout(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RerankError("重排序超时")
+        return httpx.Timeout(remaining, connect=min(self.connect_timeout, remaining))
+
+    def _retry_delay(self, attempt, deadline):
+        """指数退避加随机抖动；剩余时间不够再等一次时返回 None"""
+        delay = random.uniform(0, self.backoff * (2 ** attempt))
+        if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def _post(self, payload, headers, deadline):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.client.post(self.base_url, json=payload, headers=headers,
+                                            timeout=self._request_timeout(deadline))
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.json()
+                last_error = f"HTTP {response.status_code}"
+            except httpx.TransportError as e:
+                last_error = str(e) or type(e).__name__
+            delay = self._retry_delay(attempt, deadline)
+            if delay is None:
+                break
+            print(f"重排序请求失败（{last_error}），{delay:.2f}秒后重试")
+            time.sleep(delay)
+        raise RerankError(f"重排序请求失败: {last_error}")
+
+    async def _apost(self, payload, headers, deadline):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._get_async_client().post(self.base_url, json=payload, headers=headers,
+                                                               timeout=self._request_timeout(deadline))
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.json()
+                last_error = f"HTTP {response.status_code}"
+            except httpx.TransportError as e:
+                last_error = str(e) or type(e).__name__
+            delay = self._retry_delay(attempt, deadline)
+            if delay is None:
+                break
+            print(f"重排序请求失败（{last_error}），{delay:.2f}秒后重试")
+            await asyncio.sleep(delay)
+        raise RerankError(f"重排序请求失败: {last_error}")
+
+    def _get_score(self, query, docs, deadline) -> list[float]:
+        payload, headers = self._build_request(query, docs, top_n=len(docs))
+        return self._parse_scores(self._post(payload, headers, deadline), len(docs))
+
+    async def _aget_score(self, query, docs, deadline) -> list[float]:
+        payload, headers = self._build_request(query, docs, top_n=len(docs))
+        return self._parse_scores(await self._apost(payload, headers, deadline), len(docs))
+
+    def _batches(self, docs):
+        return [docs[i:i + self.batch_size] for i in range(0, len(docs), self.batch_size)]
+
+    def _score(self, query, docs, timeout=None) -> list[float]:
+        """候选文档较多时拆成子批次，在线程中并发请求"""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        batches = self._batches(docs)
+        if len(batches) == 1:
+            return self._get_score(query, batches[0], deadline)
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            results = list(executor.map(lambda batch: self._get_score(query, batch, deadline), batches))
+        return [score for batch in results for score in batch]
+
+    async def _ascore(self, query, docs, timeout=None) -> list[float]:
+        """子批次通过异步客户端并发请求，等待接口期间不占用线程"""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def score_batch(batch):
+            async with semaphore:
+                return await self._aget_score(query, batch, deadline)
+
+        results = await asyncio.gather(*(score_batch(batch) for batch in self._batches(docs)))
+        return [score for batch in results for score in batch]
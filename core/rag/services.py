@@ -2,55 +2,41 @@
 from django.conf import settings
 import os
 import re
-import time
-import hashlib
+import asyncio
 import json
+import threading
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional
-from langchain_community.vectorstores import FAISS
+import numpy as np
+import faiss
 from langchain_core.documents import Document
 from core.rag.embedding import get_embeddings
 from core.rag.reranker import get_reranker
 from core.rag.legal_retriever import LegalRetriever
+from core.rag.cache import get_retrieval_cache, normalize_query
+from core.rag.faiss_index import apply_search_params, estimate_index_bytes, filtered_search
+from core.rag.chunk_store import (
+    ChunkStore, ChunkStoreDocstore, get_chunk_store_path, load_readonly_vectorstore, load_vectorstore,
+)
+from core.rag.metadata_index import MetadataIndex, get_law_header_info
+from core.rag.lexical_index import (
+    get_lexical_config, get_lexical_index_path, load_lexical_index, reciprocal_rank_fusion,
+)
 from core.rag.text_splitters import convert_cn_to_int
 
 def get_rag_service(knowledge_base_name, user_id=None):
-    """获取RAG服务实例"""
+    """获取RAG服务实例（优先复用注册表中已加载的实例）"""
     # 从数据库查询知识库
     from knowledge_base.models import KnowledgeBase
     try:
         if user_id is not None:
-            kb = KnowledgeBase.objects.get(name=knowledge_base_name, user_id=user_id)
+            kb = KnowledgeBase.objects.select_related('user').get(name=knowledge_base_name, user_id=user_id)
             # print(f"按用户ID查询知识库: {knowledge_base_name}, 用户ID: {user_id}")
         else:
-            kb = KnowledgeBase.objects.get(name=knowledge_base_name)
+            kb = KnowledgeBase.objects.select_related('user').get(name=knowledge_base_name)
             print(f"未指定用户ID，按名称查询知识库: {knowledge_base_name}")
         
-        # 获取配置信息
-        rag_configs = getattr(settings, 'RAG_CONFIGS', {})
-        embedding_config = rag_configs.get('embedding', {}).copy()
-        
-        # 根据知识库的嵌入类型选择嵌入配置
-        if kb.embedding_type == 'local':
-            # print(f"使用本地嵌入模型处理知识库: {kb.name} (用户ID: {kb.user.id})")
-            embedding_config['provider'] = 'local_ollama'
-            embedding_config['model_name'] = embedding_config.get('local_model', 'bge-m3')
-            embedding_config['base_url'] = 'http://localhost:11434/api'
-        else:
-            print(f"使用远程嵌入模型处理知识库: {kb.name} (用户ID: {kb.user.id})")
-            # 确保使用远程配置（默认）
-            embedding_config['provider'] = 'siliconflow'
-            if 'local_model' in embedding_config:
-                del embedding_config['local_model']
-        
-        # 返回包含正确嵌入配置的RAG服务
-        return RAGService(
-            knowledge_base_name=kb.name,
-            user_id=kb.user.id,  # 传递user_id
-            chunk_size=kb.chunk_size,
-            chunk_overlap=kb.chunk_overlap,
-            merge_rows=kb.merge_rows,
-            embedding_config=embedding_config
-        )
+        return get_knowledge_base_rag_service(kb)
     except KnowledgeBase.DoesNotExist:
         # 从配置文件获取默认设置
         rag_configs = getattr(settings, 'RAG_CONFIGS', {})
@@ -62,11 +48,190 @@ def get_rag_service(knowledge_base_name, user_id=None):
             merge_rows=rag_configs.get('database', {}).get('merge_rows', 2),
             embedding_config=rag_configs.get('embedding', {})
         )
+
+def get_knowledge_base_rag_service(kb):
+    """
+    按已查询的知识库记录从注册表获取RAG服务，不存在时构建（需要读取索引）。
+    不访问数据库，异步视图可以在独立线程中调用，避免首次加载索引时阻塞异步ORM。
+    """
+    key = (kb.user.id, kb.name, kb.embedding_type)
+    return rag_service_registry.get(key, lambda: _build_rag_service(kb))
+
+def _build_rag_service(kb):
+    """根据知识库记录构建新的RAG服务实例"""
+    # 获取配置信息
+    rag_configs = getattr(settings, 'RAG_CONFIGS', {})
+    embedding_config = rag_configs.get('embedding', {}).copy()
+    
+    # 根据知识库的嵌入类型选择嵌入配置
+    if kb.embedding_type == 'local':
+        # print(f"使用本地嵌入模型处理知识库: {kb.name} (用户ID: {kb.user.id})")
+        embedding_config['provider'] = 'local_ollama'
+        embedding_config['model_name'] = embedding_config.get('local_model', 'bge-m3')
+        embedding_config['base_url'] = 'http://localhost:11434/api'
+    else:
+        print(f"使用远程嵌入模型处理知识库: {kb.name} (用户ID: {kb.user.id})")
+        # 确保使用远程配置（默认）
+        embedding_config['provider'] = 'siliconflow'
+        if 'local_model' in embedding_config:
+            del embedding_config['local_model']
+    
+    # 返回包含正确嵌入配置的RAG服务
+    return RAGService(
+        knowledge_base_name=kb.name,
+        user_id=kb.user.id,  # 传递user_id
+        chunk_size=kb.chunk_size,
+        chunk_overlap=kb.chunk_overlap,
+        merge_rows=kb.merge_rows,
+        embedding_config=embedding_config
+    )
+
+def get_index_path(db_vector_path, index_name):
+    """获取向量索引文件路径"""
+    return os.path.join(db_vector_path, f"{index_name}.faiss")
+
+def get_index_generation(db_vector_path, index_name):
+    """
+    获取向量索引的版本标识（文件修改时间和大小）。
+    索引被重建或删除后该值会变化，用于跨进程判断已加载的服务是否过期。
+    """
+    try:
+        stat = os.stat(get_index_path(db_vector_path, index_name))
+    except OSError:
+        return None
+    # 文本块存储和BM25索引在索引之后写入，其版本也计入标识
+    extra_mtimes = []
+    for path in (get_chunk_store_path(db_vector_path, index_name), get_lexical_index_path(db_vector_path, index_name)):
+        try:
+            extra_mtimes.append(os.stat(os.path.join(path, 'info.json')).st_mtime_ns)
+        except OSError:
+            extra_mtimes.append(None)
+    return (stat.st_mtime_ns, stat.st_size, *extra_mtimes)
+
+class RAGServiceRegistry:
+    """
+    进程内RAG服务注册表。
+    按 (user_id, kb_name, embedding_type) 缓存已加载的 RAGService，
+    避免每条消息都重新创建嵌入客户端、反序列化FAISS索引和加载法律结构。
+    超出数量或内存上限时按LRU淘汰；索引文件变化时自动重建。
+    """
+    def __init__(self, max_entries=16, max_memory_mb=2048):
+        self.max_entries = max_entries
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, factory):
+        """获取服务实例，不存在或已过期时调用factory构建"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and self._is_fresh(entry):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry['service']
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
         
-# 创建检索缓存字典
-retrieval_cache = {}
-# 缓存过期时间（秒）
-CACHE_EXPIRY = 3600
+        # 同一个知识库只允许一个线程构建，其他线程等待后直接复用
+        with build_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and self._is_fresh(entry):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry['service']
+            
+            service = factory()
+            self.misses += 1
+            # 没有可用检索器的服务不缓存，等待索引生成后再加载
+            if not service.retriever:
+                return service
+            
+            with self._lock:
+                self._entries[key] = {
+                    'service': service,
+                    'generation': service.index_generation,
+                    'size': service.estimate_memory_bytes(),
+                }
+                self._entries.move_to_end(key)
+                self._evict()
+            return service
+
+    def invalidate(self, user_id, kb_name):
+        """使指定知识库的所有缓存实例失效"""
+        with self._lock:
+            stale_keys = [k for k in self._entries if k[0] == user_id and k[1] == kb_name]
+            for k in stale_keys:
+                del self._entries[k]
+        if stale_keys:
+            print(f"已清除知识库 {kb_name} (用户ID: {user_id}) 的RAG服务缓存")
+
+    def clear(self):
+        """清空注册表"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """返回注册表统计信息"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'memory_bytes': sum(e['size'] for e in self._entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _is_fresh(self, entry):
+        service = entry['service']
+        return get_index_generation(service.db_vector_path, service.loaded_index_name) == entry['generation']
+
+    def _evict(self):
+        """按LRU顺序淘汰，直到满足数量和内存上限（至少保留最近使用的一个）"""
+        total = sum(e['size'] for e in self._entries.values())
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or total > self.max_memory_bytes
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            total -= evicted['size']
+            print(f"RAG服务缓存已满，淘汰知识库: {evicted['service'].kb_name}")
+
+def _create_registry():
+    service_cache_config = getattr(settings, 'RAG_CONFIGS', {}).get('service_cache', {})
+    return RAGServiceRegistry(
+        max_entries=service_cache_config.get('max_entries', 16),
+        max_memory_mb=service_cache_config.get('max_memory_mb', 2048),
+    )
+
+rag_service_registry = _create_registry()
+
+def invalidate_rag_service(user_id, kb_name):
+    """知识库索引重建或删除后调用，清除已缓存的RAG服务"""
+    rag_service_registry.invalidate(user_id, kb_name)
+
+# 法律结构检索器按目录共享
+_legal_retrievers = {}
+_legal_retrievers_lock = threading.Lock()
+
+def get_legal_retriever(db_vector_path):
+    """获取共享的法律检索器，法律结构文件变化时自动重新加载"""
+    with _legal_retrievers_lock:
+        retriever = _legal_retrievers.get(db_vector_path)
+        if retriever is None:
+            retriever = LegalRetriever(db_vector_path)
+            _legal_retrievers[db_vector_path] = retriever
+    retriever.reload_if_changed()
+    return retriever
+
+def get_multi_query_config():
+    """读取 RAG_CONFIGS['multi_query']"""
+    config = getattr(settings, 'RAG_CONFIGS', {}).get('multi_query', {})
+    return {
+        'max_queries': int(config.get('max_queries', 12)),
+        'min_query_chars': int(config.get('min_query_chars', 10)),
+        'rerank_query_chars': int(config.get('rerank_query_chars', 512)),
+    }
 
 class RAGService:
     """RAG服务"""
@@ -87,11 +252,22 @@ class RAGService:
         # 使用传入的嵌入配置或默认配置
         self.embedding_config = embedding_config or rag_configs.get('embedding', {})
         
+        # 实际加载的索引文件名（兼容旧格式）及其版本
+        self.loaded_index_name = self.index_name
+        self.index_generation = None
+        
+        # 批量检索一次取回的候选数量，精确匹配过滤、元数据过滤和兜底检索共用这批结果
+        faiss_params = rag_configs.get('database', {}).get('faiss_params', {})
+        self.candidate_k = int(faiss_params.get('candidate_k', 32))
+        
         # 初始化组件
         self.embeddings = get_embeddings(self.embedding_config)
         self.reranker = get_reranker(rag_configs.get('reranker', {}))
         self.retriever = self._init_retriever()
-        self.legal_retriever = LegalRetriever(self.db_vector_path)
+        self.lexical_index = self._init_lexical_index()
+        self.metadata_index = self._init_metadata_index()
+        self.legal_retriever = get_legal_retriever(self.db_vector_path)
+        self.retrieval_cache = get_retrieval_cache()
     
     def _init_retriever(self):
         """初始化检索器"""
@@ -101,34 +277,42 @@ class RAGService:
             
         try:
             # 检查向量数据库文件是否存在 - 使用index_name而不是kb_name
-            index_path = os.path.join(self.db_vector_path, f"{self.index_name}.faiss")
+            index_path = get_index_path(self.db_vector_path, self.index_name)
             if not os.path.exists(index_path):
                 print(f"向量数据库文件不存在: {index_path}")
                 
                 # 尝试查找旧格式的文件（向后兼容）
-                old_index_path = os.path.join(self.db_vector_path, f"{self.kb_name}.faiss")
+                old_index_path = get_index_path(self.db_vector_path, self.kb_name)
                 if os.path.exists(old_index_path):
                     print(f"找到旧格式向量数据库文件: {old_index_path}，将使用该文件")
                     # 继续使用旧文件名
                     index_name = self.kb_name
                 else:
-                    print(f"新旧格式向量数据库文件均不存在")
+                    print("新旧格式向量数据库文件均不存在")
                     return None
             else:
                 # 使用新格式文件名
                 index_name = self.index_name
-                
-            # 加载向量数据库 - 使用正确的index_name
-            faiss_vectorstore = FAISS.load_local(
-                folder_path=self.db_vector_path,
-                embeddings=self.embeddings,
-                index_name=index_name,
-                allow_dangerous_deserialization=True
-            )
             
+            # 先记录版本再加载，加载期间若索引被重写，下次访问时会检测到版本变化
+            self.loaded_index_name = index_name
+            self.index_generation = get_index_generation(self.db_vector_path, index_name)
+                
             # 设置检索参数
             rag_configs = getattr(settings, 'RAG_CONFIGS', {})
-            faiss_params = rag_configs.get('database', {}).get('faiss_params', {})
+            database_config = rag_configs.get('database', {})
+            faiss_params = database_config.get('faiss_params', {})
+            
+            # 优先以只读mmap方式加载（文本块存储和IVF倒排表由多个工作进程共享页缓存）
+            faiss_vectorstore = None
+            if database_config.get('mmap', True):
+                faiss_vectorstore = load_readonly_vectorstore(self.db_vector_path, index_name, self.embeddings)
+            
+            if faiss_vectorstore is None:
+                # 加载向量数据库 - 使用正确的index_name，旧格式(.pkl)会被转换为文本块存储
+                faiss_vectorstore = load_vectorstore(self.db_vector_path, index_name, self.embeddings)
+            
+            apply_search_params(faiss_vectorstore.index, faiss_params)
             
             return faiss_vectorstore.as_retriever(
                 search_type=faiss_params.get('search_type', 'similarity'),
@@ -141,13 +325,165 @@ class RAGService:
             traceback.print_exc()
             return None
             
-    def get_cache_key(self, query: str, timestamp: float = None) -> str:
-        """生成一个包含查询、索引名称和时间戳的缓存键"""
-        if timestamp is None:
-            timestamp = time.time()
-        # 使用index_name而不是kb_name，确保用户隔离
-        combined = f"{query}:{self.index_name}:{timestamp}"
-        return hashlib.md5(combined.encode('utf-8')).hexdigest()
+    def _init_lexical_index(self):
+        """加载与向量索引对应的BM25索引，不可用时返回 None（只使用向量检索）"""
+        if not self.retriever:
+            return None
+        try:
+            return load_lexical_index(
+                self.db_vector_path, self.loaded_index_name, self.retriever.vectorstore.index.ntotal
+            )
+        except Exception as e:
+            print(f"加载BM25索引出错: {e}")
+            return None
+
+    def _init_metadata_index(self):
+        """根据文本块存储建立元数据位图索引，用于把元数据过滤下推到FAISS检索，不可用时返回 None"""
+        if not self.retriever:
+            return None
+        try:
+            docstore = self.retriever.vectorstore.docstore
+            if isinstance(docstore, ChunkStoreDocstore):
+                store = docstore.store
+            else:
+                store_path = get_chunk_store_path(self.db_vector_path, self.loaded_index_name)
+                if not ChunkStore.exists(store_path):
+                    return None
+                store = ChunkStore(store_path)
+            if len(store) != self.retriever.vectorstore.index.ntotal:
+                return None
+            return MetadataIndex(store)
+        except Exception as e:
+            print(f"建立元数据索引出错: {e}")
+            return None
+
+    def estimate_memory_bytes(self) -> int:
+        """估算已加载索引和文档存储占用的内存（字节）"""
+        if not self.retriever:
+            return 0
+        vectorstore = self.retriever.vectorstore
+        size = estimate_index_bytes(vectorstore.index)
+        if self.lexical_index is not None:
+            size += self.lexical_index.nbytes()
+        if isinstance(vectorstore.docstore, ChunkStoreDocstore):
+            # mmap加载的数据位于共享页缓存中，按文件大小计算
+            return size + vectorstore.docstore.store.nbytes()
+        docs = getattr(vectorstore.docstore, '_dict', {})
+        for doc in docs.values():
+            # 文本按UTF-8估算，另加对象和元数据的固定开销
+            size += len(doc.page_content) * 3 + 512
+        return size
+
+    def _vector_search(self, query: str, query_vectors=None, search_results=None) -> List[Document]:
+        """
+        执行向量检索并返回文档副本。
+        服务实例会被多个请求复用，检索流程会修改文档元数据（分数、精确匹配标记），
+        因此不能直接修改文档存储中的原始对象。
+        query_vectors 为预先计算的 {查询: 向量}，命中时直接按向量检索，不再调用嵌入模型；
+        search_results 为 _batch_vector_search 批量检索的结果，命中时直接使用。
+        """
+        query_vector = (query_vectors or {}).get(query)
+        search_type = self.retriever.search_type
+        if search_results is not None and query in search_results:
+            docs = search_results[query]
+        elif query_vector is not None and search_type in ('similarity', 'mmr'):
+            vectorstore = self.retriever.vectorstore
+            search_kwargs = self.retriever.search_kwargs
+            if search_type == 'mmr':
+                docs = vectorstore.max_marginal_relevance_search_by_vector(query_vector, **search_kwargs)
+            else:
+                docs = vectorstore.similarity_search_by_vector(query_vector, **search_kwargs)
+        else:
+            docs = self.retriever.invoke(query)
+        return [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in docs]
+
+    def _batch_vector_search(self, queries: List[str], query_vectors,
+                             search_filters=None) -> Optional[Dict[str, List[Document]]]:
+        """
+        用一次FAISS批量检索处理多个查询向量，返回 {查询: 文档列表}（文档存储中的原始对象）。
+        每个查询取回 max(k, candidate_k) 个候选，供之后的过滤和兜底检索使用。
+        search_filters 为 {查询: 元数据位图过滤条件}（见 _get_search_filter），
+        带过滤条件的查询按条件分组，只在选中的文本块中检索。
+        只支持不带过滤条件的相似度检索，其他检索方式返回 None，由 _vector_search 逐个按向量检索。
+        """
+        search_kwargs = self.retriever.search_kwargs
+        if self.retriever.search_type != 'similarity' or set(search_kwargs) - {'k'}:
+            return None
+        queries = [q for q in queries if (query_vectors or {}).get(q) is not None]
+        if not queries:
+            return {}
+        
+        vectorstore = self.retriever.vectorstore
+        k = max(search_kwargs.get('k', 4), self.candidate_k)
+        groups = {}
+        for query in queries:
+            search_filter = (search_filters or {}).get(query)
+            groups.setdefault(id(search_filter), (search_filter, []))[1].append(query)
+        
+        results = {}
+        for search_filter, group in groups.values():
+            matrix = np.array([query_vectors[q] for q in group], dtype=np.float32)
+            if vectorstore._normalize_L2:
+                faiss.normalize_L2(matrix)
+            if search_filter is None:
+                _, indices = vectorstore.index.search(matrix, k)
+            else:
+                _, indices = filtered_search(vectorstore.index, matrix, k, *search_filter)
+            results.update((query, self._get_docs_by_rows(row)) for query, row in zip(group, indices))
+        return results
+
+    def _get_docs_by_rows(self, rows) -> List[Document]:
+        """按FAISS索引中的位置读取文档（文档存储中的原始对象），跳过无效位置"""
+        vectorstore = self.retriever.vectorstore
+        docs = []
+        for i in rows:
+            if i == -1:
+                continue
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(i)])
+            if isinstance(doc, Document):
+                docs.append(doc)
+        return docs
+
+    def _lexical_search(self, query: str, k=None, required_terms=None) -> List[Document]:
+        """
+        BM25检索，返回文档副本，metadata['lexical_score'] 为BM25分数。
+        required_terms 中的词（如“第十二条”）必须出现在文档中；查询的元数据过滤条件同样生效。
+        """
+        if self.lexical_index is None:
+            return []
+        search_filter = self._get_search_filter(query)
+        hits = self.lexical_index.search(
+            query, k=k or get_lexical_config()['top_k'], required_terms=required_terms,
+            bitmap=search_filter[0] if search_filter else None,
+        )
+        docs = []
+        for doc, (_, score) in zip(self._get_docs_by_rows([row for row, _ in hits]), hits):
+            docs.append(Document(page_content=doc.page_content, metadata=dict(doc.metadata, lexical_score=score)))
+        return docs
+
+    def _fuse_lexical(self, query: str, vector_docs: List[Document], top_k) -> List[Document]:
+        """
+        用倒数排名融合（RRF）合并向量检索和BM25检索的结果，
+        保留与向量检索相同数量（至少 top_k 个）的文档；没有BM25索引时直接返回向量检索结果
+        """
+        if self.lexical_index is None:
+            return vector_docs
+        lexical_docs = self._lexical_search(query)
+        if not lexical_docs:
+            return vector_docs
+        fused = reciprocal_rank_fusion(
+            [vector_docs, lexical_docs], key=lambda doc: doc.page_content, k=get_lexical_config()['rrf_k']
+        )
+        return [doc for doc, _ in fused[:max(len(vector_docs), top_k)]]
+
+    def get_cache_key(self, query: str, top_k=5, threshold=0.05, rewrite=True) -> str:
+        """生成检索缓存键：规范化查询 + 索引名称和版本 + 检索参数"""
+        # 使用index_name而不是kb_name，确保用户隔离；索引或法律结构更新后版本随之变化
+        index_version = f"{self.index_generation}:{self.legal_retriever.generation}"
+        return self.retrieval_cache.make_key(
+            self.index_name, index_version, query,
+            top_k=top_k, threshold=threshold, rewrite=rewrite
+        )
 
     def is_legal_document_query(self, query: str) -> bool:
         """检测是否是法律文档相关查询"""
@@ -250,30 +586,28 @@ class RAGService:
             result["meeting_refs"] = meeting_refs
         return result
 
+    def get_law_header_info(self, doc: Document):
+        """文档所属法律的 (通过日期列表, 会议列表)：文档自身的元数据加上同一法律头部块的信息"""
+        dates, meetings = get_law_header_info(doc.metadata)
+        if self.metadata_index is not None:
+            law_dates, law_meetings = self.metadata_index.get_law_info(doc.metadata.get("law_name"))
+            dates, meetings = dates + law_dates, meetings + law_meetings
+        return dates, meetings
+
     def filter_docs_by_metadata(self, docs: list, query_info: dict) -> list:
-        """根据元数据过滤文档"""
+        """根据元数据过滤文档（条文块本身没有年份和会议，按其所属法律的头部信息判断）"""
         filtered = docs
         if "year_refs" in query_info:
             year_keywords = query_info["year_refs"]
             filtered = [doc for doc in filtered if any(
-                year in doc.metadata.get("law_header", {}).get("adoption", {}).get("date", "")
-                for year in year_keywords
+                year in date for date in self.get_law_header_info(doc)[0] for year in year_keywords
             )]
             print("经过年份过滤后的文档数：", len(filtered))
         if "meeting_refs" in query_info:
             meeting_keywords = query_info["meeting_refs"]
-            temp = []
-            for doc in filtered:
-                law_header = doc.metadata.get("law_header", {})
-                adoption_meeting = law_header.get("adoption", {}).get("meeting", "")
-                amendments = law_header.get("amendments", [])
-                if any(meeting_kw in adoption_meeting for meeting_kw in meeting_keywords):
-                    temp.append(doc)
-                else:
-                    for amendment in amendments:
-                        if any(meeting_kw in amendment.get("meeting", "") for meeting_kw in meeting_keywords):
-                            temp.append(doc)
-                            break
+            temp = [doc for doc in filtered if any(
+                meeting_kw in meeting for meeting in self.get_law_header_info(doc)[1] for meeting_kw in meeting_keywords
+            )]
             filtered = temp if temp else filtered
             print("经过会议信息过滤后的文档数：", len(filtered))
         if "law_names" in query_info and query_info["law_names"]:
@@ -315,8 +649,8 @@ class RAGService:
                 merged_docs.append(Document(page_content=merged_text, metadata=meta))
         return standalone + merged_docs
 
-    def fetch_exact_law_articles(self, query: str) -> List[Document]:
-        """针对法律文档的精确检索"""
+    def fetch_exact_law_articles(self, query: str, query_vectors=None, search_results=None) -> List[Document]:
+        """针对法律文档的精确检索（query_vectors、search_results 为检索计划的结果，见 _plan_search）"""
         if not self.retriever:
             return []
         if self.is_article_query(query):
@@ -340,13 +674,12 @@ class RAGService:
             article_num_match = re.search(r'第([一二三四五六七八九十百千万]+)条', query)
             if article_num_match:
                 cn_num = article_num_match.group(1)
-                article_num = convert_cn_to_int(cn_num)
-                retriever_config = {
-                    "search_type": "similarity",
-                    "search_kwargs": {"k": 20, "score_threshold": 0.05} # 降低阈值
-                }
                 try:
-                    docs = self.retriever.invoke(query)
+                    # 有BM25索引时直接读取“第X条”的倒排表，不再调用嵌入模型
+                    if self.lexical_index is not None:
+                        docs = self._lexical_search(query, required_terms=[f"第{cn_num}条"])
+                    else:
+                        docs = self._vector_search(query, query_vectors, search_results)
                     filtered_docs = []
                     for doc in docs:
                         if f"第{cn_num}条" in doc.page_content:
@@ -367,7 +700,10 @@ class RAGService:
         for ref in references:
             exact_query = ref['text']
             try:
-                docs = self.retriever.invoke(exact_query)
+                if self.lexical_index is not None:
+                    docs = self._lexical_search(query, required_terms=[exact_query])
+                else:
+                    docs = self._vector_search(exact_query, query_vectors, search_results)
                 filtered_docs = []
                 for doc in docs:
                     if ref['text'] in doc.page_content:
@@ -380,41 +716,83 @@ class RAGService:
         
         return exact_docs
 
-    def retrieve(self, query: str, top_k=5, threshold=0.05, force_refresh=False, rewrite=True):
-        """检索相关文档"""
-        # print(f"RAG检索开始，查询：{query}，知识库：{self.kb_name}")
+    def _begin_retrieval(self, query: str, top_k, threshold, force_refresh, rewrite):
+        """
+        检索前的准备：刷新法律结构，查找检索缓存，处理章节条款查询。
+        返回 (cache_key, docs)，docs 不为 None 时直接作为检索结果。
+        """
+        # 服务实例长期复用，检索前确认法律结构是否有更新
+        self.legal_retriever.reload_if_changed()
         
-        if not self.retriever:
-            print(f"错误：retriever 未初始化，可能是向量数据库不存在")
+        cache_key = self.get_cache_key(query, top_k=top_k, threshold=threshold, rewrite=rewrite)
+        if not force_refresh:
+            cached_docs = self.retrieval_cache.get(cache_key)
+            if cached_docs is not None:
+                return cache_key, cached_docs
+        
+        # 处理章节条款查询
+        chapter_docs = self._get_chapter_docs(query)
+        if chapter_docs:
+            self.retrieval_cache.set(cache_key, chapter_docs)
+            return cache_key, chapter_docs
+        
+        return cache_key, None
+
+    def _get_chapter_docs(self, query: str) -> List[Document]:
+        """章节条款查询返回该章的所有条款，不是章节查询或没有找到时返回空列表"""
+        if not self.is_chapter_query(query):
             return []
+        print("检测到章节条款查询，使用章节专用检索")
+        chapter_num = self.extract_chapter_num(query)
+        law_name = ""
+        query_info = self.parse_legal_query(query)
+        law_names = query_info.get("law_names", [])
+        if law_names:
+            law_name = law_names[0]
         
-        cache_key = self.get_cache_key(query)
-        if cache_key in retrieval_cache and not force_refresh:
-            cache_data = retrieval_cache[cache_key]
-            if time.time() - cache_data['timestamp'] < CACHE_EXPIRY:
-                return cache_data['docs']
+        chapter_docs = self.legal_retriever.retrieve_by_chapter(law_name, chapter_num)
+        if chapter_docs:
+            print(f"章节检索找到 {len(chapter_docs)} 个相关条款")
+        return chapter_docs or []
+
+    def _get_reference_queries(self, query: str) -> List[str]:
+        """fetch_exact_law_articles 中按条款编号做向量检索的查询；有BM25索引时直接读取倒排表，返回空列表"""
+        if self.lexical_index is not None or not self.is_legal_document_query(query):
+            return []
+        return [ref['text'] for ref in self.extract_law_references(query)]
+
+    def _get_article_queries(self, query: str) -> List[str]:
+        """简单条款查询的扩展查询列表，不是条款查询时返回空列表"""
+        if not self.is_article_query(query):
+            return []
+        # 有BM25索引时，包含该条款编号的文档已在精确匹配中通过倒排表找到，不需要改写查询再做向量检索
+        if self.lexical_index is not None:
+            return []
+        if not re.search(r'第([一二三四五六七八九十百千万]+)条', query):
+            return []
         
-        all_docs = []
+        # 根据查询情况构建增强查询
+        query_info = self.parse_legal_query(query)
+        law_names = query_info.get("law_names", [])
         
-        # 处理章节条款查询
-        if self.is_chapter_query(query):
-            print("检测到章节条款查询，使用章节专用检索")
-            chapter_num = self.extract_chapter_num(query)
-            law_name = ""
-            query_info = self.parse_legal_query(query)
-            law_names = query_info.get("law_names", [])
-            if law_names:
-                law_name = law_names[0]
-            
-            chapter_docs = self.legal_retriever.retrieve_by_chapter(law_name, chapter_num)
-            if chapter_docs:
-                print(f"章节检索找到 {len(chapter_docs)} 个相关条款")
-                retrieval_cache[cache_key] = {'docs': chapter_docs, 'timestamp': time.time()}
-                return chapter_docs
+        # 如果查询中指定了法律名称，优先尝试
+        if law_names:
+            return [f"{law_name}{query}" for law_name in law_names]
+        # 默认扩展查询
+        return [
+            f"中华人民共和国人口与计划生育法{query}",
+            f"人口与计划生育法{query}",
+            f"{query}人口与计划生育",
+            f"{query}内容"
+        ]
+
+    def _collect_candidates(self, query: str, top_k, query_vectors=None, search_results=None) -> List[Document]:
+        """收集候选文档：法律精确匹配、条款扩展查询和向量检索，并按元数据过滤"""
+        all_docs = []
         
         # 处理法律文档查询
         if self.is_legal_document_query(query):
-            exact_docs = self.fetch_exact_law_articles(query)
+            exact_docs = self.fetch_exact_law_articles(query, query_vectors, search_results)
             all_docs.extend(exact_docs)
             print(f"精确匹配找到 {len(exact_docs)} 个文档")
         
@@ -423,29 +801,10 @@ class RAGService:
             article_match = re.search(r'第([一二三四五六七八九十百千万]+)条', query)
             if article_match:
                 cn_num = article_match.group(1)
-                enhanced_queries = []
-                
-                # 根据查询情况构建增强查询
-                query_info = self.parse_legal_query(query)
-                law_names = query_info.get("law_names", [])
-                
-                # 如果查询中指定了法律名称，优先尝试
-                if law_names:
-                    for law_name in law_names:
-                        enhanced_queries.append(f"{law_name}{query}")
-                else:
-                    # 默认扩展查询
-                    enhanced_queries = [
-                        f"中华人民共和国人口与计划生育法{query}",
-                        f"人口与计划生育法{query}",
-                        f"{query}人口与计划生育",
-                        f"{query}内容"
-                    ]
-                
-                for enhanced_query in enhanced_queries:
+                for enhanced_query in self._get_article_queries(query):
                     print(f"尝试扩展查询: {enhanced_query}")
                     try:
-                        vector_docs = self.retriever.invoke(enhanced_query)
+                        vector_docs = self._vector_search(enhanced_query, query_vectors, search_results)
                         article_docs = [doc for doc in vector_docs if f"第{cn_num}条" in doc.page_content]
                         if article_docs:
                             for doc in article_docs:
@@ -459,10 +818,10 @@ class RAGService:
         
         # 如果没有找到足够的文档，使用普通向量检索
         if len(all_docs) < top_k:
-            remaining = top_k - len(all_docs)
             try:
-                print(f"执行向量检索...")
-                vector_docs = self.retriever.invoke(query)
+                print("执行向量检索...")
+                vector_docs = self._vector_search(query, query_vectors, search_results)
+                vector_docs = self._fuse_lexical(query, vector_docs, top_k)
                 # print(f"向量检索找到 {len(vector_docs)} 个文档")
                 
                 # 打印前三个结果的内容与分数
@@ -493,26 +852,35 @@ class RAGService:
         if re.search(r'第[一二三四五六七八九十百千万]+条', query):
             all_docs = [d for d in all_docs if d.metadata.get("content_type") != "article_list"]
         
-        # 使用重排序器
-        if self.reranker and len(all_docs) > 0:
-            try:
-                docs_content = [d.page_content for d in all_docs]
-                scores = self.reranker.compute_score([[query, kn] for kn in docs_content])
-                scores = scores if isinstance(scores, list) else [scores]
-                for d, score in zip(all_docs, scores):
-                    if 'exact_match' in d.metadata and d.metadata.get('exact_match', False):
-                        d.metadata["score"] = max(score, d.metadata.get("score", 0))
-                    else:
-                        d.metadata["score"] = score
-                all_docs = sorted(all_docs, key=lambda x: x.metadata.get("score", 0), reverse=True)
-                all_docs = all_docs[:top_k]
-                if threshold > 0:
-                    all_docs = [d for d in all_docs if d.metadata.get("score", 0) >= threshold]
-            except Exception as e:
-                print(f"重排序出错: {e}")
-                # 确保至少返回一些文档
-                all_docs = all_docs[:top_k]
-        
+        # 放宽的候选集过滤后，非精确匹配的文档只保留前 k 个（至少 top_k 个）
+        limit = max(self.retriever.search_kwargs.get('k', 4), top_k)
+        kept = []
+        for doc in all_docs:
+            if doc.metadata.get("exact_match"):
+                kept.append(doc)
+            elif limit > 0:
+                kept.append(doc)
+                limit -= 1
+        return kept
+
+    @staticmethod
+    def _apply_rerank_scores(all_docs: List[Document], scores, top_k, threshold) -> List[Document]:
+        """用重排序分数更新文档分数（精确匹配的文档保留较高的分数），排序并截断"""
+        scores = scores if isinstance(scores, list) else [scores]
+        for d, score in zip(all_docs, scores):
+            if 'exact_match' in d.metadata and d.metadata.get('exact_match', False):
+                d.metadata["score"] = max(score, d.metadata.get("score", 0))
+            else:
+                d.metadata["score"] = score
+        all_docs = sorted(all_docs, key=lambda x: x.metadata.get("score", 0), reverse=True)
+        all_docs = all_docs[:top_k]
+        if threshold > 0:
+            all_docs = [d for d in all_docs if d.metadata.get("score", 0) >= threshold]
+        return all_docs
+
+    def _finish_retrieval(self, query: str, all_docs: List[Document], top_k, cache_key,
+                          query_vectors=None, search_results=None) -> List[Document]:
+        """合并子块；没有结果时不加过滤再检索一次；缓存最终结果"""
         # 合并子块
         all_docs = self.post_process_merge_retrieved_docs(all_docs)
         
@@ -520,7 +888,7 @@ class RAGService:
         if not all_docs:
             print("未找到文档，尝试降低阈值并重新检索...")
             try:
-                vector_docs = self.retriever.invoke(query)
+                vector_docs = self._vector_search(query, query_vectors, search_results)
                 # 不做过滤，直接返回前几个结果
                 if vector_docs:
                     print(f"降低阈值后找到 {len(vector_docs)} 个文档")
@@ -534,15 +902,296 @@ class RAGService:
         # 缓存结果
         if all_docs:
             # print(f"最终找到 {len(all_docs)} 个文档")
-            retrieval_cache[cache_key] = {'docs': all_docs, 'timestamp': time.time()}
-            if len(retrieval_cache) > 100:
-                oldest_key = min(retrieval_cache.keys(), key=lambda k: retrieval_cache[k]['timestamp'])
-                del retrieval_cache[oldest_key]
+            self.retrieval_cache.set(cache_key, all_docs)
         else:
             print("最终未找到相关文档")
         
         return all_docs
 
+    def retrieve(self, query: str, top_k=5, threshold=0.05, force_refresh=False, rewrite=True):
+        """检索相关文档"""
+        # print(f"RAG检索开始，查询：{query}，知识库：{self.kb_name}")
+        
+        if not self.retriever:
+            print("错误：retriever 未初始化，可能是向量数据库不存在")
+            return []
+        
+        cache_key, docs = self._begin_retrieval(query, top_k, threshold, force_refresh, rewrite)
+        if docs is not None:
+            return docs
+        
+        query_vectors, search_results = self._plan_search([query])
+        all_docs = self._collect_candidates(query, top_k, query_vectors, search_results)
+        
+        # 使用重排序器
+        if self.reranker and len(all_docs) > 0:
+            try:
+                docs_content = [d.page_content for d in all_docs]
+                scores = self.reranker.compute_score([[query, kn] for kn in docs_content])
+                all_docs = self._apply_rerank_scores(all_docs, scores, top_k, threshold)
+            except Exception as e:
+                print(f"重排序出错: {e}")
+                # 确保至少返回一些文档
+                all_docs = all_docs[:top_k]
+        
+        return self._finish_retrieval(query, all_docs, top_k, cache_key, query_vectors, search_results)
+
+    async def aretrieve(self, query: str, top_k=5, threshold=0.05, force_refresh=False, rewrite=True):
+        """
+        异步检索，流程和结果与 retrieve 相同。
+        只有一个需要嵌入的文本时通过嵌入模型的异步接口获取向量，重排序使用异步接口，
+        FAISS检索、缓存读写等本地计算放到线程中执行，不阻塞事件循环。
+        """
+        if not self.retriever:
+            print("错误：retriever 未初始化，可能是向量数据库不存在")
+            return []
+        
+        cache_key, docs = await asyncio.to_thread(
+            self._begin_retrieval, query, top_k, threshold, force_refresh, rewrite
+        )
+        if docs is not None:
+            return docs
+        
+        query_vectors, search_results = await self._aplan_search([query])
+        all_docs = await asyncio.to_thread(self._collect_candidates, query, top_k, query_vectors, search_results)
+        
+        # 使用重排序器
+        if self.reranker and len(all_docs) > 0:
+            try:
+                pairs = [[query, d.page_content] for d in all_docs]
+                if hasattr(self.reranker, 'acompute_score'):
+                    scores = await self.reranker.acompute_score(pairs)
+                else:
+                    scores = await asyncio.to_thread(self.reranker.compute_score, pairs)
+                all_docs = self._apply_rerank_scores(all_docs, scores, top_k, threshold)
+            except Exception as e:
+                print(f"重排序出错: {e}")
+                # 确保至少返回一些文档
+                all_docs = all_docs[:top_k]
+        
+        return await asyncio.to_thread(
+            self._finish_retrieval, query, all_docs, top_k, cache_key, query_vectors, search_results
+        )
+
+    def _query_salience(self, query: str) -> int:
+        """查询的信息量：不同字符的数量，包含法律名称、章节条款编号的查询优先"""
+        salience = len({ch for ch in query if ch.isalnum()})
+        if self.is_legal_document_query(query):
+            salience += 100
+        return salience
+
+    def select_queries(self, queries: List[str], max_queries=None) -> List[str]:
+        """
+        多查询检索前规范化去重，去掉过短的查询，并按信息量保留最多 max_queries 个（保持原顺序）。
+        第一个查询（通常是用户的问题）总是保留。
+        """
+        config = get_multi_query_config()
+        max_queries = max_queries or config['max_queries']
+        
+        unique = []
+        seen = set()
+        for query in queries:
+            query = (query or '').strip()
+            key = normalize_query(query)
+            if key and key not in seen:
+                seen.add(key)
+                unique.append(query)
+        if not unique:
+            return []
+        
+        first = unique[0]
+        rest = [q for q in unique[1:] if len(q) >= config['min_query_chars']]
+        if len(rest) > max_queries - 1:
+            ranked = sorted(range(len(rest)), key=lambda i: self._query_salience(rest[i]), reverse=True)
+            rest = [rest[i] for i in sorted(ranked[:max(max_queries - 1, 0)])]
+        return [first] + rest
+
+    def _begin_retrieve_many(self, queries: List[str], top_k, threshold, force_refresh):
+        """多查询检索的缓存查找，返回 (cache_key, docs)，docs 不为 None 时直接作为检索结果"""
+        self.legal_retriever.reload_if_changed()
+        index_version = f"{self.index_generation}:{self.legal_retriever.generation}"
+        cache_key = self.retrieval_cache.make_key(
+            self.index_name, index_version, "\n".join(queries),
+            top_k=top_k, threshold=threshold, multi=True
+        )
+        if not force_refresh:
+            cached_docs = self.retrieval_cache.get(cache_key)
+            if cached_docs is not None:
+                return cache_key, cached_docs
+        return cache_key, None
+
+    def _get_query_variants(self, query: str) -> List[str]:
+        """查询本身及检索时会用到的条款编号查询、条款扩展查询"""
+        return [query] + self._get_reference_queries(query) + self._get_article_queries(query)
+
+    def _get_search_texts(self, queries: List[str]) -> List[str]:
+        """需要嵌入的所有文本：各个查询及其变体（去重）"""
+        return list(dict.fromkeys(text for query in queries for text in self._get_query_variants(query)))
+
+    def _get_search_filter(self, query: str):
+        """
+        查询中的法律名称、年份、会议对应的元数据位图过滤条件，条款查询还排除章节列表。
+        返回 (位图, 选中数量)，没有过滤条件或没有元数据索引时返回 None。
+        """
+        if self.metadata_index is None:
+            return None
+        exclude = ["article_list"] if re.search(r'第[一二三四五六七八九十百千万]+条', query) else []
+        return self.metadata_index.build_filter(self.parse_legal_query(query), exclude_content_types=exclude)
+
+    def _get_search_filters(self, queries: List[str]) -> Dict[str, Any]:
+        """{检索文本: 过滤条件}，查询的变体使用查询本身的过滤条件"""
+        search_filters = {}
+        for query in queries:
+            search_filter = self._get_search_filter(query)
+            if search_filter is not None:
+                for text in self._get_query_variants(query):
+                    search_filters.setdefault(text, search_filter)
+        return search_filters
+
+    def _embed_queries(self, texts: List[str]) -> Dict[str, List[float]]:
+        """一次请求嵌入所有查询，出错时返回空字典（检索时逐个调用嵌入模型）"""
+        try:
+            return dict(zip(texts, self.embeddings.embed_documents(texts)))
+        except Exception as e:
+            print(f"批量嵌入查询出错: {e}")
+            return {}
+
+    def _plan_search(self, queries: List[str]):
+        """
+        检索计划：收集查询及其所有变体（条款编号查询、条款扩展查询），一次请求嵌入，再一次FAISS批量检索
+        （查询中有法律名称、年份等条件时只检索满足条件的文本块）。
+        返回 (query_vectors, search_results)，之后的精确匹配、向量检索和兜底检索都从中读取，不再调用嵌入模型。
+        """
+        texts = self._get_search_texts(queries)
+        query_vectors = self._embed_queries(texts)
+        return query_vectors, self._batch_vector_search(texts, query_vectors, self._get_search_filters(queries))
+
+    async def _aplan_search(self, queries: List[str]):
+        """_plan_search 的异步版本，只有一个文本时使用嵌入模型的异步接口"""
+        texts = self._get_search_texts(queries)
+        if len(texts) == 1:
+            try:
+                query_vectors = {texts[0]: await self.embeddings.aembed_query(texts[0])}
+            except Exception as e:
+                print(f"嵌入查询出错: {e}")
+                query_vectors = {}
+        else:
+            query_vectors = await asyncio.to_thread(self._embed_queries, texts)
+        return query_vectors, await asyncio.to_thread(
+            self._batch_vector_search, texts, query_vectors, self._get_search_filters(queries)
+        )
+
+    def _collect_many(self, queries: List[str], top_k, query_vectors, search_results) -> List[Document]:
+        """
+        按检索计划的结果逐个查询收集候选文档（含法律精确匹配和章节查询），
+        按内容合并去重，metadata['original_query'] 记录最先检索到该文档的查询
+        """
+        unique_docs = {}
+        for query in queries:
+            docs = self._get_chapter_docs(query)
+            if docs:
+                docs = [Document(page_content=d.page_content, metadata=dict(d.metadata, exact_match=True))
+                        for d in docs]
+            else:
+                docs = self._collect_candidates(query, top_k, query_vectors, search_results)
+            for doc in docs:
+                content = doc.page_content.strip()
+                existing = unique_docs.get(content)
+                if existing is None or (doc.metadata.get('exact_match') and not existing.metadata.get('exact_match')):
+                    doc.metadata['original_query'] = query[:50]
+                    unique_docs[content] = doc
+        return list(unique_docs.values())
+
+    def get_rerank_query(self, queries: List[str]) -> str:
+        """合并候选文档统一重排序时使用的查询：按顺序拼接各个查询，截取前 rerank_query_chars 个字符"""
+        return "\n".join(queries)[:get_multi_query_config()['rerank_query_chars']]
+
+    def _finish_retrieve_many(self, all_docs: List[Document], cache_key) -> List[Document]:
+        all_docs = self.post_process_merge_retrieved_docs(all_docs)
+        if all_docs:
+            self.retrieval_cache.set(cache_key, all_docs)
+        else:
+            print("多查询检索未找到相关文档")
+        return all_docs
+
+    def retrieve_many(self, queries: List[str], top_k=5, threshold=0.05, max_queries=None, force_refresh=False):
+        """
+        多查询检索（如附件的各个段落）。
+        所有查询一次批量嵌入、一次FAISS批量检索，候选文档合并去重后只重排序一次，
+        返回按分数排序、分数达到 threshold 的最多 top_k 个文档。
+        查询数量超过 max_queries（默认 RAG_CONFIGS['multi_query']['max_queries']）时按信息量保留。
+        """
+        if not self.retriever:
+            print("错误：retriever 未初始化，可能是向量数据库不存在")
+            return []
+        
+        queries = self.select_queries(queries, max_queries)
+        if not queries:
+            return []
+        cache_key, docs = self._begin_retrieve_many(queries, top_k, threshold, force_refresh)
+        if docs is not None:
+            return docs
+        
+        print(f"多查询检索: {len(queries)} 个查询")
+        query_vectors, search_results = self._plan_search(queries)
+        all_docs = self._collect_many(queries, top_k, query_vectors, search_results)
+        
+        # 使用重排序器
+        if self.reranker and len(all_docs) > 0:
+            try:
+                rerank_query = self.get_rerank_query(queries)
+                scores = self.reranker.compute_score([[rerank_query, d.page_content] for d in all_docs])
+                all_docs = self._apply_rerank_scores(all_docs, scores, top_k, threshold)
+            except Exception as e:
+                print(f"重排序出错: {e}")
+                all_docs = all_docs[:top_k]
+        else:
+            # 没有重排序器时按检索分数（精确匹配优先）排序截断
+            all_docs = sorted(all_docs, key=lambda d: d.metadata.get("score", 0), reverse=True)[:top_k]
+        
+        return self._finish_retrieve_many(all_docs, cache_key)
+
+    async def aretrieve_many(self, queries: List[str], top_k=5, threshold=0.05, max_queries=None,
+                             force_refresh=False):
+        """
+        retrieve_many 的异步版本。
+        批量嵌入只有一次请求，和FAISS检索等本地计算一起放到线程中执行；重排序使用异步接口。
+        """
+        if not self.retriever:
+            print("错误：retriever 未初始化，可能是向量数据库不存在")
+            return []
+        
+        queries = self.select_queries(queries, max_queries)
+        if not queries:
+            return []
+        cache_key, docs = await asyncio.to_thread(
+            self._begin_retrieve_many, queries, top_k, threshold, force_refresh
+        )
+        if docs is not None:
+            return docs
+        
+        print(f"多查询检索: {len(queries)} 个查询")
+        query_vectors, search_results = await asyncio.to_thread(self._plan_search, queries)
+        all_docs = await asyncio.to_thread(self._collect_many, queries, top_k, query_vectors, search_results)
+        
+        # 使用重排序器
+        if self.reranker and len(all_docs) > 0:
+            try:
+                pairs = [[self.get_rerank_query(queries), d.page_content] for d in all_docs]
+                if hasattr(self.reranker, 'acompute_score'):
+                    scores = await self.reranker.acompute_score(pairs)
+                else:
+                    scores = await asyncio.to_thread(self.reranker.compute_score, pairs)
+                all_docs = self._apply_rerank_scores(all_docs, scores, top_k, threshold)
+            except Exception as e:
+                print(f"重排序出错: {e}")
+                all_docs = all_docs[:top_k]
+        else:
+            # 没有重排序器时按检索分数（精确匹配优先）排序截断
+            all_docs = sorted(all_docs, key=lambda d: d.metadata.get("score", 0), reverse=True)[:top_k]
+        
+        return await asyncio.to_thread(self._finish_retrieve_many, all_docs, cache_key)
+
     def create_prompt(self, question: str, docs: list) -> str:
         """创建提示词"""
         if not docs:
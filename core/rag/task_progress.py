@@ -0,0 +1,69 @@
+# core/rag/task_progress.py
+"""
+知识库处理任务的进度存储。
+进度和取消标记保存在 RAG_CONFIGS['progress'] 指定的Django缓存中（默认 'shared'），
+Web进程和工作进程都能读取，过期后自动清除。
+"""
+import time
+import threading
+from django.conf import settings
+
+# 结束状态，总是立即写入
+FINAL_STATUSES = ('completed', 'error', 'cancelled')
+
+_last_writes = {}
+_last_writes_lock = threading.Lock()
+
+def get_progress_config():
+    """读取 RAG_CONFIGS['progress']"""
+    progress_config = getattr(settings, 'RAG_CONFIGS', {}).get('progress', {})
+    return {
+        'cache_alias': progress_config.get('cache_alias', 'shared'),
+        'ttl': int(progress_config.get('ttl', 86400)),
+        'min_interval': float(progress_config.get('min_interval', 0.5)),
+    }
+
+def _get_cache():
+    from django.core.cache import caches
+    return caches[get_progress_config()['cache_alias']]
+
+def get_task_group(kb_id, task_id):
+    """任务的键名"""
+    return f'kb_{kb_id}_{task_id}'
+
+def set_task_progress(group_name, data, force=False):
+    """
+    写入任务进度。
+    同一状态下距上次写入不足 min_interval 秒的更新直接丢弃，避免逐批更新造成大量缓存写入；
+    状态变化和结束状态总是写入。返回是否写入。
+    """
+    config = get_progress_config()
+    status = data.get('status')
+    now = time.time()
+    with _last_writes_lock:
+        last = _last_writes.get(group_name)
+        if (not force and status not in FINAL_STATUSES and last is not None
+                and last[1] == status and now - last[0] < config['min_interval']):
+            return False
+        if status in FINAL_STATUSES:
+            _last_writes.pop(group_name, None)
+        else:
+            _last_writes[group_name] = (now, status)
+    _get_cache().set(f'rag:progress:{group_name}', data, timeout=config['ttl'])
+    return True
+
+def get_task_progress(group_name):
+    """读取任务进度，已请求取消的任务状态显示为 cancelled"""
+    cache = _get_cache()
+    data = cache.get(f'rag:progress:{group_name}')
+    if data and is_task_cancelled(group_name):
+        data = dict(data, status='cancelled', message='处理已取消')
+    return data
+
+def request_task_cancel(group_name):
+    """设置取消标记，处理流程在下一批次前检查该标记"""
+    _get_cache().set(f'rag:progress:{group_name}:cancel', True, timeout=get_progress_config()['ttl'])
+
+def is_task_cancelled(group_name):
+    """检查取消标记"""
+    return bool(_get_cache().get(f'rag:progress:{group_name}:cancel'))
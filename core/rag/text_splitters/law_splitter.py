@@ -4,8 +4,9 @@ from langchain_core.documents import Document
 
 def extract_law_metadata(text: str) -> Dict[str, Any]:
     """提取法律文档头部元信息（年份、会议、修订时间）"""
-    passed_date_match = re.search(r"（?(\d{4}年\d{1,2}月\d{1,2}日)[^）]{0,20}通过", text)
-    revised_dates = re.findall(r"(?:根据)?(\d{4}年\d{1,2}月\d{1,2}日)[^）]{0,20}(?:修正|修改)", text)
+    # 日期与“通过”之间通常是会议名称（如“第九届全国人民代表大会常务委员会第二十五次会议”，超过20个字）
+    passed_date_match = re.search(r"（?(\d{4}年\d{1,2}月\d{1,2}日)[^）]{0,40}?通过", text)
+    revised_dates = re.findall(r"(?:根据)?(\d{4}年\d{1,2}月\d{1,2}日)[^）]{0,40}?(?:修正|修改)", text)
     meetings = re.findall(r"(第[一二三四五六七八九十]{1,3}届全国人民代表大会常务委员会[^）]*会议)", text)
     return {
         "passed_date": passed_date_match.group(1) if passed_date_match else None,
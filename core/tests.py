@@ -0,0 +1,285 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from django.test import SimpleTestCase
+from core.rag.embedding import OllamaEmbedding
+from core.rag.reranker import RerankError, SiliconflowReranker
+
+def stub_score(doc):
+    """模拟服务给出的分数：文档越长分数越高"""
+    return len(doc) / 100
+
+class StubServer(ThreadingHTTPServer):
+    """
+    本地模拟接口服务，记录收到的请求体。
+    statuses 中的状态码依次用于之后的请求（为空时返回200），delay 为每次成功返回前的等待时间。
+    """
+    daemon_threads = True
+
+    def __init__(self, handler):
+        self.requests = []
+        self.statuses = deque()
+        self.delay = 0
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), handler)
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+            self.statuses.clear()
+            self.delay = 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+class StubHandler(BaseHTTPRequestHandler):
+    def read_request(self):
+        """记录请求体，返回 (请求体, 状态码)"""
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        with self.server.lock:
+            self.server.requests.append((self.path, body))
+            status = self.server.statuses.popleft() if self.server.statuses else 200
+        return body, status
+
+    def send_json(self, status, data):
+        payload = json.dumps(data).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端已超时断开
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+class StubRerankHandler(StubHandler):
+    """模拟 Silicon Flow 重排序接口"""
+    def do_POST(self):
+        body, status = self.read_request()
+        if status != 200:
+            self.send_json(status, {'message': 'error'})
+            return
+        time.sleep(self.server.delay)
+        # 按分数从高到低返回，与真实接口一致
+        results = sorted(
+            ({'index': i, 'relevance_score': stub_score(doc)} for i, doc in enumerate(body['documents'])),
+            key=lambda item: item['relevance_score'], reverse=True,
+        )
+        self.send_json(200, {'results': results[:body.get('top_n') or len(results)]})
+
+def stub_vector(text):
+    """模拟嵌入：文本“文本N”的向量为归一化的 [N, 1]"""
+    vector = np.array([float(text[2:]), 1.0])
+    return (vector / np.linalg.norm(vector)).tolist()
+
+class StubOllamaHandler(StubHandler):
+    """
+    模拟Ollama嵌入接口。
+    server.batch_supported 为 False 时模拟旧版本（没有 /api/embed，返回纯文本404）；
+    模型不是 stub-embedding 时与Ollama一样返回带 error 字段的404。
+    """
+    def do_POST(self):
+        body, _ = self.read_request()
+        if self.path == '/api/embed' and not self.server.batch_supported:
+            payload = b'404 page not found'
+            self.send_response(404)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        if body.get('model') != 'stub-embedding':
+            self.send_json(404, {'error': f"model \"{body.get('model')}\" not found, try pulling it first"})
+            return
+
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            if self.path == '/api/embed':
+                # 前面的批次较慢，并发时后面的批次先返回
+                time.sleep(self.server.delay / (1 + float(body['input'][0][2:])))
+                self.send_json(200, {'model': body['model'], 'embeddings': [stub_vector(t) for t in body['input']]})
+            else:
+                self.send_json(200, {'embedding': stub_vector(body['prompt'])})
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+class StubServerTestCase(SimpleTestCase):
+    handler = StubHandler
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = StubServer(cls.handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.reset()
+
+class RerankerTests(StubServerTestCase):
+    handler = StubRerankHandler
+    docs = ['甲', '乙乙乙', '丙丙', '丁丁丁丁', '戊']
+
+    def make_reranker(self, **options):
+        options = {'batch_size': 32, 'max_retries': 2, 'backoff': 0.01, 'timeout': 5.0, **options}
+        return SiliconflowReranker(model_name='stub-reranker', api_key='test',
+                                   base_url=f'{self.server.url}/v1/rerank', **options)
+
+    def pairs(self, query='查询', docs=None):
+        return [[query, doc] for doc in docs or self.docs]
+
+    def expected(self, docs=None):
+        return [stub_score(doc) for doc in docs or self.docs]
+
+    def test_sub_batches(self):
+        reranker = self.make_reranker(batch_size=2)
+        self.assertEqual(reranker.compute_score(self.pairs()), self.expected())
+        self.assertEqual(sorted(len(body['documents']) for _, body in self.server.requests), [1, 2, 2])
+
+    def test_sub_batches_async(self):
+        reranker = self.make_reranker(batch_size=2)
+        self.assertEqual(asyncio.run(reranker.acompute_score(self.pairs())), self.expected())
+        self.assertEqual(sorted(len(body['documents']) for _, body in self.server.requests), [1, 2, 2])
+
+    def test_cache_hits(self):
+        reranker = self.make_reranker()
+        reranker.compute_score(self.pairs())
+        self.assertEqual(reranker.compute_score(self.pairs()), self.expected())
+        self.assertEqual(asyncio.run(reranker.acompute_score(self.pairs())), self.expected())
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(reranker.stats()['hits'], 2 * len(self.docs))
+
+        # 只有未缓存的文档会发送给接口
+        reranker.compute_score(self.pairs(docs=self.docs + ['己己']))
+        self.assertEqual(self.server.requests[-1][1]['documents'], ['己己'])
+
+    def test_retry_then_success(self):
+        reranker = self.make_reranker()
+        for status in (429, 503):
+            with self.subTest(status=status):
+                self.server.reset()
+                self.server.statuses.extend([status, status])
+                self.assertEqual(reranker.compute_score(self.pairs(query=f'同步{status}')), self.expected())
+                self.assertEqual(len(self.server.requests), 3)
+
+                self.server.reset()
+                self.server.statuses.extend([status, status])
+                scores = asyncio.run(reranker.acompute_score(self.pairs(query=f'异步{status}')))
+                self.assertEqual(scores, self.expected())
+                self.assertEqual(len(self.server.requests), 3)
+
+    def test_gives_up_after_max_retries(self):
+        reranker = self.make_reranker(max_retries=2)
+        self.server.statuses.extend([500] * 3)
+        with self.assertRaises(RerankError):
+            reranker.compute_score(self.pairs())
+        self.assertEqual(len(self.server.requests), 3)
+
+        self.server.reset()
+        self.server.statuses.extend([502] * 3)
+        with self.assertRaises(RerankError):
+            asyncio.run(reranker.acompute_score(self.pairs()))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_deadline(self):
+        reranker = self.make_reranker(timeout=0.3)
+        self.server.delay = 1.0
+        start = time.monotonic()
+        with self.assertRaises(RerankError):
+            reranker.compute_score(self.pairs())
+        self.assertLess(time.monotonic() - start, 0.9)
+
+        # 调用时指定的 timeout 优先于配置
+        reranker = self.make_reranker(timeout=30)
+        start = time.monotonic()
+        with self.assertRaises(RerankError):
+            asyncio.run(reranker.acompute_score(self.pairs(), timeout=0.3))
+        self.assertLess(time.monotonic() - start, 0.9)
+
+    def test_apply_top_n(self):
+        scores = [0.1, 0.9, 0.5, 0.7]
+        self.assertEqual(SiliconflowReranker._apply_top_n(scores, 2), [0.0, 0.9, 0.0, 0.7])
+        self.assertEqual(SiliconflowReranker._apply_top_n(scores, None), scores)
+        self.assertEqual(SiliconflowReranker._apply_top_n(scores, 10), scores)
+
+        reranker = self.make_reranker()
+        self.assertEqual(reranker.compute_score(self.pairs(), top_n=2), [0.0, 0.03, 0.0, 0.04, 0.0])
+
+class OllamaEmbeddingTests(StubServerTestCase):
+    handler = StubOllamaHandler
+    texts = [f'文本{i}' for i in range(7)]
+
+    def setUp(self):
+        super().setUp()
+        self.server.batch_supported = True
+        self.server.active = 0
+        self.server.max_active = 0
+
+    def make_embeddings(self, model_name='stub-embedding', **options):
+        return OllamaEmbedding(model_name=model_name, base_url=f'{self.server.url}/api', **options)
+
+    def paths(self):
+        return [path for path, _ in self.server.requests]
+
+    def assertVectors(self, vectors, texts):
+        self.assertEqual(len(vectors), len(texts))
+        for vector, text in zip(vectors, texts):
+            np.testing.assert_allclose(vector, stub_vector(text), rtol=1e-6)
+
+    def test_batches_with_configured_batch_size(self):
+        embeddings = self.make_embeddings(batch_size=3)
+        self.assertVectors(embeddings.embed_documents(self.texts), self.texts)
+        self.assertEqual(set(self.paths()), {'/api/embed'})
+        self.assertEqual(sorted(len(body['input']) for _, body in self.server.requests), [1, 3, 3])
+        self.assertTrue(embeddings.supports_batch)
+
+    def test_concurrent_batches_keep_input_order(self):
+        self.server.delay = 0.2
+        embeddings = self.make_embeddings(batch_size=1, max_concurrency=4)
+        self.assertVectors(embeddings.embed_documents(self.texts), self.texts)
+        self.assertEqual(len(self.server.requests), len(self.texts))
+        self.assertGreater(self.server.max_active, 1)
+
+    def test_falls_back_to_single_endpoint_on_404(self):
+        self.server.batch_supported = False
+        embeddings = self.make_embeddings(batch_size=3)
+        self.assertVectors(embeddings.embed_documents(self.texts), self.texts)
+        self.assertFalse(embeddings.supports_batch)
+        # 只探测一次批量接口，之后每个文本请求一次 /api/embeddings
+        self.assertEqual(self.paths().count('/api/embed'), 1)
+        self.assertEqual(self.paths().count('/api/embeddings'), len(self.texts))
+
+        self.server.reset()
+        embeddings = self.make_embeddings()
+        self.assertVectors([asyncio.run(embeddings.aembed_query('文本3'))], ['文本3'])
+        self.assertFalse(embeddings.supports_batch)
+        self.assertEqual(self.paths(), ['/api/embed', '/api/embeddings'])
+
+    def test_model_not_found_keeps_batch_endpoint(self):
+        embeddings = self.make_embeddings(model_name='missing-model')
+        self.assertEqual(embeddings.embed_query('文本1'), [0.0] * 1024)
+        self.assertEqual(asyncio.run(embeddings.aembed_query('文本1')), [0.0] * 1024)
+        self.assertIsNone(embeddings.supports_batch)
+        self.assertEqual(self.paths(), ['/api/embed', '/api/embed'])
+
+        # 模型可用后仍然使用批量接口
+        embeddings.model_name = 'stub-embedding'
+        self.assertVectors(embeddings.embed_documents(self.texts[:2]), self.texts[:2])
+        self.assertTrue(embeddings.supports_batch)
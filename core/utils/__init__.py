@@ -2,7 +2,7 @@
 # 空文件
 
 # core/utils/__init__.py
-from .common import print_colorful, log_message, random_icon, get_hash_of_file, read_json_file, save_json_file, Fore
+from .common import print_colorful, log_message, random_icon, get_hash_of_file, get_hash_of_chunks, get_loop_bound_client, read_json_file, save_json_file, Fore
 
 # core/rag/__init__.py
 # 空文件
@@ -3,6 +3,7 @@ import random
 import hashlib
 import os
 import json
+import asyncio
 from datetime import datetime
 
 class Fore:
@@ -45,11 +46,36 @@ def random_icon(idx=None):
     else:
         return icons[idx % n]
 
-def get_hash_of_file(path):
-    """获取文件的MD5哈希值"""
+# 计算文件哈希时每次读取的块大小
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def get_hash_of_chunks(chunks):
+    """对字节块流计算BLAKE2b哈希值（64位十六进制），不需要把整个文件读入内存"""
+    hasher = hashlib.blake2b(digest_size=32)
+    for chunk in chunks:
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+def get_hash_of_file(path, block_size=HASH_BLOCK_SIZE):
+    """按固定大小分块读取文件，计算BLAKE2b哈希值"""
     with open(path, "rb") as f:
-        readable_hash = hashlib.md5(f.read()).hexdigest()
-    return readable_hash
+        return get_hash_of_chunks(iter(lambda: f.read(block_size), b""))
+
+def get_loop_bound_client(registry, key, factory):
+    """
+    返回当前事件循环中 key 对应的异步客户端，不存在时调用 factory 创建。
+    registry 是调用方持有的 weakref.WeakKeyDictionary。
+    httpx.AsyncClient 的连接池只能在创建它的事件循环中使用，而开发服务器每个异步请求都使用新的事件循环，
+    因此按事件循环分别缓存，循环结束后对应的客户端随之释放；同一循环中相同 key 的请求共享连接池。
+    """
+    loop = asyncio.get_running_loop()
+    clients = registry.get(loop)
+    if clients is None:
+        clients = registry[loop] = {}
+    client = clients.get(key)
+    if client is None:
+        client = clients[key] = factory()
+    return client
 
 def read_json_file(path):
     """安全地读取JSON文件"""
@@ -1,4 +1,4 @@
-import api from './index';
+import api, { postEventStream } from './index';
 
 export const chatAPI = {
   // 发送消息
@@ -22,21 +22,17 @@ export const chatAPI = {
     });
   },
   
-  // 发送流式消息请求
-  sendStreamMessage: (data) => {
+  // 发送流式消息请求，onEvent 依次收到 related_docs、thinking、answer、error 和 done 事件
+  sendStreamMessage: (data, onEvent, signal) => {
     console.log('API sendStreamMessage');
-    // 这个方法不返回Promise，因为它使用的是EventSource
-    // 调用者需要自己处理流式响应
-    const queryParams = new URLSearchParams({
+    return postEventStream('/chat/stream/', {
       message: data.message,
-      history_id: data.history_id || '',
+      history_id: data.history_id || null,
       model: data.model || 'deepseek-r1',
       use_rag: data.use_rag || false,
       knowledge_base: data.knowledge_base || '',
-      system_prompt_id: data.system_prompt_id || ''
-    }).toString();
-    
-    return `/api/chat/stream/?${queryParams}`;
+      system_prompt_id: data.system_prompt_id || null
+    }, onEvent, signal);
   },
   
   // 获取聊天历史列表
@@ -38,6 +38,61 @@ api.interceptors.response.use(
   }
 );
 
+// 以POST请求读取SSE事件流：fetch 可以设置 Authorization 请求头，令牌不会出现在URL中
+// onEvent(event, data) 依次收到服务端发送的事件，返回的Promise在事件流结束时完成
+export const postEventStream = async (url, data, onEvent, signal) => {
+  const token = localStorage.getItem('token');
+  const response = await fetch(`${api.defaults.baseURL}${url}`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'Accept': 'text/event-stream',
+      ...(token ? { 'Authorization': `Bearer ${token}` } : {})
+    },
+    body: JSON.stringify(data),
+    signal
+  });
+  if (response.status === 401) {
+    localStorage.removeItem('token');
+    window.location.href = '/login';
+    return;
+  }
+
+  // 出错时服务端同样以 error 事件返回错误信息
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  const dispatch = (block) => {
+    let event = 'message';
+    const dataLines = [];
+    for (const line of block.split('\n')) {
+      if (line.startsWith('event:')) {
+        event = line.slice(6).trim();
+      } else if (line.startsWith('data:')) {
+        dataLines.push(line.slice(5).trimStart());
+      }
+    }
+    if (dataLines.length) {
+      onEvent(event, JSON.parse(dataLines.join('\n')));
+    }
+  };
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      dispatch(buffer.slice(0, boundary));
+      buffer = buffer.slice(boundary + 2);
+    }
+  }
+  if (buffer.trim()) {
+    dispatch(buffer);
+  }
+};
+
 // 设置 API
 export const settingsAPI = {
   // 获取用户设置
@@ -110,21 +165,17 @@ export const chatAPI = {
     });
   },
   
-  // 发送流式消息请求
-  sendStreamMessage: (data) => {
+  // 发送流式消息请求，onEvent 依次收到 related_docs、thinking、answer、error 和 done 事件
+  sendStreamMessage: (data, onEvent, signal) => {
     console.log('API sendStreamMessage');
-    // 这个方法不返回Promise，因为它使用的是EventSource
-    // 调用者需要自己处理流式响应
-    const queryParams = new URLSearchParams({
+    return postEventStream('/chat/stream/', {
       message: data.message,
-      history_id: data.history_id || '',
+      history_id: data.history_id || null,
       model: data.model || 'deepseek-r1',
       use_rag: data.use_rag || false,
       knowledge_base: data.knowledge_base || '',
-      system_prompt_id: data.system_prompt_id || ''
-    }).toString();
-    
-    return `/api/chat/stream/?${queryParams}`;
+      system_prompt_id: data.system_prompt_id || null
+    }, onEvent, signal);
   },
   
   // 获取聊天历史列表
@@ -190,9 +241,10 @@ export const knowledgeAPI = {
     });
   },
   
-  // 获取处理进度
-  getProcessingProgress: (knowledgeBaseId, taskId) => {
-    return api.get(`/knowledge-base/${knowledgeBaseId}/progress/${taskId}/`);
+  // 获取处理进度，传入上次的时间戳时使用长轮询，进度更新后才返回
+  getProcessingProgress: (knowledgeBaseId, taskId, since = null) => {
+    const params = since ? { since, wait: 25 } : {};
+    return api.get(`/knowledge-base/${knowledgeBaseId}/progress/${taskId}/`, { params });
   },
   
   // 取消处理
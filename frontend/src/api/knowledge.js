@@ -42,9 +42,10 @@ export const knowledgeAPI = {
     });
   },
   
-  // 获取处理进度
-  getProcessingProgress: (knowledgeBaseId, taskId) => {
-    return api.get(`/knowledge-base/${knowledgeBaseId}/progress/${taskId}/`);
+  // 获取处理进度，传入上次的时间戳时使用长轮询，进度更新后才返回
+  getProcessingProgress: (knowledgeBaseId, taskId, since = null) => {
+    const params = since ? { since, wait: 25 } : {};
+    return api.get(`/knowledge-base/${knowledgeBaseId}/progress/${taskId}/`, { params });
   },
   
   // 取消处理
@@ -15,7 +15,8 @@ const ProcessingModal = ({
   const [status, setStatus] = useState('initializing');
   const [message, setMessage] = useState('正在初始化...');
   const [error, setError] = useState(null);
-  const intervalRef = useRef(null); // 使用useRef存储interval ID
+  const intervalRef = useRef(null); // 使用useRef存储下一次请求的timer ID
+  const lastTimestampRef = useRef(null); // 上次收到的进度时间戳，用于长轮询
   const isCompletedRef = useRef(false); // 追踪是否已完成
   const retryCountRef = useRef(0); // 重试计数器
 
@@ -25,7 +26,7 @@ const ProcessingModal = ({
     const clearPolling = () => {
       if (intervalRef.current) {
         console.log('停止轮询');
-        clearInterval(intervalRef.current);
+        clearTimeout(intervalRef.current);
         intervalRef.current = null;
       }
     };
@@ -38,12 +39,17 @@ const ProcessingModal = ({
       setStatus('initializing'); // 重置状态
       setMessage('正在初始化...'); // 重置消息
       
-      // 立即查询一次进度
-      fetchProgress();
+      lastTimestampRef.current = null;
       
-      // 设置轮询间隔
+      // 长轮询：后端在进度更新后才返回，返回后立即发起下一次请求，出错时等待1秒再重试
+      const poll = async () => {
+        await fetchProgress();
+        if (!isCompletedRef.current && intervalRef.current) {
+          intervalRef.current = setTimeout(poll, retryCountRef.current > 0 ? 1000 : 0);
+        }
+      };
       if (!intervalRef.current) {
-        intervalRef.current = setInterval(fetchProgress, 1000);
+        intervalRef.current = setTimeout(poll, 0);
       }
     } else {
       // 如果modal不可见，停止轮询
@@ -60,9 +66,13 @@ const ProcessingModal = ({
     if (isCompletedRef.current || !visible || !knowledgeBaseId || !taskId) return;
     
     try {
-      const response = await knowledgeAPI.getProcessingProgress(knowledgeBaseId, taskId);
+      const response = await knowledgeAPI.getProcessingProgress(knowledgeBaseId, taskId, lastTimestampRef.current);
       const data = response.data;
       
+      if (data.timestamp) {
+        lastTimestampRef.current = data.timestamp;
+      }
+      
       console.log('获取进度信息:', data);
       retryCountRef.current = 0; // 成功获取数据，重置重试计数
       
@@ -83,7 +93,7 @@ const ProcessingModal = ({
         
         // 明确停止轮询
         if (intervalRef.current) {
-          clearInterval(intervalRef.current);
+          clearTimeout(intervalRef.current);
           intervalRef.current = null;
         }
         
@@ -104,7 +114,7 @@ const ProcessingModal = ({
           isCompletedRef.current = true;
           
           if (intervalRef.current) {
-            clearInterval(intervalRef.current);
+            clearTimeout(intervalRef.current);
             intervalRef.current = null;
           }
         }
@@ -120,7 +130,7 @@ const ProcessingModal = ({
         // 出错次数过多时停止轮询
         isCompletedRef.current = true;
         if (intervalRef.current) {
-          clearInterval(intervalRef.current);
+          clearTimeout(intervalRef.current);
           intervalRef.current = null;
         }
       }
@@ -137,7 +147,7 @@ const ProcessingModal = ({
       // 停止轮询
       isCompletedRef.current = true;
       if (intervalRef.current) {
-        clearInterval(intervalRef.current);
+        clearTimeout(intervalRef.current);
         intervalRef.current = null;
       }
       
@@ -156,7 +166,7 @@ const ProcessingModal = ({
       // 标记完成状态
       isCompletedRef.current = true;
       if (intervalRef.current) {
-        clearInterval(intervalRef.current);
+        clearTimeout(intervalRef.current);
         intervalRef.current = null;
       }
     }
@@ -167,7 +177,7 @@ const ProcessingModal = ({
     // 确保关闭时停止轮询
     isCompletedRef.current = true;
     if (intervalRef.current) {
-      clearInterval(intervalRef.current);
+      clearTimeout(intervalRef.current);
       intervalRef.current = null;
     }
     
@@ -141,7 +141,8 @@ const KnowledgeBasePage = () => {
             chunk_size: 8000,
             chunk_overlap: 50,
             merge_rows: 2,
-            embedding_type: 'local'
+            embedding_type: 'local',
+            index_type: 'flat'
           }}
         >
           <Form.Item
@@ -170,6 +171,19 @@ const KnowledgeBasePage = () => {
             </Radio.Group>
           </Form.Item>
           
+          <Form.Item
+            name="index_type"
+            label="向量索引类型"
+            tooltip="文档较少时使用精确检索；大规模知识库可选择近似索引以降低检索延迟和内存占用"
+          >
+            <Radio.Group>
+              <Radio value="flat">精确检索 (Flat)</Radio>
+              <Radio value="ivf_flat">IVF-Flat</Radio>
+              <Radio value="ivf_pq">IVF-PQ</Radio>
+              <Radio value="hnsw">HNSW</Radio>
+            </Radio.Group>
+          </Form.Item>
+          
           <Form.Item
             name="chunk_size"
             label="块大小"
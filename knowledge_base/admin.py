@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import KnowledgeBase, Document
+from .models import KnowledgeBase, Document, ProcessingJob
 
 class DocumentInline(admin.TabularInline):
     model = Document
@@ -34,4 +34,17 @@ class DocumentAdmin(admin.ModelAdmin):
         qs = super().get_queryset(request)
         if request.user.is_superuser:
             return qs
-        return qs.filter(knowledge_base__user=request.user)
\ No newline at end of file
+        return qs.filter(knowledge_base__user=request.user)
+
+@admin.register(ProcessingJob)
+class ProcessingJobAdmin(admin.ModelAdmin):
+    list_display = ['task_id', 'knowledge_base', 'user', 'status', 'attempts', 'progress', 'total', 'created_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['task_id', 'knowledge_base__name']
+    readonly_fields = ['created_at', 'started_at', 'finished_at', 'heartbeat_at', 'worker_id']
+    
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        if request.user.is_superuser:
+            return qs
+        return qs.filter(user=request.user)
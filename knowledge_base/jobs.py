@@ -0,0 +1,265 @@
+# knowledge_base/jobs.py
+"""
+基于数据库的知识库处理任务队列。
+Web进程只负责写入 ProcessingJob，由 process_kb_jobs 命令启动的工作进程领取并执行，
+不依赖外部消息队列，SQLite 下也能运行。
+"""
+import os
+import socket
+import threading
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Exists, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from core.rag.document_processor import process_documents
+from core.rag.task_progress import get_task_group, get_task_progress, request_task_cancel
+from core.utils import print_colorful, Fore
+from .models import ProcessingJob
+
+def get_job_config():
+    """读取 RAG_CONFIGS['jobs']"""
+    job_config = getattr(settings, 'RAG_CONFIGS', {}).get('jobs', {})
+    return {
+        'global_concurrency': max(1, int(job_config.get('global_concurrency', 2))),
+        'per_user_concurrency': max(1, int(job_config.get('per_user_concurrency', 1))),
+        'max_attempts': max(1, int(job_config.get('max_attempts', 3))),
+        'retry_delay': float(job_config.get('retry_delay', 60)),
+        'heartbeat_interval': float(job_config.get('heartbeat_interval', 5)),
+        'stale_after': float(job_config.get('stale_after', 120)),
+        'poll_interval': float(job_config.get('poll_interval', 2)),
+    }
+
+def get_worker_id():
+    """工作进程标识：主机名和进程号"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def enqueue_job(knowledge_base, user, force_create=False, task_id=None):
+    """把知识库处理任务加入队列"""
+    config = get_job_config()
+    job = ProcessingJob.objects.create(
+        knowledge_base=knowledge_base,
+        user=user,
+        task_id=task_id,
+        force_create=bool(force_create),
+        max_attempts=config['max_attempts'],
+        stage='initializing',
+        message='等待处理...',
+    )
+    return job
+
+def request_cancel(job):
+    """取消任务：等待中的任务直接取消，运行中的任务在处理下一批文档前停止"""
+    cancelled = ProcessingJob.objects.filter(id=job.id, status='pending').update(
+        status='cancelled', stage='cancelled', message='处理已取消', finished_at=timezone.now()
+    )
+    if not cancelled:
+        ProcessingJob.objects.filter(id=job.id, status='running').update(cancel_requested=True)
+        request_task_cancel(get_task_group(job.knowledge_base_id, job.task_id))
+
+def get_job_progress(job):
+    """
+    把任务状态转换为进度接口的返回格式。
+    运行中的任务优先使用进度存储中的实时进度，其他状态以任务记录为准。
+    """
+    if job.status == 'running':
+        data = get_task_progress(get_task_group(job.knowledge_base_id, job.task_id))
+        if data:
+            return dict(data, attempts=job.attempts, failed_files=job.failed_files)
+    if job.status == 'pending':
+        status = 'initializing'
+    elif job.status == 'running':
+        status = job.stage or 'processing'
+    elif job.status == 'failed':
+        status = 'error'
+    else:
+        status = job.status
+    total = max(job.total, 1)
+    progress = min(job.progress, total)
+    if job.status == 'completed':
+        progress = total
+    return {
+        'status': status,
+        'message': job.message,
+        'progress': progress,
+        'total': total,
+        'task_id': job.task_id,
+        'attempts': job.attempts,
+        'failed_files': job.failed_files,
+        'timestamp': (job.finished_at or job.heartbeat_at or job.created_at).timestamp(),
+    }
+
+def reclaim_stale_jobs(config=None):
+    """心跳超时的运行中任务（工作进程被终止）重新放回队列，超过最大尝试次数则标记失败"""
+    config = config or get_job_config()
+    deadline = timezone.now() - timedelta(seconds=config['stale_after'])
+    stale = ProcessingJob.objects.filter(status='running', heartbeat_at__lt=deadline)
+    for job in stale:
+        if job.attempts < job.max_attempts:
+            updated = ProcessingJob.objects.filter(id=job.id, status='running', heartbeat_at__lt=deadline).update(
+                status='pending', stage='initializing', worker_id='',
+                message='处理进程已中断，等待从检查点继续...'
+            )
+        else:
+            updated = ProcessingJob.objects.filter(id=job.id, status='running', heartbeat_at__lt=deadline).update(
+                status='failed', stage='error', message='处理进程多次中断，任务失败', finished_at=timezone.now()
+            )
+        if updated:
+            print_colorful(f"回收中断的任务: {job.task_id}", text_color=Fore.YELLOW)
+
+def _count_of(queryset):
+    """queryset 的行数，作为子查询用于条件更新"""
+    return Coalesce(Subquery(
+        queryset.order_by().values('status').annotate(num_jobs=Count('id')).values('num_jobs')[:1]
+    ), 0)
+
+def claim_next_job(worker_id, config=None):
+    """
+    领取下一个可运行的任务。
+    遵守全局和每个用户的并发上限，同一知识库同时只运行一个任务。
+    先按当前运行中的任务筛选候选任务，再对每个候选任务执行一条条件更新：
+    status仍为pending、且各项并发上限仍满足时才更新。检查和领取在同一条UPDATE语句中完成，
+    多个工作进程同时领取时不会超过上限，一个任务也只会被一个工作进程领取。
+    """
+    config = config or get_job_config()
+    running = ProcessingJob.objects.filter(status='running')
+    if running.count() >= config['global_concurrency']:
+        return None
+    busy_users = (
+        running.values('user').annotate(num_jobs=Count('id'))
+        .filter(num_jobs__gte=config['per_user_concurrency']).values_list('user', flat=True)
+    )
+    busy_knowledge_bases = running.values_list('knowledge_base', flat=True)
+    now = timezone.now()
+    candidates = (
+        ProcessingJob.objects.filter(status='pending', run_after__lte=now)
+        .exclude(user__in=list(busy_users))
+        .exclude(knowledge_base__in=list(busy_knowledge_bases))
+        .order_by('created_at')[:10]
+    )
+    for job in candidates:
+        claimed = ProcessingJob.objects.filter(id=job.id, status='pending').alias(
+            global_running=_count_of(running),
+            user_running=_count_of(running.filter(user=OuterRef('user'))),
+            knowledge_base_busy=Exists(running.filter(knowledge_base=OuterRef('knowledge_base'))),
+        ).filter(
+            global_running__lt=config['global_concurrency'],
+            user_running__lt=config['per_user_concurrency'],
+            knowledge_base_busy=False,
+        ).update(
+            status='running', worker_id=worker_id, attempts=F('attempts') + 1,
+            started_at=now, heartbeat_at=now, stage='initializing', message='正在初始化...'
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+def release_worker_jobs(worker_id):
+    """工作进程退出时把自己正在运行的任务放回队列，本次中断不计入尝试次数"""
+    return ProcessingJob.objects.filter(status='running', worker_id=worker_id).update(
+        status='pending', stage='initializing', worker_id='', attempts=F('attempts') - 1,
+        message='处理进程已停止，等待从检查点继续...'
+    )
+
+class JobMonitor(threading.Thread):
+    """
+    任务运行期间的后台线程：定期写入心跳，并把进度存储中的进度同步到任务记录，
+    进度存储过期后仍能从任务记录查看结果。
+    """
+    def __init__(self, job, interval):
+        super().__init__(daemon=True)
+        self.job_id = job.id
+        self.group_name = get_task_group(job.knowledge_base_id, job.task_id)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def sync(self):
+        data = get_task_progress(self.group_name)
+        fields = {'heartbeat_at': timezone.now()}
+        if data:
+            fields.update(
+                stage=data.get('status', ''),
+                message=data.get('message', ''),
+                progress=data.get('progress', 0),
+                total=data.get('total', 0),
+            )
+        ProcessingJob.objects.filter(id=self.job_id, status='running').update(**fields)
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    self.sync()
+                except Exception as e:
+                    print_colorful(f"同步任务状态失败: {str(e)}", text_color=Fore.YELLOW)
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def run_job(job, config=None):
+    """在当前线程执行一个已领取的任务，结束后根据结果更新任务状态"""
+    config = config or get_job_config()
+    knowledge_base = job.knowledge_base
+    checkpoint = dict(job.checkpoint or {})
+
+    # 强制重建时先把全部文档重置为未处理，中断后从检查点继续只需处理剩余文档
+    if job.force_create and not checkpoint.get('reset'):
+        knowledge_base.documents.update(processed=False)
+        checkpoint['reset'] = True
+        ProcessingJob.objects.filter(id=job.id).update(checkpoint=checkpoint)
+    # 重置后已有文档被标记为已处理，说明新索引已经保存过（检查点或上一次尝试），继续追加剩余文档
+    force_create = job.force_create and not knowledge_base.documents.filter(processed=True).exists()
+
+    def save_checkpoint(document_ids):
+        checkpoint['documents'] = checkpoint.get('documents', []) + list(document_ids)
+        ProcessingJob.objects.filter(id=job.id).update(checkpoint=checkpoint, heartbeat_at=timezone.now())
+
+    monitor = JobMonitor(job, config['heartbeat_interval'])
+    monitor.start()
+    print(f"开始执行任务: {job.task_id} (知识库 {knowledge_base.name}, 第 {job.attempts} 次尝试)")
+    try:
+        try:
+            result = process_documents(
+                knowledge_base, force_create, task_id=job.task_id, checkpoint_callback=save_checkpoint
+            )
+            error = None
+        except Exception as e:
+            traceback.print_exc()
+            result, error = {}, str(e)
+        monitor.stop()
+        monitor.sync()
+
+        now = timezone.now()
+        jobs = ProcessingJob.objects.filter(id=job.id, status='running')
+        if isinstance(result, dict) and result.get('task_cancelled'):
+            jobs.update(status='cancelled', stage='cancelled', message='处理已取消', finished_at=now)
+        elif error or result:
+            failed_files = result or {'*': error}
+            if job.attempts < job.max_attempts:
+                # 失败的文件保持未处理状态，稍后重试时只处理这些文件
+                retry_at = now + timedelta(seconds=config['retry_delay'] * job.attempts)
+                jobs.update(
+                    status='pending', stage='initializing', worker_id='', run_after=retry_at,
+                    failed_files=failed_files,
+                    message=f'{len(failed_files)} 个文件处理失败，将在 {retry_at.strftime("%H:%M:%S")} 重试'
+                )
+            else:
+                jobs.update(
+                    status='failed', stage='error', failed_files=failed_files, finished_at=now,
+                    message=f'{len(failed_files)} 个文件处理失败: ' + '; '.join(
+                        f'{os.path.basename(path)}: {reason}' for path, reason in failed_files.items()
+                    )
+                )
+        else:
+            jobs.update(status='completed', stage='completed', failed_files={}, finished_at=now)
+        print(f"任务执行结束: {job.task_id}")
+    finally:
+        if monitor.is_alive():
+            monitor.stop()
+        connection.close()
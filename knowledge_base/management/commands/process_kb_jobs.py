@@ -0,0 +1,53 @@
+# knowledge_base/management/commands/process_kb_jobs.py
+import signal
+import threading
+import time
+from django.core.management.base import BaseCommand
+from knowledge_base.jobs import (
+    claim_next_job, get_job_config, get_worker_id, reclaim_stale_jobs, release_worker_jobs, run_job,
+)
+
+class Command(BaseCommand):
+    help = '运行知识库文档处理任务的工作进程'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='本进程同时运行的任务数，默认使用全局并发上限')
+        parser.add_argument('--once', action='store_true',
+                            help='处理完当前可运行的任务后退出')
+
+    def handle(self, *args, **options):
+        config = get_job_config()
+        concurrency = options['concurrency'] or config['global_concurrency']
+        worker_id = get_worker_id()
+        self.stdout.write(f"工作进程 {worker_id} 已启动，并发任务数: {concurrency}")
+
+        # systemd、docker stop 等发送 SIGTERM 时与 Ctrl+C 一样正常退出，把正在运行的任务放回队列
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
+
+        threads = []
+        try:
+            while True:
+                threads = [thread for thread in threads if thread.is_alive()]
+                reclaim_stale_jobs(config)
+
+                while len(threads) < concurrency:
+                    job = claim_next_job(worker_id, config)
+                    if job is None:
+                        break
+                    thread = threading.Thread(target=run_job, args=(job, config), daemon=True)
+                    thread.start()
+                    threads.append(thread)
+
+                if options['once'] and not threads:
+                    break
+                time.sleep(config['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            released = release_worker_jobs(worker_id)
+            self.stdout.write(f"工作进程已停止，{released} 个任务已放回队列")
+
+    @staticmethod
+    def handle_sigterm(signum, frame):
+        raise KeyboardInterrupt
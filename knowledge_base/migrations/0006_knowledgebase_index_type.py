@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-16 22:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("knowledge_base", "0005_alter_knowledgebase_name_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="knowledgebase",
+            name="index_params",
+            field=models.JSONField(
+                blank=True,
+                default=dict,
+                help_text="索引构建参数，如 nlist、pq_m、pq_nbits、hnsw_m、train_size",
+            ),
+        ),
+        migrations.AddField(
+            model_name="knowledgebase",
+            name="index_type",
+            field=models.CharField(
+                choices=[
+                    ("flat", "精确检索(Flat)"),
+                    ("ivf_flat", "倒排索引(IVF-Flat)"),
+                    ("ivf_pq", "倒排+乘积量化(IVF-PQ)"),
+                    ("hnsw", "图索引(HNSW)"),
+                ],
+                default="flat",
+                help_text="大规模知识库可选择近似索引，修改后需重新创建知识库",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-16 22:57
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("knowledge_base", "0006_knowledgebase_index_type"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="document",
+            name="file_hash",
+            field=models.CharField(
+                blank=True, help_text="文件内容的BLAKE2b哈希，用于去重", max_length=64
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="document",
+            index=models.Index(
+                fields=["knowledge_base", "file_hash"],
+                name="knowledge_b_knowled_0e1a3c_idx",
+            ),
+        ),
+    ]
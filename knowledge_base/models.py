@@ -1,6 +1,7 @@
 # knowledge_base/models.py
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 import os
 
 def document_upload_path(instance, filename):
@@ -30,6 +31,24 @@ class KnowledgeBase(models.Model):
         default='remote', 
         help_text="选择使用远程API或本地Ollama进行嵌入"
     )
+    # 向量索引类型
+    INDEX_TYPE_CHOICES = [
+        ('flat', '精确检索(Flat)'),
+        ('ivf_flat', '倒排索引(IVF-Flat)'),
+        ('ivf_pq', '倒排+乘积量化(IVF-PQ)'),
+        ('hnsw', '图索引(HNSW)'),
+    ]
+    index_type = models.CharField(
+        max_length=10,
+        choices=INDEX_TYPE_CHOICES,
+        default='flat',
+        help_text="大规模知识库可选择近似索引，修改后需重新创建知识库"
+    )
+    index_params = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="索引构建参数，如 nlist、pq_m、pq_nbits、hnsw_m、train_size"
+    )
     
     def __str__(self):
         return self.name
@@ -43,7 +62,7 @@ class Document(models.Model):
     knowledge_base = models.ForeignKey(KnowledgeBase, on_delete=models.CASCADE, related_name='documents')
     file = models.FileField(upload_to=document_upload_path)
     filename = models.CharField(max_length=255)
-    file_hash = models.CharField(max_length=64, blank=True)
+    file_hash = models.CharField(max_length=64, blank=True, help_text="文件内容的BLAKE2b哈希，用于去重")
     uploaded_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='uploaded_documents')
     uploaded_at = models.DateTimeField(auto_now_add=True)
     processed = models.BooleanField(default=False)
@@ -55,4 +74,50 @@ class Document(models.Model):
     class Meta:
         verbose_name = "文档"
         verbose_name_plural = "文档"
-        unique_together = ('knowledge_base', 'filename')
\ No newline at end of file
+        unique_together = ('knowledge_base', 'filename')
+        indexes = [
+            models.Index(fields=['knowledge_base', 'file_hash']),
+        ]
+
+class ProcessingJob(models.Model):
+    """知识库文档处理任务，由 process_kb_jobs 命令在独立的工作进程中执行"""
+    STATUS_CHOICES = [
+        ('pending', '等待中'),
+        ('running', '处理中'),
+        ('completed', '已完成'),
+        ('failed', '失败'),
+        ('cancelled', '已取消'),
+    ]
+    knowledge_base = models.ForeignKey(KnowledgeBase, on_delete=models.CASCADE, related_name='jobs')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='processing_jobs')
+    task_id = models.CharField(max_length=64, unique=True)
+    force_create = models.BooleanField(default=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now, help_text="重试任务在此时间之后才会被领取")
+    cancel_requested = models.BooleanField(default=False)
+    worker_id = models.CharField(max_length=100, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    # 最近一次同步的处理进度
+    stage = models.CharField(max_length=20, blank=True)
+    message = models.TextField(blank=True)
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    # 检查点：已写入索引的文档ID，以及强制重建时是否已重置文档状态
+    checkpoint = models.JSONField(default=dict, blank=True)
+    failed_files = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"{self.knowledge_base.name} ({self.task_id})"
+    
+    class Meta:
+        verbose_name = "处理任务"
+        verbose_name_plural = "处理任务"
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
@@ -1,43 +1,75 @@
-from rest_framework.views import APIView
-from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
-from django.conf import settings
-
-class ProcessingProgressView(APIView):
-    """获取处理进度的API"""
-    permission_classes = [IsAuthenticated]
-    
-    def get(self, request, kb_id, task_id):
-        """获取指定任务的进度"""
-        group_name = f'kb_{kb_id}_{task_id}'
-        
-        # 从settings中获取进度数据
-        progress_data = settings.PROCESSING_TASKS.get(group_name, {})
-        
-        if not progress_data:
-            # 检查是否存在任务正在启动但尚未设置进度的情况
-            # 通常在任务刚刚创建时可能出现这种情况
-            pending_tasks = [k for k in settings.PROCESSING_TASKS.keys() if k.startswith(f'kb_{kb_id}_')]
-            if pending_tasks:
-                # 如果有正在处理的任务，返回初始化状态
-                return Response({
-                    'status': 'initializing',
-                    'message': '正在初始化处理...',
-                    'progress': 0,
-                    'total': 100
-                })
-            else:
-                # 确实找不到任务
-                return Response({
-                    'status': 'not_found',
-                    'message': '找不到指定的任务',
-                    'progress': 0,
-                    'total': 1
-                })
-        
-        # 确保进度不超过总数
-        if 'progress' in progress_data and 'total' in progress_data:
-            if progress_data['progress'] > progress_data['total']:
-                progress_data['progress'] = progress_data['total']
-        
-        return Response(progress_data)
\ No newline at end of file
+"""
+处理进度接口。
+使用Django原生异步视图实现长轮询：等待进度更新期间通过 asyncio.sleep 让出事件循环，
+在ASGI服务器（如 uvicorn rag_project.asgi:application）下不占用工作线程。
+"""
+import asyncio
+import time
+from django.views.decorators.http import require_GET
+from chat.async_views import authenticate, json_response, unauthorized_response
+from core.rag.task_progress import FINAL_STATUSES, get_task_group, get_task_progress
+from .models import ProcessingJob
+from .jobs import get_job_progress
+
+# 长轮询的最长等待时间和检查间隔（秒）
+MAX_WAIT_SECONDS = 30
+POLL_INTERVAL = 1.0
+
+def parse_float(value, default=None):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+@require_GET
+async def processing_progress(request, kb_id, task_id):
+    """
+    获取指定任务的进度。
+    支持长轮询：传入 since（上次收到的 timestamp）和 wait（秒），
+    进度没有更新时最多等待 wait 秒再返回，前端不需要频繁轮询。
+    """
+    user = await authenticate(request)
+    if user is None:
+        return unauthorized_response()
+
+    since = parse_float(request.GET.get('since'))
+    wait = min(max(parse_float(request.GET.get('wait'), 0), 0), MAX_WAIT_SECONDS)
+    deadline = time.time() + wait
+
+    # 任务记录只查找一次，之后按主键刷新
+    job = await ProcessingJob.objects.filter(
+        knowledge_base_id=kb_id, knowledge_base__user=user, task_id=task_id
+    ).afirst()
+    while True:
+        progress_data = await asyncio.to_thread(get_progress, kb_id, task_id, job)
+        if (since is None
+                or progress_data['status'] in FINAL_STATUSES + ('not_found',)
+                or progress_data.get('timestamp', 0) > since
+                or time.time() >= deadline):
+            return json_response(progress_data)
+        await asyncio.sleep(min(POLL_INTERVAL, max(deadline - time.time(), 0)))
+        if job is not None:
+            job = await ProcessingJob.objects.filter(id=job.id).afirst()
+
+def get_progress(kb_id, task_id, job=None):
+    # 后台任务由独立的工作进程执行，进度保存在共享的进度存储和任务记录中
+    if job is not None:
+        progress_data = get_job_progress(job)
+    else:
+        progress_data = get_task_progress(get_task_group(kb_id, task_id))
+
+    if not progress_data:
+        # 确实找不到任务
+        return {
+            'status': 'not_found',
+            'message': '找不到指定的任务',
+            'progress': 0,
+            'total': 1
+        }
+
+    # 确保进度不超过总数
+    if 'progress' in progress_data and 'total' in progress_data:
+        if progress_data['progress'] > progress_data['total']:
+            progress_data['progress'] = progress_data['total']
+
+    return progress_data
@@ -1,5 +1,6 @@
 # knowledge_base/serializers.py
 from rest_framework import serializers
+from core.rag.faiss_index import validate_index_params
 from .models import KnowledgeBase, Document
 
 class DocumentSerializer(serializers.ModelSerializer):
@@ -14,7 +15,8 @@ class KnowledgeBaseSerializer(serializers.ModelSerializer):
     class Meta:
         model = KnowledgeBase
         fields = ['id', 'name', 'description', 'created_at', 'updated_at', 
-                  'chunk_size', 'chunk_overlap', 'merge_rows', 'embedding_type', 'documents_count']
+                  'chunk_size', 'chunk_overlap', 'merge_rows', 'embedding_type',
+                  'index_type', 'index_params', 'documents_count']
         read_only_fields = ['id', 'created_at', 'updated_at']
     
     def get_documents_count(self, obj):
@@ -28,6 +30,17 @@ class KnowledgeBaseSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError("您已创建过同名知识库")
         return value
 
+    def validate(self, attrs):
+        """按索引类型检查索引参数（部分更新时使用知识库当前的值）"""
+        index_type = attrs.get('index_type', getattr(self.instance, 'index_type', 'flat'))
+        index_params = attrs.get('index_params', getattr(self.instance, 'index_params', {}))
+        if 'index_type' in attrs or 'index_params' in attrs:
+            try:
+                attrs['index_params'] = validate_index_params(index_type, index_params)
+            except ValueError as e:
+                raise serializers.ValidationError({'index_params': str(e)})
+        return attrs
+
 class KnowledgeBaseDetailSerializer(KnowledgeBaseSerializer):
     documents = DocumentSerializer(many=True, read_only=True)
     
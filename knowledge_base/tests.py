@@ -1,3 +1,155 @@
-from django.test import TestCase
+import copy
+import shutil
+import tempfile
+import time
+import zlib
+from unittest import mock
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from langchain_core.embeddings import Embeddings
+from rest_framework_simplejwt.tokens import RefreshToken
+from core.rag.chunk_store import ChunkStore, get_chunk_store_path
+from core.rag.document_processor import process_documents
+from .models import Document, KnowledgeBase, ProcessingJob
+from .serializers import KnowledgeBaseSerializer
 
-# Create your tests here.
+class IndexParamsValidationTests(TestCase):
+    def validate(self, data, instance=None):
+        serializer = KnowledgeBaseSerializer(instance, data=data, partial=instance is not None)
+        return serializer.is_valid(), serializer
+
+    def test_valid_params(self):
+        valid, serializer = self.validate({
+            'name': 'kb', 'index_type': 'ivf_pq',
+            'index_params': {'nlist': 100, 'pq_m': 16, 'pq_nbits': 8, 'train_size': 50000},
+        })
+        self.assertTrue(valid, serializer.errors)
+        valid, serializer = self.validate({'name': 'kb', 'index_type': 'hnsw', 'index_params': {'hnsw_m': None}})
+        self.assertTrue(valid, serializer.errors)
+        self.assertEqual(serializer.validated_data['index_params'], {})
+
+    def test_invalid_params(self):
+        cases = [
+            ('flat', {'nlist': 100}),                         # Flat索引没有参数
+            ('hnsw', {'nlist': 100}),                         # 其他索引类型的参数
+            ('hnsw', {'hnsw_m': '32'}),                       # 不是整数
+            ('hnsw', {'hnsw_m': True}),
+            ('ivf_pq', {'pq_nbits': 32}),                     # 超出范围
+            ('ivf_flat', {'nlist': 4096, 'train_size': 10000}),  # 聚类数超过训练样本支持的数量
+            ('ivf_flat', [100]),                              # 不是JSON对象
+        ]
+        for index_type, index_params in cases:
+            with self.subTest(index_type=index_type, index_params=index_params):
+                valid, serializer = self.validate({'name': 'kb', 'index_type': index_type, 'index_params': index_params})
+                self.assertFalse(valid)
+                self.assertIn('index_params', serializer.errors)
+
+    def test_partial_update_uses_current_index_type(self):
+        user = User.objects.create_user(username='kb-owner', password='test')
+        knowledge_base = KnowledgeBase.objects.create(user=user, name='kb', index_type='hnsw')
+        valid, serializer = self.validate({'index_params': {'ef_construction': 400}}, instance=knowledge_base)
+        self.assertTrue(valid, serializer.errors)
+        valid, serializer = self.validate({'index_params': {'nlist': 100}}, instance=knowledge_base)
+        self.assertFalse(valid)
+
+class StubEmbeddings(Embeddings):
+    """按文本哈希生成固定向量；fail_after 次调用之后抛出异常，模拟嵌入服务中断"""
+    max_batch_size = 2
+    max_concurrency = 1
+
+    def __init__(self, fail_after=None):
+        self.calls = 0
+        self.fail_after = fail_after
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        if self.fail_after is not None and self.calls > self.fail_after:
+            raise RuntimeError('嵌入服务中断')
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = np.random.default_rng(zlib.crc32(text.encode('utf-8'))).standard_normal(8)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+class CheckpointResumeTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        rag_configs = copy.deepcopy(getattr(settings, 'RAG_CONFIGS', {}))
+        rag_configs['ingestion'] = {'workers': 1, 'queue_size': 16, 'checkpoint_interval': 1e-9}
+        rag_configs.setdefault('database', {}).setdefault('faiss_params', {})['report'] = {'enabled': False}
+        overrides = override_settings(MEDIA_ROOT=media_root, RAG_CONFIGS=rag_configs)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        user = User.objects.create_user(username='kb-owner', password='test')
+        self.knowledge_base = KnowledgeBase.objects.create(user=user, name='kb', chunk_size=100, chunk_overlap=0)
+        # 第一个文件只有一个文本块，与第二个文件的第一个文本块在同一批次中嵌入
+        self.first = self.add_document('a.txt', '第一个文件只有一行。')
+        self.second = self.add_document('b.txt', '\n\n'.join(f'第二个文件的第{i}段，' + '内容' * 30 for i in range(6)))
+
+    def add_document(self, filename, text):
+        document = Document(knowledge_base=self.knowledge_base, filename=filename)
+        document.file.save(filename, ContentFile(text.encode('utf-8')), save=False)
+        document.save()
+        return document
+
+    def run_processing(self, embeddings, force_create=False):
+        with mock.patch('core.rag.document_processor.get_embeddings', return_value=embeddings):
+            return process_documents(self.knowledge_base, force_create=force_create)
+
+    def document_rows(self):
+        index_name = f'user_{self.knowledge_base.user.id}_{self.knowledge_base.name}'
+        store = ChunkStore(get_chunk_store_path(f'{settings.MEDIA_ROOT}/faiss_index', index_name))
+        return {document.id: len(store.find_document_rows(document.id)) for document in (self.first, self.second)}
+
+    def test_resume_after_mid_file_checkpoint(self):
+        # 第一批写入后保存检查点（包含第二个文件的部分文本块），第二批时中断
+        failed = self.run_processing(StubEmbeddings(fail_after=1))
+        self.assertIn(self.second.file.path, failed)
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertTrue(self.first.processed)
+        self.assertFalse(self.second.processed)
+        self.assertEqual(self.document_rows(), {self.first.id: 1, self.second.id: 1})
+
+        self.assertEqual(self.run_processing(StubEmbeddings()), {})
+        resumed = self.document_rows()
+
+        self.run_processing(StubEmbeddings(), force_create=True)
+        self.assertEqual(resumed, self.document_rows())
+        self.assertGreater(resumed[self.second.id], 1)
+
+class ProcessingProgressTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='kb-owner', password='test')
+        self.knowledge_base = KnowledgeBase.objects.create(user=user, name='kb')
+        self.job = ProcessingJob.objects.create(knowledge_base=self.knowledge_base, user=user, task_id='task-1')
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(user).access_token}'}
+
+    def get(self, task_id='task-1', **params):
+        return self.client.get(f'/api/knowledge-base/{self.knowledge_base.id}/progress/{task_id}/', params, **self.auth)
+
+    def test_requires_authentication(self):
+        self.auth = {}
+        self.assertEqual(self.get().status_code, 401)
+
+    def test_returns_immediately_without_wait(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'initializing')
+        self.assertEqual(self.get('missing', since=0, wait=10).json()['status'], 'not_found')
+
+    def test_long_poll_waits_for_update(self):
+        timestamp = self.get().json()['timestamp']
+        start = time.monotonic()
+        self.assertEqual(self.get(since=timestamp, wait=1).json()['timestamp'], timestamp)
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+
+        # 进度早于 since 之后才更新时立即返回
+        start = time.monotonic()
+        self.assertEqual(self.get(since=timestamp - 1, wait=10).json()['status'], 'initializing')
+        self.assertLess(time.monotonic() - start, 1)
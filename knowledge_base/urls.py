@@ -8,5 +8,5 @@ urlpatterns = [
     path('<int:pk>/documents/', views.DocumentListView.as_view(), name='document_list'),
     path('<int:kb_pk>/documents/<int:pk>/', views.DocumentDetailView.as_view(), name='document_detail'),
     path('<int:pk>/process/', views.ProcessKnowledgeBaseView.as_view(), name='process_knowledge_base'),
-    path('<int:kb_id>/progress/<str:task_id>/', progress.ProcessingProgressView.as_view(), name='processing_progress'),
+    path('<int:kb_id>/progress/<str:task_id>/', progress.processing_progress, name='processing_progress'),
 ]
\ No newline at end of file
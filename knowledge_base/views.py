@@ -4,12 +4,14 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.parsers import MultiPartParser, FormParser
 from django.shortcuts import get_object_or_404
-from .models import KnowledgeBase, Document
+from .models import KnowledgeBase, Document, ProcessingJob
+from .jobs import enqueue_job, request_cancel
 from .serializers import KnowledgeBaseSerializer, KnowledgeBaseDetailSerializer, DocumentSerializer
-from core.rag.document_processor import process_documents
+from core.rag.document_processor import get_index_lock, remove_document_from_index
+from core.rag.services import invalidate_rag_service
+from core.utils import get_hash_of_chunks
 import os
 import uuid
-import threading
 from django.conf import settings
 
 class KnowledgeBaseListView(generics.ListCreateAPIView):
@@ -38,7 +40,6 @@ class KnowledgeBaseDetailView(generics.RetrieveUpdateDestroyAPIView):
     
     def perform_destroy(self, instance):
         # 删除知识库文件夹
-        from django.conf import settings
         import shutil
         
         # 使用包含用户ID的路径
@@ -49,28 +50,24 @@ class KnowledgeBaseDetailView(generics.RetrieveUpdateDestroyAPIView):
         if os.path.exists(kb_doc_path):
             shutil.rmtree(kb_doc_path)
             
-        # 删除向量数据库文件 - 使用新的文件名格式
+        # 删除向量数据库文件 - 使用新的文件名格式（持有索引写锁，避免与正在处理的任务同时写入）
+        db_vector_path = os.path.join(settings.MEDIA_ROOT, 'faiss_index')
         index_name = f"user_{user_id}_{instance.name}"
-        for ext in ['.faiss', '.pkl']:
-            vector_path = os.path.join(settings.MEDIA_ROOT, 'faiss_index', f"{index_name}{ext}")
-            if os.path.exists(vector_path):
-                os.remove(vector_path)
+        with get_index_lock(db_vector_path, index_name):
+            for ext in ['.faiss', '.pkl', '.report.json']:
+                vector_path = os.path.join(db_vector_path, f"{index_name}{ext}")
+                if os.path.exists(vector_path):
+                    os.remove(vector_path)
+            for ext in ['.chunks', '.lexical']:
+                store_path = os.path.join(db_vector_path, f"{index_name}{ext}")
+                if os.path.exists(store_path):
+                    shutil.rmtree(store_path)
+        lock_path = os.path.join(db_vector_path, f"{index_name}.lock")
+        if os.path.exists(lock_path):
+            os.remove(lock_path)
                 
-        # 删除哈希记录 - 使用新的键名格式
-        from core.utils import read_json_file, save_json_file
-        hash_file_path = os.path.join(settings.MEDIA_ROOT, 'documents', 'hash_file.json')
-        hash_data = read_json_file(hash_file_path)
-        
-        # 检查新旧两种键名格式
-        old_key = instance.name
-        new_key = f"user_{user_id}_{instance.name}"
-        
-        if new_key in hash_data:
-            del hash_data[new_key]
-            save_json_file(hash_data, hash_file_path)
-        elif old_key in hash_data:
-            del hash_data[old_key]
-            save_json_file(hash_data, hash_file_path)
+        # 清除已缓存的RAG服务
+        invalidate_rag_service(user_id, instance.name)
         
         instance.delete()
 
@@ -96,11 +93,12 @@ class DocumentListView(generics.ListCreateAPIView):
             if not file:
                 return Response({"error": "没有找到文件"}, status=status.HTTP_400_BAD_REQUEST)
             
-            # 创建文档记录
+            # 创建文档记录，上传时按块计算文件哈希用于去重
             document = Document(
                 knowledge_base=kb,
                 file=file,
                 filename=file.name,
+                file_hash=get_hash_of_chunks(file.chunks()),
                 uploaded_by=request.user
             )
             document.save()
@@ -121,6 +119,23 @@ class DocumentDetailView(generics.RetrieveDestroyAPIView):
         kb_id = self.kwargs.get('kb_pk')
         kb = get_object_or_404(KnowledgeBase, id=kb_id, user=self.request.user)
         return Document.objects.filter(knowledge_base=kb)
+    
+    def perform_destroy(self, instance):
+        kb = instance.knowledge_base
+        
+        # 从向量索引中删除该文档的文本块和法律结构
+        try:
+            remove_document_from_index(kb, instance)
+        except Exception as e:
+            print(f"从索引中删除文档 {instance.filename} 失败: {str(e)}")
+            import traceback
+            traceback.print_exc()
+        
+        # 删除上传的文件
+        if instance.file:
+            instance.file.delete(save=False)
+        
+        instance.delete()
 
 class ProcessKnowledgeBaseView(APIView):
     """处理知识库文档"""
@@ -148,41 +163,11 @@ class ProcessKnowledgeBaseView(APIView):
                     status=status.HTTP_200_OK
                 )
             
-            # 初始化任务状态
-            group_name = f'kb_{pk}_{task_id}'
-            settings.PROCESSING_TASKS[group_name] = {
-                'status': 'initializing',
-                'message': '正在初始化...',
-                'progress': 0,
-                'total': 100,
-                'task_id': task_id
-            }
-            
-            # 异步处理文档
-            def process_async():
-                try:
-                    print(f"异步处理任务开始: {task_id}")
-                    failed_docs = process_documents(kb, force_create, task_id=task_id)
-                    if failed_docs and isinstance(failed_docs, dict) and failed_docs.get('task_cancelled'):
-                        print(f"任务已取消: {task_id}")
-                    elif failed_docs:
-                        print(f"处理失败的文档: {failed_docs}")
-                except Exception as e:
-                    print(f"异步处理文档时出错: {str(e)}")
-                    # 更新任务状态为错误
-                    group_name = f'kb_{pk}_{task_id}'
-                    if group_name in settings.PROCESSING_TASKS:
-                        settings.PROCESSING_TASKS[group_name]['status'] = 'error'
-                        settings.PROCESSING_TASKS[group_name]['message'] = f'处理时出错: {str(e)}'
-                    import traceback
-                    traceback.print_exc()
-            
-            thread = threading.Thread(target=process_async)
-            thread.daemon = True
-            thread.start()
+            # 加入任务队列，由 process_kb_jobs 工作进程执行
+            enqueue_job(kb, request.user, force_create, task_id)
             
             return Response({
-                'message': '文档处理已开始',
+                'message': '文档处理任务已加入队列',
                 'task_id': task_id
             })
                 
@@ -201,12 +186,11 @@ class ProcessKnowledgeBaseView(APIView):
             return Response({'error': '未提供任务ID'}, status=status.HTTP_400_BAD_REQUEST)
         
         print(f"取消处理任务: KB={pk}, 任务ID={task_id}")
-        group_name = f'kb_{pk}_{task_id}'
+        job = ProcessingJob.objects.filter(knowledge_base=kb, task_id=task_id).first()
         
         # 标记任务为已取消
-        if group_name in settings.PROCESSING_TASKS:
-            settings.PROCESSING_TASKS[group_name]['status'] = 'cancelled'
-            settings.PROCESSING_TASKS[group_name]['message'] = '处理已取消'
+        if job is not None:
+            request_cancel(job)
             return Response({'message': '任务已取消'})
         else:
             return Response({'error': '找不到指定的任务'}, status=status.HTTP_404_NOT_FOUND)
\ No newline at end of file
@@ -3,4 +3,8 @@ from django.apps import AppConfig
 class ModelManagerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'model_manager'
-    verbose_name = '模型管理'
\ No newline at end of file
+    verbose_name = '模型管理'
+
+    def ready(self):
+        # 注册模型变化时刷新LLM服务缓存的信号
+        from . import signals  # noqa: F401
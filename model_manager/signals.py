@@ -0,0 +1,9 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from core.llm.services import invalidate_llm_services
+from .models import LLMModel
+
+@receiver([post_save, post_delete], sender=LLMModel)
+def refresh_llm_services(sender, instance, **kwargs):
+    """模型新增、修改或删除后刷新LLM服务缓存（QuerySet.update 不会触发，批量修改后需手动调用 invalidate_llm_services）"""
+    invalidate_llm_services()
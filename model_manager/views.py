@@ -47,13 +47,13 @@ class LLMModelListView(generics.ListCreateAPIView):
     
     def perform_create(self, serializer):
         instance = serializer.save()
-        # 通知其他服务刷新模型缓存
+        # 模型服务缓存由 model_manager.signals 自动刷新
         print(f"创建了新模型: {instance.name}")
         return instance
 
     def perform_update(self, serializer):
         instance = serializer.save()
-        # 通知其他服务刷新模型缓存
+        # 模型服务缓存由 model_manager.signals 自动刷新
         print(f"更新了模型: {instance.name}")
         return instance
 
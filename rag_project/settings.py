@@ -167,24 +167,154 @@ RAG_CONFIGS = {
         'api_key': ,
         'base_url': 'https://api.siliconflow.cn/v1/',
         'local_model': 'bge-m3',  
+        # 同时在途的嵌入批次数，以及提供商级别的速率限制（每分钟请求数/token数）
+        'max_concurrency': 4,
+        'rate_limit': {'rpm': 2000, 'tpm': 500000},
+        # 本地Ollama嵌入：每次请求 /api/embed 的文本数和并发请求数
+        'local_batch_size': 32,
+        'local_max_concurrency': 2,
     },
     'reranker': {
         'provider': 'siliconflow',
         'model_name': 'BAAI/bge-reranker-v2-m3',
         'api_key': ,
         'context_len': 8192,
+        'base_url': 'https://api.siliconflow.cn/v1/rerank',
+        # 每次打分（含重试）的总截止时间和建立连接的超时（秒），临时错误最多重试 max_retries 次（指数退避，初始 backoff 秒）
+        'timeout': 10,
+        'connect_timeout': 3,
+        'max_retries': 2,
+        'backoff': 0.2,
+        # 候选文档按 batch_size 拆分子批次，最多 max_concurrency 个同时请求
+        'batch_size': 32,
+        'max_concurrency': 4,
+        # (模型, 查询, 文档) 分数缓存的条数和有效期（秒）
+        'cache_size': 10000,
+        'cache_ttl': 3600,
+        # provider 为 'local' 时在本机CPU上用ONNX Runtime运行交叉编码器（需要安装 onnxruntime 和 tokenizers）：
+        # local_model_path 目录中放导出的 local_onnx_file 和 tokenizer.json，local_quantize 为 True 时使用int8动态量化模型；
+        # 按长度排序分成 local_batch_size 大小的微批次，最多 local_max_concurrency 个批次同时推理，
+        # 每次推理使用 local_num_threads 个线程（0 表示由 ONNX Runtime 决定）
+        'local_model_path': os.path.join(BASE_DIR, 'models', 'bge-reranker-v2-m3-onnx'),
+        'local_onnx_file': 'model.onnx',
+        'local_quantize': True,
+        'local_max_length': 512,
+        'local_batch_size': 8,
+        'local_max_concurrency': 2,
+        'local_num_threads': 0,
     },
     'database': {
         'db_type': 'faiss',
         'db_docs_path': os.path.join(MEDIA_ROOT, 'documents'),
-        'hash_file_path': os.path.join(MEDIA_ROOT, 'documents/hash_file.json'),
         'db_vector_path': os.path.join(MEDIA_ROOT, 'faiss_index'),
         'chunk_size': 512,
         'chunk_overlap': 50,
         'merge_rows': 2,
+        # 以只读mmap方式加载索引和文本块存储（文本块存储和IVF倒排表由多个工作进程共享页缓存）
+        'mmap': True,
         'faiss_params': {
             'search_type': 'similarity',
             'search_kwargs': {'k': 8},
+            # 每次检索只嵌入一次、批量检索一次，每个查询取回 candidate_k 个候选，
+            # 条款精确匹配、元数据过滤和兜底检索都在这批候选中进行，最后保留前 k 个
+            'candidate_k': 32,
+            # 近似索引的查询参数：IVF每次查询访问的聚类数、HNSW查询时的搜索宽度
+            'nprobe': 16,
+            'efSearch': 64,
+            # 每次新建索引后生成召回率-延迟报告（{index_name}.report.json）
+            'report': {'enabled': True, 'num_queries': 100, 'k': 10},
+        },
+    },
+    # 知识库文档处理：切分文件的进程数（0表示使用全部CPU核心）、切分结果队列长度、进程启动方式、
+    # 保存检查点的间隔秒数（已写入索引的文件标记为已处理，任务中断后从剩余文件继续，0表示只在结束时保存）
+    'ingestion': {
+        'workers': 4,
+        'queue_size': 16,
+        'start_method': 'spawn',
+        'checkpoint_interval': 60,
+    },
+    # 处理进度存储：保存在 cache_alias 指定的共享缓存中，ttl 秒后过期；同一状态下的进度更新至少间隔 min_interval 秒
+    'progress': {
+        'cache_alias': 'shared',
+        'ttl': 86400,
+        'min_interval': 0.5,
+    },
+    # 后台处理任务队列（python manage.py process_kb_jobs）：全局和每个用户同时运行的任务数、
+    # 失败文件的最大尝试次数和重试间隔、心跳间隔和判定任务中断的超时时间（秒）
+    'jobs': {
+        'global_concurrency': 2,
+        'per_user_concurrency': 1,
+        'max_attempts': 3,
+        'retry_delay': 60,
+        'heartbeat_interval': 5,
+        'stale_after': 120,
+        'poll_interval': 2,
+    },
+    # 持久化嵌入缓存：按 (provider, model_name, sha256(text)) 保存float32向量，重建知识库时只嵌入变化的块
+    'embedding_cache': {
+        'enabled': True,
+        'path': os.path.join(MEDIA_ROOT, 'embedding_cache', 'embeddings.sqlite3'),
+    },
+    # 已加载RAG服务的进程内缓存（LRU，按数量和估算内存淘汰）
+    'service_cache': {
+        'max_entries': 16,
+        'max_memory_mb': 2048,
+    },
+    # 多查询检索（RAGService.retrieve_many，用于附件的各个段落）：最多保留 max_queries 个查询（按信息量选择），
+    # 忽略短于 min_query_chars 的段落；合并后的候选文档用各查询拼接成的前 rerank_query_chars 个字符统一重排序
+    'multi_query': {
+        'max_queries': 12,
+        'min_query_chars': 10,
+        'rerank_query_chars': 512,
+    },
+    # BM25倒排索引（{index_name}.lexical，中文按字二元组分词，条款编号整体作为一个词）：与向量索引一起生成，
+    # 精确条款查询直接读取倒排表；向量检索结果与BM25的前 top_k 个结果按倒数排名融合（RRF，常数 rrf_k）
+    'lexical': {
+        'enabled': True,
+        'k1': 1.2,
+        'b': 0.75,
+        'top_k': 20,
+        'rrf_k': 60,
+    },
+    # 检索结果缓存：backend 为 'local'（进程内LRU）或 'django'（使用 CACHES 中的 cache_alias，可多进程共享）
+    'retrieval_cache': {
+        'backend': 'local',
+        'cache_alias': 'shared',
+        'max_entries': 1000,
+        'ttl': 3600,
+    },
+    # 对话模型客户端：LLMService 按模型缓存并复用HTTP长连接（安装 h2 后对HTTPS接口使用HTTP/2）；
+    # 模型配置修改后通过 cache_alias 中的版本标记通知其他进程，各进程最多每 check_interval 秒检查一次
+    'llm_clients': {
+        'http2': True,
+        'max_connections': 100,
+        'max_keepalive_connections': 20,
+        'keepalive_expiry': 60,
+        'cache_alias': 'shared',
+        'check_interval': 5,
+    },
+    # 聊天历史：按模型的 context_length 预留回复（reply_tokens）和检索结果（rag_tokens）后截取最近的消息，
+    # 每次最多查询 max_messages 条；更早的消息压缩（每条最多 summary_line_chars 字）后并入不超过 summary_tokens 的滚动摘要
+    'chat_history': {
+        'encoding': 'cl100k_base',
+        'reply_tokens': 1024,
+        'rag_tokens': 2048,
+        'max_messages': 50,
+        'summary_tokens': 512,
+        'summary_line_chars': 200,
+    },
+}
+
+# 缓存配置：'shared' 为基于文件的缓存，可在多个工作进程间共享
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
         },
     },
 }
@@ -212,5 +342,3 @@ LOGGING = {
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REQUEST_TIMEOUT = 180
-
-PROCESSING_TASKS = {}
\ No newline at end of file